@@ -4,13 +4,16 @@
 """
 
 import time
+import asyncio
 import base64
 import os
 import sys
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional, Annotated
+from typing import List, Optional, Annotated, Literal
 
 # 添加項目根目錄到 Python 路徑（用於雲端部署）
 current_dir = Path(__file__).parent
@@ -19,8 +22,10 @@ if str(parent_dir) not in sys.path:
     sys.path.insert(0, str(parent_dir))
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, Request, status, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
@@ -28,30 +33,78 @@ from sqlalchemy.orm import Session
 # 導入自定義模塊
 try:
     from scripts.database import (
-        create_tables, get_db, User, Document, AIModel, UserAIModelPreference,
+        create_tables, get_db, SessionLocal, User, Document, AIModel, UserAIModelPreference,
         create_user, authenticate_user, get_user_by_username, get_user_by_email,
         create_access_token, verify_token, create_document, get_user_documents, delete_document,
         create_builtin_models, get_available_models, create_custom_model, delete_custom_model,
         set_user_model_preference, get_user_model_preferences, get_user_default_model, 
         delete_user_model_preference, delete_user_model_preference_by_id
     )
-    from scripts.user_knowledge_base import UserKnowledgeBaseSystem
+    from scripts.resource_manager import get_resource_manager
+    from scripts.rate_limit import RateLimiter, RateLimitExceeded
+    from scripts.provider_health import get_provider_health
+    from scripts.model_router import get_model_router
+    from scripts.lexical_index import RETRIEVAL_MODE, RETRIEVAL_MODES
+    from scripts.search_filter import SearchFilter
+    from scripts.search_cache import (
+        SearchResultCache, InvalidCursor, encode_cursor, decode_cursor, SEARCH_CACHE_DEPTH, SEARCH_MAX_PAGE_SIZE
+    )
+    from scripts.latency_budget import (
+        Deadline, BudgetExceeded, BudgetEvents, DeferredAnswers, LLM_MIN_BUDGET_MS, LLM_TIMEOUT,
+        MAX_BUDGET_MS
+    )
 except ImportError:
     # 本地開發環境的導入方式
     from database import (
-        create_tables, get_db, User, Document, AIModel, UserAIModelPreference,
+        create_tables, get_db, SessionLocal, User, Document, AIModel, UserAIModelPreference,
         create_user, authenticate_user, get_user_by_username, get_user_by_email,
         create_access_token, verify_token, create_document, get_user_documents, delete_document,
         create_builtin_models, get_available_models, create_custom_model, delete_custom_model,
         set_user_model_preference, get_user_model_preferences, get_user_default_model, 
         delete_user_model_preference, delete_user_model_preference_by_id
     )
-    from user_knowledge_base import UserKnowledgeBaseSystem
+    from resource_manager import get_resource_manager
+    from rate_limit import RateLimiter, RateLimitExceeded
+    from provider_health import get_provider_health
+    from model_router import get_model_router
+    from lexical_index import RETRIEVAL_MODE, RETRIEVAL_MODES
+    from search_filter import SearchFilter
+    from search_cache import (
+        SearchResultCache, InvalidCursor, encode_cursor, decode_cursor, SEARCH_CACHE_DEPTH, SEARCH_MAX_PAGE_SIZE
+    )
+    from latency_budget import (
+        Deadline, BudgetExceeded, BudgetEvents, DeferredAnswers, LLM_MIN_BUDGET_MS, LLM_TIMEOUT,
+        MAX_BUDGET_MS
+    )
 
 # 載入環境變數
 load_dotenv()
 load_dotenv(dotenv_path=parent_dir / '.env')  # 嘗試從項目根目錄加載
 
+# CPU 資源分區：必須在後台線程導入 torch / faiss 之前設置線程數環境變數
+resource_manager = get_resource_manager()
+resource_manager.configure_environment()
+
+# 按用戶和接口類別限流
+rate_limiter = RateLimiter.from_env()
+# 服務前的可信反向代理層數；0 表示直連，按 IP 限流時忽略 X-Forwarded-For
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+# 可查看 /system/memory 和 /system/resources 的管理員用戶名（逗號分隔），未設置時對所有用戶返回 403
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
+# 查詢延遲預算：耗盡事件統計和延遲答案
+budget_events = BudgetEvents()
+deferred_answers = DeferredAnswers()
+# LLM 生成在獨立線程池中執行，超出預算的請求返回後仍可繼續完成
+# LLM 調用失敗時是否自動改用抽取式答案
+EXTRACTIVE_FALLBACK = os.getenv("EXTRACTIVE_FALLBACK", "true").lower() == "true"
+llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_MAX_CONCURRENCY", "8")), thread_name_prefix="llm")
+# /search 分頁使用的檢索結果緩存
+search_cache = SearchResultCache()
+# 批量查詢：每批最多查詢數，以及單批同時進行的 LLM 生成數上限
+BATCH_QUERY_MAX_ITEMS = int(os.getenv("BATCH_QUERY_MAX_ITEMS", "100"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+
 # 創建數據庫表
 create_tables()
 
@@ -92,27 +145,98 @@ security = HTTPBearer()
 user_kb_system = None
 kb_system_error = None
 
+# 知識庫載入進度（供 /ready 查詢）
+kb_loading_state = {
+    "status": "pending",  # pending / loading / ready / failed
+    "stage": "等待啟動",
+    "progress": 0.0,
+    "started_at": None,
+    "finished_at": None,
+    "elapsed": None,
+    "model_load_seconds": None
+}
+# 載入期間上傳或刪除過文檔的用戶，載入完成後補建索引
+pending_index_users = set()
+kb_state_lock = threading.Lock()
+
+def _set_loading_state(**kwargs):
+    with kb_state_lock:
+        kb_loading_state.update(kwargs)
+        if kb_loading_state["started_at"] is not None:
+            kb_loading_state["elapsed"] = round(time.time() - kb_loading_state["started_at"], 2)
+
 def initialize_kb_system():
     """初始化知識庫系統，帶錯誤處理"""
     global user_kb_system, kb_system_error
     
+    _set_loading_state(status="loading", stage="導入依賴 (torch / faiss)", progress=0.1, started_at=time.time())
     try:
         print("🔄 正在初始化 AI 知識庫系統...")
-        user_kb_system = UserKnowledgeBaseSystem()
-        print("✅ AI 知識庫系統初始化成功")
+        # 延遲導入：torch、sentence-transformers 和 faiss 只在此處載入
+        try:
+            from scripts.user_knowledge_base import UserKnowledgeBaseSystem
+        except ImportError:
+            from user_knowledge_base import UserKnowledgeBaseSystem
+        
+        _set_loading_state(stage="載入嵌入模型", progress=0.4)
+        kb_system = UserKnowledgeBaseSystem(resource_manager=resource_manager)
+        
+        user_kb_system = kb_system
         kb_system_error = None
+        _set_loading_state(status="ready", stage="就緒", progress=1.0, finished_at=time.time(),
+                           model_load_seconds=round(kb_system.model_load_seconds, 3))
+        print(f"✅ AI 知識庫系統初始化成功，耗時 {kb_loading_state['elapsed']}s")
+        
+        _rebuild_pending_indexes()
         return True
     except Exception as e:
         print(f"⚠️ AI 知識庫系統初始化失敗: {e}")
         print("💡 系統將以基礎模式運行（不含 AI 功能）")
         user_kb_system = None
         kb_system_error = str(e)
+        _set_loading_state(status="failed", stage=f"載入失敗: {e}", finished_at=time.time())
         return False
 
-# 嘗試初始化知識庫系統
-initialize_kb_system()
+def reset_after_fork():
+    """預先 fork 的 worker 啟動前調用：丟棄從主進程繼承的數據庫連接（不關閉，主進程仍在使用）"""
+    engine.dispose(close=False)
+
+def _rebuild_pending_indexes():
+    """為載入期間變更過文檔的用戶補建索引"""
+    with kb_state_lock:
+        user_ids = list(pending_index_users)
+        pending_index_users.clear()
+    
+    for user_id in user_ids:
+        try:
+            user_kb_system.build_user_index(user_id)
+            search_cache.invalidate_user(user_id)
+        except Exception as e:
+            print(f"用戶 {user_id} 補建索引失敗: {e}")
+
+def start_kb_system_loading():
+    """在後台線程中載入知識庫，應用可以立即開始接受請求"""
+    if kb_loading_state["status"] != "pending":
+        return
+    _set_loading_state(status="loading", stage="啟動載入線程")
+    threading.Thread(target=initialize_kb_system, name="kb-loader", daemon=True).start()
+
+def kb_system_loading() -> bool:
+    """知識庫是否仍在載入中"""
+    return kb_loading_state["status"] in ("pending", "loading")
+
+@app.on_event("startup")
+async def load_kb_system_in_background():
+    # 工作池線程在每個 worker 進程內創建
+    resource_manager.start_pools()
+    start_kb_system_loading()
 
 # Pydantic 模型
+# 枚舉型字段用 Literal 聲明，取值不合法時由 FastAPI 返回 422
+AnswerMode = Literal["llm", "extractive"]
+RoutingMode = Literal["default", "latency"]
+RetrievalMode = Literal["vector", "lexical", "hybrid"]
+
 class UserRegister(BaseModel):
     username: str
     email: str  # 使用 str 替代 EmailStr 以兼容較舊版本
@@ -135,9 +259,38 @@ class UserInfo(BaseModel):
     full_name: Optional[str]
     created_at: datetime
 
+class SearchFilterRequest(BaseModel):
+    document_ids: Optional[List[int]] = None  # 只在這些文檔中檢索（/documents 返回的 id）
+    file_types: Optional[List[str]] = None  # 如 ["pdf", "docx"]
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
 class QueryRequest(BaseModel):
     query: str
     top_k: Optional[int] = 5
+    budget_ms: Optional[float] = None  # 延遲預算，未設置時讀取 X-Latency-Budget-Ms 頭或默認值
+    allow_deferred: bool = True  # 超出預算時是否允許通過 /query/deferred/{answer_id} 獲取答案
+    routing: Optional[RoutingMode] = None  # default / latency（在已設定的模型間按延遲路由並對沖），默認讀取 LLM_ROUTING_MODE
+    mode: AnswerMode = "llm"  # llm / extractive（不調用 LLM，直接從文檔中摘錄答案）
+    retrieval: Optional[RetrievalMode] = None  # vector / lexical / hybrid，默認讀取 RETRIEVAL_MODE
+    filters: Optional[SearchFilterRequest] = None  # 限定檢索的文檔、文件類型和上傳時間
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    top_k: Optional[int] = 5
+    generate: bool = True  # 是否為每個查詢生成答案；False 時只返回檢索結果
+    mode: AnswerMode = "llm"  # llm / extractive
+    concurrency: Optional[int] = None  # LLM 併發數，不超過 BATCH_LLM_CONCURRENCY
+    routing: Optional[RoutingMode] = None
+    retrieval: Optional[RetrievalMode] = None
+    filters: Optional[SearchFilterRequest] = None  # 所有查詢共用
+
+class SearchRequest(BaseModel):
+    query: str
+    page_size: int = 10
+    cursor: Optional[str] = None  # 上一頁返回的 next_cursor
+    retrieval: Optional[RetrievalMode] = None  # vector / lexical（型號、錯誤碼等精確詞）/ hybrid
+    filters: Optional[SearchFilterRequest] = None
 
 class QueryResponse(BaseModel):
     query: str
@@ -211,12 +364,66 @@ async def get_current_user(
     
     return user
 
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """要求當前用戶在 ADMIN_USERNAMES 中"""
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="需要管理員權限"
+        )
+    return current_user
+
+def _enforce_rate_limit(endpoint_class: str, identity: str):
+    try:
+        rate_limiter.check(endpoint_class, identity)
+    except RateLimitExceeded as e:
+        retry_after = max(1, int(e.retry_after + 0.999))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "message": str(e),
+                "endpoint_class": e.endpoint_class,
+                "limit_per_minute": e.limit.per_minute,
+                "burst": e.limit.burst,
+                "retry_after": retry_after
+            },
+            headers={"Retry-After": str(retry_after)},
+        )
+
+def _client_ip(request: Request) -> str:
+    """
+    限流使用的客戶端地址：默認取直連地址；部署在 TRUSTED_PROXY_COUNT 層可信代理之後時，
+    取 X-Forwarded-For 中由最外層可信代理追加的一跳（更左側的值可由客戶端偽造）
+    """
+    peer = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if TRUSTED_PROXY_COUNT <= 0 or not forwarded:
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    if not hops:
+        return peer
+    return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
+
+def rate_limited_user(endpoint_class: str):
+    """按用戶限流的依賴，返回當前用戶"""
+    # 同步依賴：SQLite 存儲的 BEGIN IMMEDIATE 可能阻塞，由 FastAPI 放到線程池執行，不佔用事件循環
+    def dependency(current_user: User = Depends(get_current_user)) -> User:
+        _enforce_rate_limit(endpoint_class, f"user:{current_user.id}")
+        return current_user
+    return dependency
+
+def rate_limited_client(endpoint_class: str):
+    """按客戶端 IP 限流的依賴（用於未認證的接口）"""
+    def dependency(request: Request):
+        _enforce_rate_limit(endpoint_class, f"ip:{_client_ip(request)}")
+    return dependency
+
 # API 端點
 @app.get("/")
 async def root():
     return {"message": "企業知識庫 API 服務運行中 (支持用戶認證)", "version": "2.0.0"}
 
-@app.post("/auth/register", response_model=Token)
+@app.post("/auth/register", response_model=Token, dependencies=[Depends(rate_limited_client("auth"))])
 async def register(user_data: UserRegister, db: Session = Depends(get_db)):
     """用戶註冊"""
     # 檢查用戶名是否已存在
@@ -256,7 +463,7 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
         }
     }
 
-@app.post("/auth/login", response_model=Token)
+@app.post("/auth/login", response_model=Token, dependencies=[Depends(rate_limited_client("auth"))])
 async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     """用戶登入"""
     user = authenticate_user(db, user_data.username, user_data.password)
@@ -296,7 +503,7 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(rate_limited_user("upload")),
     db: Session = Depends(get_db)
 ):
     """上傳文檔 (需要認證)"""
@@ -352,9 +559,17 @@ async def upload_document(
         
         # 嘗試重建用戶索引
         index_status = "基礎存儲模式"
-        if user_kb_system is not None:
+        if user_kb_system is None and kb_system_loading():
+            with kb_state_lock:
+                pending_index_users.add(current_user.id)
+            index_status = "AI 系統載入中，索引將在載入完成後建立"
+        elif user_kb_system is not None:
             try:
-                user_kb_system.build_user_index(current_user.id)
+                # 分片索引只重建新文件所在的分片
+                await run_in_threadpool(
+                    user_kb_system.build_user_index, current_user.id, [Path(file_path_str).name]
+                )
+                search_cache.invalidate_user(current_user.id)
                 index_status = "AI 索引已更新"
             except Exception as e:
                 print(f"索引建立失敗: {e}")
@@ -371,16 +586,106 @@ async def upload_document(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"上傳失敗: {str(e)}")
 
+def _extractive_fallback(user_id: int, query: str, texts: List[str], sources: List[dict], reason: str) -> str:
+    result = user_kb_system.extractive_answer(user_id, query, texts, sources)
+    return f"（{reason.rstrip('。')}，以下內容直接摘錄自您的文檔）\n\n{result['answer']}"
+
+def _generate_answer(user_id: int, query: str, context_docs: List[str], timeout: float,
+                     routing: Optional[str] = None, texts: Optional[List[str]] = None,
+                     sources: Optional[List[dict]] = None) -> str:
+    """
+    在 LLM 線程池中生成回答；使用獨立的數據庫會話，請求返回後仍可安全完成
+    
+    傳入 texts / sources 且啟用 EXTRACTIVE_FALLBACK 時，LLM 失敗後返回抽取式答案
+    """
+    fallback = None
+    if EXTRACTIVE_FALLBACK and texts:
+        fallback = lambda reason: _extractive_fallback(user_id, query, texts, sources, reason)
+    
+    db = SessionLocal()
+    try:
+        return user_kb_system.query_user_with_llm(
+            user_id=user_id,
+            query=query,
+            context_docs=context_docs,
+            db_session=db,
+            timeout=timeout,
+            routing=routing,
+            fallback=fallback
+        )
+    finally:
+        db.close()
+
+def _partial_answer(user_id: int, query: str, texts: List[str], search_results: List[dict]) -> str:
+    """預算內未完成生成時的部分答案：抽取式答案，失敗時退回最相關的文檔片段"""
+    reason = "在延遲預算內未能完成 AI 回答"
+    try:
+        return _extractive_fallback(user_id, query, texts, search_results, reason)
+    except Exception as e:
+        print(f"抽取式答案生成失敗: {e}")
+    snippets = "\n\n".join(f"[{r['rank']}] {r['content'][:300]}" for r in search_results[:2])
+    return f"{reason}，以下是最相關的文檔內容：\n\n{snippets}"
+
+def _retrieval_mode(retrieval: Optional[str]) -> str:
+    mode = (retrieval or RETRIEVAL_MODE).lower()
+    if mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"retrieval 可選 {', '.join(RETRIEVAL_MODES)}")
+    return mode
+
+def _search_filter(filters: Optional[SearchFilterRequest], user_id: int, db: Session) -> Optional[SearchFilter]:
+    """把請求中的過濾條件轉成 SearchFilter；文檔 ID 換成索引中的文件名，不屬於該用戶時返回 404"""
+    if filters is None:
+        return None
+    filenames = None
+    if filters.document_ids is not None:
+        documents = db.query(Document).filter(
+            Document.id.in_(filters.document_ids), Document.owner_id == user_id
+        ).all()
+        missing = set(filters.document_ids) - {document.id for document in documents}
+        if missing:
+            raise HTTPException(status_code=404, detail=f"文檔不存在或無權限訪問: {sorted(missing)}")
+        filenames = [document.filename for document in documents]
+    return SearchFilter(
+        filenames=filenames,
+        file_types=filters.file_types,
+        uploaded_after=filters.uploaded_after.timestamp() if filters.uploaded_after else None,
+        uploaded_before=filters.uploaded_before.timestamp() if filters.uploaded_before else None
+    )
+
+def _request_budget_ms(request: QueryRequest, http_request: Request) -> Optional[float]:
+    if request.budget_ms is not None:
+        return request.budget_ms
+    header = http_request.headers.get("x-latency-budget-ms")
+    try:
+        return float(header) if header else None
+    except ValueError:
+        return None
+
 @app.post("/query")
 async def query_knowledge_base(
     request: QueryRequest,
-    current_user: User = Depends(get_current_user),
+    http_request: Request,
+    current_user: User = Depends(rate_limited_user("query")),
     db: Session = Depends(get_db)
 ):
     """查詢個人知識庫 (需要認證)"""
     start_time = time.time()
+    deadline = Deadline(_request_budget_ms(request, http_request))
+    retrieval = _retrieval_mode(request.retrieval)
+    search_filter = _search_filter(request.filters, current_user.id, db)
     
     # 檢查 AI 系統是否可用
+    if user_kb_system is None and kb_system_loading():
+        return {
+            "query": request.query,
+            "answer": f"AI 系統正在啟動中（{kb_loading_state['stage']}），請稍後重試。",
+            "sources": [],
+            "processing_time": time.time() - start_time,
+            "ai_enabled": False,
+            "loading": dict(kb_loading_state),
+            "error": "AI system loading"
+        }
+    
     if user_kb_system is None:
         return {
             "query": request.query,
@@ -391,13 +696,31 @@ async def query_knowledge_base(
             "error": "AI system unavailable"
         }
     
+    budget_events.query_started()
     try:
         # 搜索用戶的文檔
-        search_results = user_kb_system.search_user_documents(
-            user_id=current_user.id,
-            query=request.query,
-            top_k=request.top_k
-        )
+        try:
+            search_results = await run_in_threadpool(
+                user_kb_system.search_user_documents,
+                user_id=current_user.id,
+                query=request.query,
+                top_k=request.top_k,
+                deadline=deadline,
+                with_text=True,
+                retrieval=retrieval,
+                filters=search_filter
+            )
+        except BudgetExceeded as e:
+            budget_events.record(e.stage, deadline, current_user.id, outcome="no_results")
+            return {
+                "query": request.query,
+                "answer": "查詢在檢索階段超出延遲預算，請稍後重試或提高 budget_ms。",
+                "sources": [],
+                "processing_time": time.time() - start_time,
+                "ai_enabled": True,
+                "degraded": True,
+                "budget": deadline.summary()
+            }
         
         if not search_results:
             return {
@@ -408,17 +731,71 @@ async def query_knowledge_base(
                 "ai_enabled": True
             }
         
-        # 提取最相關的上下文文檔
-        context_docs = [result['content'] for result in search_results[:2]]
+        texts = [result.pop('text') for result in search_results]
         
-        # 使用 LLM 生成回答
-        answer = user_kb_system.query_user_with_llm(
-            user_id=current_user.id,
-            query=request.query,
-            context_docs=context_docs,
-            db_session=db
+        # 抽取式模式：不調用 LLM，直接從文檔中摘錄答案
+        if request.mode == "extractive":
+            extractive = await run_in_threadpool(
+                user_kb_system.extractive_answer, current_user.id, request.query, texts, search_results
+            )
+            deadline.mark("extractive")
+            return {
+                "query": request.query,
+                "answer": extractive["answer"],
+                "sources": search_results,
+                "processing_time": time.time() - start_time,
+                "ai_enabled": True,
+                "mode": "extractive",
+                "spans": extractive["spans"],
+                "confidence": extractive["confidence"],
+                "low_confidence": extractive["low_confidence"],
+                "budget": deadline.summary()
+            }
+        
+        # 按 token 預算打包上下文；剩餘預算不足以等待 LLM 時跳過句子壓縮
+        packed = await run_in_threadpool(
+            user_kb_system.build_context,
+            current_user.id,
+            request.query,
+            texts,
+            compress=None if deadline.remaining_ms() > LLM_MIN_BUDGET_MS else False
+        )
+        deadline.mark("context")
+        context_docs = packed.docs or [result['content'] for result in search_results[:2]]
+        
+        # 使用 LLM 生成回答：允許延遲獲取時 LLM 請求使用完整超時，否則受剩餘預算限制
+        llm_timeout = LLM_TIMEOUT if request.allow_deferred else deadline.timeout(cap=LLM_TIMEOUT)
+        future = llm_executor.submit(
+            _generate_answer, current_user.id, request.query, context_docs, llm_timeout, request.routing,
+            texts, search_results
         )
         
+        # 剩餘預算不足以等待 LLM 時直接降級
+        wait = deadline.remaining() if deadline.remaining_ms() >= LLM_MIN_BUDGET_MS else 0
+        try:
+            answer = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=wait)
+            deadline.mark("generation")
+        except asyncio.TimeoutError:
+            response = {
+                "query": request.query,
+                "answer": await run_in_threadpool(
+                    _partial_answer, current_user.id, request.query, texts, search_results
+                ),
+                "sources": search_results,
+                "processing_time": time.time() - start_time,
+                "ai_enabled": True,
+                "degraded": True,
+                "budget": deadline.summary(),
+                "context": packed.summary()
+            }
+            if request.allow_deferred:
+                answer_id = deferred_answers.defer(future, current_user.id, request.query)
+                response["deferred"] = {"answer_id": answer_id, "url": f"/query/deferred/{answer_id}"}
+                budget_events.record("generation", deadline, current_user.id, outcome="deferred")
+            else:
+                budget_events.record("generation", deadline, current_user.id, outcome="partial")
+            return response
+        
         processing_time = time.time() - start_time
         
         return {
@@ -426,7 +803,9 @@ async def query_knowledge_base(
             "answer": answer,
             "sources": search_results,
             "processing_time": processing_time,
-            "ai_enabled": True
+            "ai_enabled": True,
+            "budget": deadline.summary(),
+            "context": packed.summary()
         }
     except Exception as e:
         return {
@@ -438,6 +817,173 @@ async def query_knowledge_base(
             "error": str(e)
         }
 
+@app.get("/query/deferred/{answer_id}")
+async def get_deferred_answer(
+    answer_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """獲取超出延遲預算後仍在生成的答案 (需要認證)：status 為 pending / ready / failed"""
+    result = deferred_answers.get(answer_id, current_user.id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="答案不存在或已過期")
+    return result
+
+@app.post("/search")
+async def search_knowledge_base(
+    request: SearchRequest,
+    current_user: User = Depends(rate_limited_user("search")),
+    db: Session = Depends(get_db)
+):
+    """
+    只檢索不生成答案 (需要認證)：返回帶分數和元數據的文檔片段
+    
+    第一頁一次檢索 SEARCH_CACHE_DEPTH 個結果並緩存，後續頁用 next_cursor 從緩存中切片；
+    結果集深度固定為 SEARCH_CACHE_DEPTH，翻過末尾返回空頁，不會按游標偏移量加深檢索
+    """
+    start_time = time.time()
+    if user_kb_system is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"AI 系統正在啟動中（{kb_loading_state['stage']}），請稍後重試" if kb_system_loading()
+            else f"AI 查詢功能暫時不可用：{kb_system_error or '未知錯誤'}"
+        )
+    page_size = max(1, min(request.page_size, SEARCH_MAX_PAGE_SIZE))
+    retrieval = _retrieval_mode(request.retrieval)
+    search_filter = _search_filter(request.filters, current_user.id, db)
+    filter_key = search_filter.key() if search_filter is not None else ""
+    
+    # 在檢索之前取版本：檢索期間索引被重建時，緩存的結果集下次按新版本失效
+    index_version = await run_in_threadpool(user_kb_system.index_version, current_user.id)
+    result_id, offset, results = None, 0, None
+    try:
+        if request.cursor:
+            result_id, offset = decode_cursor(request.cursor)
+            results = search_cache.get(result_id, current_user.id, request.query, retrieval, filter_key,
+                                       index_version)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # 不限制延遲預算，只用 Deadline 記錄各檢索階段耗時
+    timing = Deadline(MAX_BUDGET_MS)
+    cached = results is not None
+    if not cached:
+        # 第一頁，或緩存已過期 / 索引已重建 / 在其他 worker 上：重新檢索並沿用游標中的 result_id
+        results = await run_in_threadpool(
+            user_kb_system.search_user_documents,
+            user_id=current_user.id,
+            query=request.query,
+            top_k=SEARCH_CACHE_DEPTH,
+            deadline=timing,
+            retrieval=retrieval,
+            filters=search_filter
+        )
+        result_id = search_cache.put(current_user.id, request.query, results, result_id, retrieval, filter_key,
+                                     index_version)
+    
+    page = results[offset:offset + page_size]
+    next_offset = offset + len(page)
+    return {
+        "query": request.query,
+        "results": page,
+        "total": len(results),
+        "next_cursor": encode_cursor(result_id, next_offset) if next_offset < len(results) else None,
+        "cached": cached,
+        "retrieval": retrieval,
+        "timing": {"stages": dict(timing.stages)},
+        "processing_time": time.time() - start_time
+    }
+
+async def _answer_batch_item(user_id: int, query: str, search_results: List[dict], request: BatchQueryRequest,
+                             semaphore: asyncio.Semaphore) -> dict:
+    """批量查詢中的單個問題：打包上下文並生成答案，返回帶計時的結果"""
+    texts = [result.pop('text') for result in search_results]
+    item = {"query": query, "answer": None, "sources": search_results}
+    if not request.generate:
+        return item
+    if not search_results:
+        item["answer"] = "抱歉，在您的文檔中沒有找到相關信息。"
+        return item
+    
+    async with semaphore:
+        start_time = time.perf_counter()
+        try:
+            if request.mode == "extractive":
+                extractive = await run_in_threadpool(
+                    user_kb_system.extractive_answer, user_id, query, texts, search_results
+                )
+                item.update(answer=extractive["answer"], confidence=extractive["confidence"])
+            else:
+                packed = await run_in_threadpool(user_kb_system.build_context, user_id, query, texts)
+                item["context"] = packed.summary()
+                context_docs = packed.docs or [result['content'] for result in search_results[:2]]
+                item["answer"] = await asyncio.wrap_future(llm_executor.submit(
+                    _generate_answer, user_id, query, context_docs, LLM_TIMEOUT, request.routing,
+                    texts, search_results
+                ))
+        except Exception as e:
+            item.update(answer=f"生成回答時遇到錯誤：{str(e)}", error=str(e))
+        item["generation_ms"] = round((time.perf_counter() - start_time) * 1000, 1)
+    return item
+
+@app.post("/query/batch")
+async def batch_query_knowledge_base(
+    request: BatchQueryRequest,
+    current_user: User = Depends(rate_limited_user("batch")),
+    db: Session = Depends(get_db)
+):
+    """
+    批量查詢個人知識庫 (需要認證)
+    
+    所有問題一次嵌入、一次檢索，再以有限併發逐個生成答案；適用於評估集和定時報表任務
+    """
+    start_time = time.time()
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries 不能為空")
+    if len(request.queries) > BATCH_QUERY_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"每批最多 {BATCH_QUERY_MAX_ITEMS} 個查詢")
+    if user_kb_system is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"AI 系統正在啟動中（{kb_loading_state['stage']}），請稍後重試" if kb_system_loading()
+            else f"AI 查詢功能暫時不可用：{kb_system_error or '未知錯誤'}"
+        )
+    
+    search_filter = _search_filter(request.filters, current_user.id, db)
+    
+    # 批量查詢不使用查詢延遲預算，按最大預算創建 Deadline 記錄各階段耗時
+    timing = Deadline(MAX_BUDGET_MS)
+    try:
+        batch_results = await run_in_threadpool(
+            user_kb_system.search_user_documents_batch,
+            user_id=current_user.id,
+            queries=request.queries,
+            top_k=request.top_k,
+            deadline=timing,
+            with_text=True,
+            retrieval=_retrieval_mode(request.retrieval),
+            filters=search_filter
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量檢索失敗: {str(e)}")
+    
+    concurrency = max(1, min(request.concurrency or BATCH_LLM_CONCURRENCY, BATCH_LLM_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+    items = await asyncio.gather(*[
+        _answer_batch_item(current_user.id, query, search_results, request, semaphore)
+        for query, search_results in zip(request.queries, batch_results)
+    ])
+    timing.mark("generation")
+    
+    return {
+        "results": items,
+        "count": len(items),
+        "processing_time": time.time() - start_time,
+        "timing": {"stages": dict(timing.stages), "concurrency": concurrency},
+        "ai_enabled": True
+    }
+
 @app.get("/documents", response_model=List[DocumentInfo])
 async def list_user_documents(
     current_user: User = Depends(get_current_user),
@@ -464,6 +1010,10 @@ async def delete_user_document(
     db: Session = Depends(get_db)
 ):
     """刪除用戶文檔 (需要認證)"""
+    document = db.query(Document).filter(
+        Document.id == document_id, Document.owner_id == current_user.id
+    ).first()
+    filename = document.filename if document else None
     success = delete_document(db, document_id, current_user.id)
     
     if not success:
@@ -471,9 +1021,16 @@ async def delete_user_document(
     
     # 嘗試重新建立用戶索引
     index_status = "文檔已刪除"
-    if user_kb_system is not None:
+    if user_kb_system is None and kb_system_loading():
+        with kb_state_lock:
+            pending_index_users.add(current_user.id)
+        index_status = "文檔已刪除，索引將在 AI 系統載入完成後更新"
+    elif user_kb_system is not None:
         try:
-            user_kb_system.build_user_index(current_user.id)
+            await run_in_threadpool(
+                user_kb_system.build_user_index, current_user.id, [filename] if filename else None
+            )
+            search_cache.invalidate_user(current_user.id)
             index_status = "文檔已刪除，AI 索引已更新"
         except Exception as e:
             print(f"索引更新失敗: {e}")
@@ -495,7 +1052,7 @@ async def get_user_status(
     user_documents = get_user_documents(db, current_user.id)
     
     # 檢查 AI 系統狀態
-    ai_status = "ready" if user_kb_system is not None else "unavailable"
+    ai_status = "ready" if user_kb_system is not None else ("loading" if kb_system_loading() else "unavailable")
     
     # 獲取用戶的默認模型
     default_model_pref = get_user_default_model(db, current_user.id)
@@ -541,7 +1098,10 @@ async def get_user_status(
     }
     
     # 如果 AI 系統不可用，添加錯誤信息
-    if user_kb_system is None:
+    if user_kb_system is None and kb_system_loading():
+        status_response["loading"] = dict(kb_loading_state)
+        status_response["message"] = "系統運行中，AI 功能正在載入"
+    elif user_kb_system is None:
         status_response["ai_error"] = kb_system_error
         status_response["message"] = "系統運行中，但 AI 功能暫時不可用"
     
@@ -553,10 +1113,52 @@ async def health_check():
     return {
         "status": "healthy", 
         "timestamp": datetime.utcnow(),
-        "ai_system": "ready" if user_kb_system is not None else "initializing",
+        "ai_system": "ready" if user_kb_system is not None else ("initializing" if kb_system_loading() else "unavailable"),
         "version": "2.0.0"
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """就緒檢查 (無需認證)：AI 系統載入期間返回 503 和載入進度"""
+    with kb_state_lock:
+        loading = dict(kb_loading_state)
+    
+    body = {
+        "ready": loading["status"] not in ("pending", "loading"),
+        "ai_system": loading["status"],
+        "loading": loading,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    if loading["status"] == "failed":
+        # 基礎模式仍可服務認證和文檔管理
+        body["ai_error"] = kb_system_error
+    
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
+
+@app.get("/system/memory")
+async def memory_status(current_user: User = Depends(get_admin_user)):
+    """進程記憶體統計 (需要管理員權限)：預先 fork 模式下包含主進程和所有 worker"""
+    try:
+        from scripts.prefork import memory_report, get_master_pid
+    except ImportError:
+        from prefork import memory_report, get_master_pid
+    
+    # 由 worker 發起時統計主進程及其所有子進程
+    return memory_report(get_master_pid())
+
+@app.get("/system/resources")
+async def resource_status(current_user: User = Depends(get_admin_user)):
+    """運行資源統計 (需要管理員權限)：工作池、限流、延遲預算、LLM 熔斷與路由、檢索緩存和共享索引池"""
+    resources = resource_manager.stats()
+    resources["rate_limits"] = rate_limiter.stats()
+    resources["latency_budget"] = budget_events.stats()
+    resources["llm_providers"] = get_provider_health().stats()
+    resources["llm_routing"] = get_model_router().stats()
+    resources["search_cache"] = search_cache.stats()
+    if user_kb_system is not None and user_kb_system.pooled_indexes is not None:
+        resources["pooled_indexes"] = user_kb_system.pooled_indexes.stats()
+    return resources
+
 # AI模型管理端點
 @app.get("/ai-models", response_model=List[AIModelInfo])
 async def list_available_models(
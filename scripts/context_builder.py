@@ -0,0 +1,214 @@
+"""
+按 token 預算構建 LLM 上下文
+按檢索排名把文檔打包到 token 預算內，可選按與查詢的相似度刪去無關句子，
+減少提示詞 token 數、縮短生成時間
+"""
+
+import os
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 上下文 token 預算
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# 最多使用的檢索結果數
+CONTEXT_MAX_CHUNKS = int(os.getenv("CONTEXT_MAX_CHUNKS", "5"))
+# 是否按句子相似度壓縮，以及保留句子的最低餘弦相似度
+CONTEXT_COMPRESSION = os.getenv("CONTEXT_COMPRESSION", "true").lower() == "true"
+CONTEXT_MIN_SENTENCE_SIMILARITY = float(os.getenv("CONTEXT_MIN_SENTENCE_SIMILARITY", "0.35"))
+# tiktoken 編碼名稱（安裝了 tiktoken 時使用）
+CONTEXT_TIKTOKEN_ENCODING = os.getenv("CONTEXT_TIKTOKEN_ENCODING", "cl100k_base")
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 句末標點（中英文）或換行處切分，標點保留在前一句
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?；;])|(?<=\.)\s+|\n+")
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+# 以這些字符結尾的句子與下一句之間不加空格（CJK 文字和全角標點）
+_NO_SPACE_AFTER = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+class TokenCounter:
+    """tiktoken 可用時精確計數，否則按字符近似（CJK 每字約 1 token，其他約 4 字符 1 token）"""
+
+    def __init__(self, encoding: str = CONTEXT_TIKTOKEN_ENCODING):
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding)
+            except Exception as e:
+                logger.warning(f"tiktoken 編碼 {encoding} 載入失敗，使用近似計數: {e}")
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        cjk = len(_CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """按字符二分查找不超過 max_tokens 的前綴"""
+        if max_tokens <= 0:
+            return ""
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_BOUNDARY.split(text) if s and s.strip()]
+
+
+def join_sentences(sentences: List[str]) -> str:
+    text = ""
+    for sentence in sentences:
+        if text and not _NO_SPACE_AFTER.match(text[-1]):
+            text += " "
+        text += sentence
+    return text
+
+
+def score_sentences(encode: Callable[[List[str]], np.ndarray], query: str,
+                    chunks: List[List[str]]) -> List[np.ndarray]:
+    """一次嵌入查詢和所有句子，用矩陣乘法算出每句與查詢的餘弦相似度，按文檔分組返回"""
+    sentences = [sentence for chunk in chunks for sentence in chunk]
+    embeddings = encode([query] + sentences)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    scores = embeddings[1:] @ embeddings[0]
+
+    result, offset = [], 0
+    for chunk in chunks:
+        result.append(scores[offset:offset + len(chunk)])
+        offset += len(chunk)
+    return result
+
+
+@dataclass
+class PackedContext:
+    """打包結果：docs 按檢索排名排列，可直接傳給 query_user_with_llm"""
+    docs: List[str] = field(default_factory=list)
+    tokens: int = 0
+    original_tokens: int = 0
+    sentences_total: int = 0
+    sentences_kept: int = 0
+    compressed: bool = False
+
+    def summary(self) -> Dict:
+        return {
+            "chunks": len(self.docs),
+            "tokens": self.tokens,
+            "original_tokens": self.original_tokens,
+            "sentences_total": self.sentences_total,
+            "sentences_kept": self.sentences_kept,
+            "compressed": self.compressed
+        }
+
+
+class ContextBuilder:
+    """把檢索結果按 token 預算打包成上下文"""
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray],
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 max_chunks: int = CONTEXT_MAX_CHUNKS,
+                 compression: bool = CONTEXT_COMPRESSION,
+                 min_similarity: float = CONTEXT_MIN_SENTENCE_SIMILARITY,
+                 counter: Optional[TokenCounter] = None):
+        """
+        Args:
+            encode: 批量嵌入函數，返回 float32 矩陣（與檢索使用同一模型）
+            token_budget: 上下文 token 上限
+            max_chunks: 最多使用的檢索結果數
+            compression: 是否刪去與查詢相似度低的句子
+            min_similarity: 保留句子的最低餘弦相似度（每個文檔至少保留最相關的一句）
+        """
+        self.encode = encode
+        self.token_budget = token_budget
+        self.max_chunks = max_chunks
+        self.compression = compression
+        self.min_similarity = min_similarity
+        self.counter = counter or TokenCounter()
+
+    def build(self, query: str, texts: List[str], compress: Optional[bool] = None) -> PackedContext:
+        """
+        Args:
+            query: 用戶問題
+            texts: 按檢索排名排列的文檔全文
+            compress: 覆蓋構造時的 compression 設置（例如延遲預算不足時關閉）
+        """
+        compress = self.compression if compress is None else compress
+        texts = [text for text in texts[:self.max_chunks] if text.strip()]
+        packed = PackedContext(compressed=compress)
+        if not texts:
+            return packed
+
+        chunks = [split_sentences(text) for text in texts]
+        packed.original_tokens = sum(self.counter.count(text) for text in texts)
+        packed.sentences_total = sum(len(chunk) for chunk in chunks)
+
+        scores = None
+        if compress and packed.sentences_total:
+            try:
+                scores = score_sentences(self.encode, query, chunks)
+            except Exception as e:
+                logger.warning(f"句子相似度計算失敗，不壓縮上下文: {e}")
+                packed.compressed = False
+
+        remaining = self.token_budget
+        for i, sentences in enumerate(chunks):
+            if remaining <= 0:
+                break
+
+            if scores is not None:
+                chunk_scores = scores[i]
+                keep = chunk_scores >= self.min_similarity
+                keep[int(np.argmax(chunk_scores))] = True
+                order = np.argsort(-chunk_scores)
+            else:
+                keep = np.ones(len(sentences), dtype=bool)
+                order = np.arange(len(sentences))
+
+            # 按相關性（不壓縮時按原順序）選句子直到預算用完，再恢復原文順序
+            selected, used = [], 0
+            for j in order:
+                if not keep[j]:
+                    continue
+                tokens = self.counter.count(sentences[j])
+                if used + tokens > remaining:
+                    if scores is None:
+                        break
+                    continue
+                selected.append(j)
+                used += tokens
+            if not selected:
+                # 沒有完整句子放得下（例如無標點的長文檔整篇是一句）：截斷最相關的一句填滿剩餘預算
+                best = next(j for j in order if keep[j])
+                truncated = self.counter.truncate(sentences[best], remaining).strip()
+                if not truncated:
+                    continue
+                packed.docs.append(truncated)
+                packed.sentences_kept += 1
+                remaining -= self.counter.count(truncated)
+                continue
+
+            packed.docs.append(join_sentences([sentences[j] for j in sorted(selected)]))
+            packed.sentences_kept += len(selected)
+            remaining -= used
+
+        packed.tokens = sum(self.counter.count(doc) for doc in packed.docs)
+        return packed
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+嵌入模型預序列化
+部署時把嵌入模型寫成本地可直接載入的目錄（safetensors 權重 + 分詞器），運行時免去 Hugging Face 緩存解析
+"""
+
+import os
+import sys
+import json
+import inspect
+import time
+import logging
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "artifact.json"
+
+
+def _library_versions() -> dict:
+    versions = {}
+    for name in ("torch", "transformers", "sentence_transformers"):
+        try:
+            versions[name] = __import__(name).__version__
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+def build_model_artifact(model_name: str, output_dir) -> Path:
+    """
+    將模型保存為本地預序列化目錄
+
+    Args:
+        model_name: Hugging Face 模型名稱或本地路徑
+        output_dir: 輸出目錄
+
+    Returns:
+        輸出目錄路徑
+    """
+    from sentence_transformers import SentenceTransformer
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"預序列化嵌入模型: {model_name} -> {output_dir}")
+    model = SentenceTransformer(model_name, device="cpu")
+    model.save(str(output_dir))
+
+    # 舊版 transformers 默認寫 pytorch_model.bin（pickle），改寫為可 mmap 的 safetensors
+    bin_file = output_dir / "pytorch_model.bin"
+    if bin_file.exists():
+        model[0].auto_model.save_pretrained(str(output_dir), safe_serialization=True)
+        bin_file.unlink()
+
+    manifest = {
+        "model_name": model_name,
+        "created_at": datetime.utcnow().isoformat(),
+        "dimension": model.get_sentence_embedding_dimension(),
+        "max_seq_length": model.max_seq_length,
+        "weights": "model.safetensors",
+        "versions": _library_versions()
+    }
+    with open(output_dir / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    return output_dir
+
+
+def is_model_artifact(path) -> bool:
+    """目錄是否為 build_model_artifact 生成的模型"""
+    return path is not None and (Path(path) / MANIFEST_FILE).exists()
+
+
+def load_model_artifact(artifact_dir, expected_model_name: str = None):
+    """
+    從預序列化目錄載入模型
+
+    權重為 safetensors 格式，transformers 通過 mmap 讀取；從本地路徑載入不訪問 Hugging Face Hub
+    （sentence-transformers 支持時另加 local_files_only）。不設置進程級的離線環境變數，
+    載入失敗時調用方仍可改從 Hub 下載
+
+    Raises:
+        ValueError: 模型名稱或生成產物時的庫版本與當前環境不一致
+    """
+    artifact_dir = Path(artifact_dir)
+    with open(artifact_dir / MANIFEST_FILE, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if expected_model_name and manifest["model_name"] != expected_model_name:
+        raise ValueError(f"模型產物為 {manifest['model_name']}，與配置的 {expected_model_name} 不一致")
+
+    versions = _library_versions()
+    if versions != manifest.get("versions"):
+        # 序列化格式隨庫版本變化，不一致時視為載入失敗
+        raise ValueError(f"模型產物的庫版本與當前環境不一致: {manifest.get('versions')} != {versions}")
+
+    from sentence_transformers import SentenceTransformer
+
+    kwargs = {"device": "cpu"}
+    if "local_files_only" in inspect.signature(SentenceTransformer.__init__).parameters:
+        kwargs["local_files_only"] = True
+    return SentenceTransformer(str(artifact_dir), **kwargs)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="生成預序列化的嵌入模型目錄")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-zh"))
+    parser.add_argument("--output", default=os.getenv("EMBEDDING_ARTIFACT_DIR", "models/embedding"))
+    args = parser.parse_args()
+
+    output_dir = build_model_artifact(args.model, args.output)
+
+    # 驗證產物可以載入並報告載入耗時
+    start_time = time.perf_counter()
+    load_model_artifact(output_dir)
+    print(f"模型產物已生成: {output_dir}（載入耗時 {time.perf_counter() - start_time:.2f}s）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
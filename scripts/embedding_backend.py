@@ -0,0 +1,98 @@
+"""
+嵌入模型後端選擇
+根據 EMBEDDING_BACKEND 環境變數載入 PyTorch（默認）、ONNX Runtime 或遠程嵌入服務後端
+"""
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 支持的後端：torch, onnx, onnx-int8, remote（獨立嵌入服務，見 embedding_server.py）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# 預序列化模型目錄（由 embedding_artifact.py 生成），PyTorch 後端優先從此載入
+EMBEDDING_ARTIFACT_DIR = os.getenv("EMBEDDING_ARTIFACT_DIR")
+# ONNX 輸出與 PyTorch 輸出的最低餘弦相似度
+ONNX_MIN_COSINE = float(os.getenv("ONNX_MIN_COSINE", "0.99"))
+
+
+def _load_onnx_model(model_name: str, quantized: bool):
+    """
+    載入已導出的 ONNX 模型
+
+    啟動時不做導出（需要 PyTorch 模型和數分鐘的導出、量化）：模型由 `python scripts/onnx_embedding.py export`
+    或鏡像構建（--build-arg BAKE_ONNX_MODEL=true）預先生成
+
+    Raises:
+        FileNotFoundError: 未找到導出的模型
+    """
+    try:
+        from scripts.onnx_embedding import OnnxEmbeddingModel, default_onnx_dir, CONFIG_FILE, INT8_FILE
+    except ImportError:
+        from onnx_embedding import OnnxEmbeddingModel, default_onnx_dir, CONFIG_FILE, INT8_FILE
+
+    model_dir = default_onnx_dir(model_name)
+    if not (model_dir / CONFIG_FILE).exists() or (quantized and not (model_dir / INT8_FILE).exists()):
+        raise FileNotFoundError(
+            f"未找到導出的 ONNX 模型 {model_dir}，請先運行 python scripts/onnx_embedding.py export"
+            f"{' --quantize' if quantized else ''} --model {model_name}"
+        )
+
+    with open(model_dir / CONFIG_FILE, "r", encoding="utf-8") as f:
+        validation = json.load(f).get("validation", {}).get("int8" if quantized else "fp32")
+
+    # 未通過餘弦相似度驗證的模型不投入使用
+    if not validation or validation["min_cosine"] < ONNX_MIN_COSINE:
+        raise ValueError(f"ONNX 模型驗證未通過 (要求 min_cosine >= {ONNX_MIN_COSINE}): {validation}")
+
+    return OnnxEmbeddingModel(model_dir, quantized=quantized)
+
+
+def load_embedding_model(model_name: str, backend: str = None):
+    """
+    載入嵌入模型
+
+    Args:
+        model_name: 嵌入模型名稱
+        backend: 後端名稱，默認讀取 EMBEDDING_BACKEND
+
+    Returns:
+        提供 encode() 接口的模型對象
+    """
+    backend = (backend or EMBEDDING_BACKEND).lower()
+
+    if backend in ("onnx", "onnx-int8"):
+        try:
+            model = _load_onnx_model(model_name, quantized=backend == "onnx-int8")
+            logger.info(f"使用 ONNX Runtime 嵌入後端: {backend}")
+            return model
+        except Exception as e:
+            logger.error(f"ONNX 後端載入失敗，回退到 PyTorch: {e}")
+    elif backend == "remote":
+        try:
+            from scripts.embedding_server import RemoteEmbeddingModel
+        except ImportError:
+            from embedding_server import RemoteEmbeddingModel
+        try:
+            return RemoteEmbeddingModel(model_name=model_name)
+        except Exception as e:
+            logger.error(f"無法連接嵌入服務，回退到進程內 PyTorch 模型: {e}")
+    elif backend != "torch":
+        logger.warning(f"未知的嵌入後端 {backend}，使用 PyTorch")
+
+    try:
+        from scripts.embedding_artifact import is_model_artifact, load_model_artifact
+    except ImportError:
+        from embedding_artifact import is_model_artifact, load_model_artifact
+
+    if is_model_artifact(EMBEDDING_ARTIFACT_DIR):
+        try:
+            model = load_model_artifact(EMBEDDING_ARTIFACT_DIR, expected_model_name=model_name)
+            logger.info(f"從預序列化目錄載入嵌入模型: {EMBEDDING_ARTIFACT_DIR}")
+            return model
+        except Exception as e:
+            logger.error(f"預序列化模型載入失敗，改從 Hugging Face 載入: {e}")
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
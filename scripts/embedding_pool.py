@@ -0,0 +1,145 @@
+"""
+多進程嵌入池
+大批量重建索引時使用多個嵌入工作進程，每個進程持有獨立的模型副本並固定線程數
+"""
+
+import os
+import math
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 工作進程內的模型實例（每個進程一份）
+_worker_model = None
+
+
+def _init_worker(model_name: str, threads_per_worker: int, worker_counter) -> None:
+    """工作進程初始化：固定線程數和 CPU 親和性後載入模型"""
+    global _worker_model
+
+    # 必須在導入 torch 之前設置，否則 OpenMP/MKL 線程池已按全部核心創建
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "ONNX_NUM_THREADS"):
+        os.environ[var] = str(threads_per_worker)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+
+    # 每個進程綁定到互不重疊的核心區間
+    if hasattr(os, "sched_setaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+        start = worker_index * threads_per_worker
+        cores = available[start:start + threads_per_worker]
+        if cores:
+            os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+
+    try:
+        from scripts.embedding_backend import load_embedding_model
+    except ImportError:
+        from embedding_backend import load_embedding_model
+    _worker_model = load_embedding_model(model_name)
+
+
+def _encode_shard(texts: List[str], batch_size: int) -> np.ndarray:
+    """在工作進程中嵌入一個分片"""
+    embeddings = _worker_model.encode(
+        texts,
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    )
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+class EmbeddingPool:
+    """將文本分片到多個嵌入進程，並按原順序重組結果"""
+
+    def __init__(self,
+                 model_name: str,
+                 num_workers: int,
+                 threads_per_worker: Optional[int] = None,
+                 min_shard_size: int = int(os.getenv("EMBED_POOL_MIN_SHARD_SIZE", "32")),
+                 max_shard_size: int = int(os.getenv("EMBED_POOL_MAX_SHARD_SIZE", "2048"))):
+        """
+        初始化嵌入進程池
+
+        Args:
+            model_name: 嵌入模型名稱
+            num_workers: 工作進程數量
+            threads_per_worker: 每個進程的 PyTorch 線程數，默認平分可用核心
+            min_shard_size: 分片最少文本數，避免小批量時進程間通信開銷超過計算
+            max_shard_size: 分片最多文本數，大批量重建時仍可逐分片產出結果
+        """
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        self.num_workers = max(1, num_workers)
+        self.threads_per_worker = threads_per_worker or max(1, cpu_count // self.num_workers)
+        self.min_shard_size = max(1, min_shard_size)
+        self.max_shard_size = max(self.min_shard_size, max_shard_size)
+
+        # 使用 spawn，避免 fork 繼承父進程已初始化的 OpenMP 線程池
+        context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_name, self.threads_per_worker, context.Value("i", 0))
+        )
+        logger.info(
+            f"嵌入進程池已啟動: {self.num_workers} 個進程, "
+            f"每進程 {self.threads_per_worker} 線程, 分片大小 {self.min_shard_size}-{self.max_shard_size}"
+        )
+
+    def shard_size(self, count: int) -> int:
+        """按進程數平分文本，並限制在 [min_shard_size, max_shard_size] 內"""
+        return min(self.max_shard_size, max(self.min_shard_size, math.ceil(count / self.num_workers)))
+
+    def iter_encode(self, sentences: List[str], batch_size: int = 32) -> Iterator[np.ndarray]:
+        """按原順序逐分片返回嵌入向量，可邊計算邊寫入索引"""
+        shard_size = self.shard_size(len(sentences))
+        starts = iter(range(0, len(sentences), shard_size))
+        # 最多保持 num_workers * 2 個分片在途：進程不空閒，未取走的結果也不會在記憶體中堆積
+        pending = deque()
+        for start in starts:
+            pending.append(self._executor.submit(_encode_shard, sentences[start:start + shard_size], batch_size))
+            if len(pending) >= self.num_workers * 2:
+                break
+        try:
+            while pending:
+                embeddings = pending.popleft().result()
+                start = next(starts, None)
+                if start is not None:
+                    pending.append(self._executor.submit(_encode_shard, sentences[start:start + shard_size], batch_size))
+                yield embeddings
+        finally:
+            # 調用方提前停止迭代或出錯時，取消尚未開始的分片
+            for future in pending:
+                future.cancel()
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """與 SentenceTransformer.encode 兼容的接口"""
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size=batch_size)[0]
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(list(self.iter_encode(list(sentences), batch_size)))
+
+    def close(self) -> None:
+        """關閉所有工作進程"""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+獨立嵌入服務
+單個進程持有嵌入模型，通過本地 HTTP 或 Unix socket 為多個 API worker 提供批量嵌入
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import base64
+import socket
+import logging
+import argparse
+import threading
+import http.client
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://127.0.0.1:8090")
+
+
+class MicroBatcher:
+    """把併發到達的小請求合併成一次 encode 調用"""
+
+    def __init__(self, model, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        """
+        Args:
+            model: 提供 encode() 的嵌入模型
+            max_batch_size: 單次 encode 的最大文本數
+            max_wait_ms: 收到第一個請求後等待更多請求的最長時間
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "texts": 0}
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: List[str], normalize: bool = False) -> Future:
+        """提交文本，返回結果為 float32 矩陣的 Future"""
+        future = Future()
+        self._queue.put((list(texts), normalize, future))
+        return future
+
+    def _collect(self):
+        pending = [self._queue.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            # 是否歸一化不同的請求分開編碼
+            for normalize in (False, True):
+                group = [item for item in pending if item[1] == normalize]
+                if group:
+                    self._encode_group(group, normalize)
+
+    def _encode_group(self, group, normalize: bool):
+        texts = [text for item in group for text in item[0]]
+        try:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.max_batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+                normalize_embeddings=normalize
+            )
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        except Exception as e:
+            for _, _, future in group:
+                future.set_exception(e)
+            return
+
+        self.stats["requests"] += len(group)
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(texts)
+
+        offset = 0
+        for item_texts, _, future in group:
+            future.set_result(embeddings[offset:offset + len(item_texts)])
+            offset += len(item_texts)
+
+
+def create_app(model_name: str, max_batch_size: int, max_wait_ms: float):
+    """創建嵌入服務的 FastAPI 應用"""
+    import asyncio
+    from fastapi import FastAPI
+    from pydantic import BaseModel
+
+    try:
+        from scripts.embedding_backend import load_embedding_model
+    except ImportError:
+        from embedding_backend import load_embedding_model
+
+    load_start = time.perf_counter()
+    model = load_embedding_model(model_name)
+    load_seconds = time.perf_counter() - load_start
+    logger.info(f"嵌入服務模型載入耗時 {load_seconds:.2f}s")
+
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    app = FastAPI(title="嵌入服務", version="1.0.0")
+
+    class EmbedRequest(BaseModel):
+        texts: List[str]
+        normalize: bool = False
+
+    @app.post("/embed")
+    async def embed(request: EmbedRequest):
+        embeddings = await asyncio.wrap_future(batcher.submit(request.texts, request.normalize))
+        return {
+            "count": embeddings.shape[0],
+            "dimension": embeddings.shape[1] if embeddings.ndim == 2 else 0,
+            "embeddings": base64.b64encode(embeddings.tobytes()).decode("ascii")
+        }
+
+    @app.get("/info")
+    async def info():
+        return {
+            "model_name": model_name,
+            "dimension": model.get_sentence_embedding_dimension(),
+            "model_load_seconds": round(load_seconds, 3),
+            "max_batch_size": max_batch_size,
+            "max_wait_ms": max_wait_ms,
+            "stats": dict(batcher.stats)
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    return app
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """通過 Unix domain socket 連接的 HTTP 連接"""
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteEmbeddingModel:
+    """嵌入服務客戶端，接口與 SentenceTransformer.encode 兼容"""
+
+    def __init__(self, service_url: str = EMBEDDING_SERVICE_URL, model_name: Optional[str] = None,
+                 timeout: float = float(os.getenv("EMBEDDING_SERVICE_TIMEOUT", "60")),
+                 max_texts_per_request: int = 256):
+        """
+        Args:
+            service_url: http://host:port 或 unix:///path/to/socket
+            model_name: 期望的模型名稱，與服務端不一致時記錄警告
+            timeout: 單次請求超時秒數
+            max_texts_per_request: 單次請求最多發送的文本數
+        """
+        self.service_url = service_url
+        self.timeout = timeout
+        self.max_texts_per_request = max_texts_per_request
+        self._local = threading.local()
+
+        info = self._request("GET", "/info")
+        self.dimension = info["dimension"]
+        if model_name and info["model_name"] != model_name:
+            logger.warning(f"嵌入服務使用的模型 {info['model_name']} 與配置的 {model_name} 不一致")
+        logger.info(f"已連接嵌入服務: {service_url} ({info['model_name']}, {self.dimension} 維)")
+
+    def _connection(self) -> http.client.HTTPConnection:
+        # 每個線程復用一個持久連接；預先 fork 後按進程重新連接，不與主進程共用 socket
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            parsed = urlparse(self.service_url)
+            if parsed.scheme == "unix":
+                conn = _UnixHTTPConnection(parsed.path, self.timeout)
+            else:
+                conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _request(self, method: str, path: str, payload: Optional[dict] = None) -> dict:
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"嵌入服務返回 {response.status}: {data[:200]!r}")
+                return json.loads(data)
+            except (ConnectionError, http.client.HTTPException, socket.timeout):
+                # 連接被服務端關閉時重連一次
+                conn.close()
+                self._local.conn = None
+                if attempt == 1:
+                    raise
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """通過嵌入服務生成句向量"""
+        if isinstance(sentences, str):
+            return self.encode([sentences], normalize_embeddings=normalize_embeddings)[0]
+
+        sentences = list(sentences)
+        parts = []
+        for start in range(0, len(sentences), self.max_texts_per_request):
+            result = self._request("POST", "/embed", {
+                "texts": sentences[start:start + self.max_texts_per_request],
+                "normalize": normalize_embeddings
+            })
+            vectors = np.frombuffer(base64.b64decode(result["embeddings"]), dtype=np.float32)
+            parts.append(vectors.reshape(result["count"], self.dimension))
+
+        if not parts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="啟動本地嵌入服務")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-zh"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--uds", help="監聽 Unix socket 路徑（設置後忽略 host/port）")
+    parser.add_argument("--max-batch-size", type=int, default=int(os.getenv("EMBEDDING_SERVICE_MAX_BATCH", "64")))
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.getenv("EMBEDDING_SERVICE_MAX_WAIT_MS", "5")))
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    import uvicorn
+
+    app = create_app(args.model, args.max_batch_size, args.max_wait_ms)
+    if args.uds:
+        uvicorn.run(app, uds=args.uds, log_level="info", access_log=False)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="info", access_log=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
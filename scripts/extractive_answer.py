@@ -0,0 +1,129 @@
+"""
+本地抽取式問答
+把檢索到的文檔切成句子，一次矩陣乘法算出每句與查詢的相似度，返回最相關的原文片段並標註來源；
+不調用 LLM，可作為 mode=extractive 使用，也可在 LLM 不可用時自動兜底
+"""
+
+import os
+import re
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List
+
+import numpy as np
+
+try:
+    from scripts.context_builder import split_sentences, join_sentences, score_sentences
+except ImportError:
+    from context_builder import split_sentences, join_sentences, score_sentences
+
+# 返回的片段數、片段最多包含的句子數
+EXTRACTIVE_MAX_SPANS = int(os.getenv("EXTRACTIVE_MAX_SPANS", "3"))
+EXTRACTIVE_MAX_SPAN_SENTENCES = int(os.getenv("EXTRACTIVE_MAX_SPAN_SENTENCES", "3"))
+# 句子被選入答案的最低餘弦相似度，低於此值時只返回最相關的一句並標記為低置信度
+EXTRACTIVE_MIN_SIMILARITY = float(os.getenv("EXTRACTIVE_MIN_SIMILARITY", "0.3"))
+# 參與抽取的檢索結果數
+EXTRACTIVE_MAX_CHUNKS = int(os.getenv("EXTRACTIVE_MAX_CHUNKS", "5"))
+
+# 保存文檔時加在文件名前的 uuid 前綴
+_STORED_PREFIX = re.compile(r"^[0-9a-f]{32}_")
+
+
+@dataclass
+class Span:
+    text: str
+    score: float
+    source: int  # 來源在檢索結果中的排名（從 1 開始）
+    filename: str
+
+
+class ExtractiveAnswerer:
+    """從檢索結果中抽取與查詢最相關的句子作為答案"""
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray],
+                 max_spans: int = EXTRACTIVE_MAX_SPANS,
+                 max_span_sentences: int = EXTRACTIVE_MAX_SPAN_SENTENCES,
+                 min_similarity: float = EXTRACTIVE_MIN_SIMILARITY,
+                 max_chunks: int = EXTRACTIVE_MAX_CHUNKS):
+        """
+        Args:
+            encode: 批量嵌入函數，返回 float32 矩陣（與檢索使用同一模型）
+            max_spans: 返回的片段數
+            max_span_sentences: 相鄰的相關句子合併成片段時的最大句數
+            min_similarity: 句子入選的最低餘弦相似度
+            max_chunks: 參與抽取的檢索結果數
+        """
+        self.encode = encode
+        self.max_spans = max_spans
+        self.max_span_sentences = max_span_sentences
+        self.min_similarity = min_similarity
+        self.max_chunks = max_chunks
+
+    def _span_around(self, scores: np.ndarray, center: int) -> range:
+        """以最相關的句子為中心，向兩側擴展相鄰的相關句子"""
+        start = end = center
+        while end - start + 1 < self.max_span_sentences:
+            left = scores[start - 1] if start > 0 else -np.inf
+            right = scores[end + 1] if end + 1 < len(scores) else -np.inf
+            if max(left, right) < self.min_similarity:
+                break
+            if left >= right:
+                start -= 1
+            else:
+                end += 1
+        return range(start, end + 1)
+
+    def answer(self, query: str, texts: List[str], sources: List[Dict]) -> Dict:
+        """
+        Args:
+            query: 用戶問題
+            texts: 按檢索排名排列的文檔全文
+            sources: 對應的檢索結果（用於引用的文件名）
+
+        Returns:
+            answer（帶引用標記的答案文本）、spans、confidence、elapsed_ms
+        """
+        start_time = time.perf_counter()
+        chunks = [split_sentences(text) for text in texts[:self.max_chunks]]
+        if not any(chunks):
+            return {"answer": "在您的文檔中沒有找到可以引用的內容。", "spans": [],
+                    "confidence": 0.0, "low_confidence": True,
+                    "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 1)}
+
+        chunk_scores = score_sentences(self.encode, query, chunks)
+        flat = np.concatenate(chunk_scores)
+        chunk_ids = np.repeat(np.arange(len(chunks)), [len(chunk) for chunk in chunks])
+        offsets = np.concatenate([[0], np.cumsum([len(chunk) for chunk in chunks])[:-1]])
+
+        spans: List[Span] = []
+        covered = np.zeros(len(flat), dtype=bool)
+        for position in np.argsort(-flat):
+            if len(spans) >= self.max_spans:
+                break
+            if covered[position] or (spans and flat[position] < self.min_similarity):
+                continue
+            chunk_id = int(chunk_ids[position])
+            sentence_range = self._span_around(chunk_scores[chunk_id], int(position - offsets[chunk_id]))
+            covered[[offsets[chunk_id] + i for i in sentence_range]] = True
+            source = sources[chunk_id] if chunk_id < len(sources) else {}
+            spans.append(Span(
+                text=join_sentences([chunks[chunk_id][i] for i in sentence_range]),
+                score=round(float(flat[position]), 4),
+                source=source.get("rank", chunk_id + 1),
+                filename=_STORED_PREFIX.sub("", source.get("metadata", {}).get("filename", ""))
+            ))
+
+        confidence = float(flat.max())
+        cited = {}
+        for span in spans:
+            cited.setdefault(span.source, span.filename)
+        answer = "\n".join(f"{span.text} [{span.source}]" for span in spans)
+        answer += "\n\n來源：" + "；".join(f"[{rank}] {filename}" for rank, filename in cited.items())
+
+        return {
+            "answer": answer,
+            "spans": [asdict(span) for span in spans],
+            "confidence": round(confidence, 4),
+            "low_confidence": confidence < self.min_similarity,
+            "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 1)
+        }
@@ -0,0 +1,54 @@
+"""
+跨進程文件鎖
+prefork 多 worker 部署時，同一用戶的建索引、共享索引池的讀-改-寫需要在進程間互斥：
+進程內的線程先按路徑共用一把 threading.Lock 排隊，再用 fcntl.flock（Windows 上用 msvcrt.locking）在進程間互斥
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_registry_lock = threading.Lock()
+
+
+def _thread_lock(path: Path) -> threading.Lock:
+    with _registry_lock:
+        return _thread_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+@contextmanager
+def file_lock(path: Path):
+    """持有 path 上的排他鎖直到退出；鎖文件不存在時創建，退出後保留（刪除會讓等待者鎖住已脫離的 inode）"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _thread_lock(path):
+        with open(path, "a+b") as handle:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            else:
+                handle.seek(0)
+                while True:
+                    # LK_LOCK 重試約 10 秒後拋出 OSError，建索引可能更久，繼續等待
+                    try:
+                        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+                else:
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
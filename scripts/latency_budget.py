@@ -0,0 +1,176 @@
+"""
+查詢延遲預算
+每個查詢帶一個截止時間，依次傳遞給嵌入、搜索和生成階段；預算不足時降級返回
+檢索結果和部分答案，或把仍在生成的答案轉為延遲獲取
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 默認查詢預算（毫秒），客戶端可通過請求體 budget_ms 或 X-Latency-Budget-Ms 頭覆蓋
+QUERY_LATENCY_BUDGET_MS = float(os.getenv("QUERY_LATENCY_BUDGET_MS", "20000"))
+# 客戶端可請求的預算上下限
+MIN_BUDGET_MS = float(os.getenv("QUERY_MIN_BUDGET_MS", "500"))
+MAX_BUDGET_MS = float(os.getenv("QUERY_MAX_BUDGET_MS", "60000"))
+# LLM 請求的默認超時（秒），不允許延遲答案的查詢取此值與剩餘預算的較小值
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+# 剩餘預算低於此值時不再等待 LLM，直接轉為延遲答案
+LLM_MIN_BUDGET_MS = float(os.getenv("LLM_MIN_BUDGET_MS", "1000"))
+# 延遲答案保留時間（秒）
+DEFERRED_ANSWER_TTL = float(os.getenv("DEFERRED_ANSWER_TTL", "600"))
+
+
+class BudgetExceeded(Exception):
+    """某階段開始前或等待中預算已用完"""
+
+    def __init__(self, stage: str, deadline: "Deadline"):
+        self.stage = stage
+        self.deadline = deadline
+        super().__init__(f"延遲預算 {deadline.budget_ms:.0f}ms 在 {stage} 階段耗盡")
+
+
+class Deadline:
+    """單個請求的延遲預算"""
+
+    def __init__(self, budget_ms: Optional[float] = None):
+        budget_ms = QUERY_LATENCY_BUDGET_MS if budget_ms is None else budget_ms
+        self.budget_ms = min(max(float(budget_ms), MIN_BUDGET_MS), MAX_BUDGET_MS)
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + self.budget_ms / 1000.0
+        self.stages: Dict[str, float] = {}
+        self._stage_started = self.started_at
+
+    def remaining(self) -> float:
+        """剩餘秒數（不小於 0）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self) -> float:
+        return self.remaining() * 1000
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started_at) * 1000
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str):
+        """階段開始前調用，預算已耗盡時拋出 BudgetExceeded"""
+        if self.expired():
+            raise BudgetExceeded(stage, self)
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """下游調用（HTTP 請求、Future.result）的超時秒數"""
+        remaining = self.remaining()
+        return remaining if cap is None else min(remaining, cap)
+
+    def mark(self, stage: str):
+        """記錄從上一個標記到現在的階段耗時（毫秒）"""
+        now = time.monotonic()
+        self.stages[stage] = round((now - self._stage_started) * 1000, 1)
+        self._stage_started = now
+
+    def summary(self) -> Dict:
+        return {
+            "budget_ms": self.budget_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 1),
+            "remaining_ms": round(self.remaining_ms(), 1),
+            "stages": dict(self.stages)
+        }
+
+
+class BudgetEvents:
+    """預算耗盡事件記錄"""
+
+    def __init__(self, max_events: int = 200):
+        self._events = deque(maxlen=max_events)
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.total_queries = 0
+
+    def query_started(self):
+        with self._lock:
+            self.total_queries += 1
+
+    def record(self, stage: str, deadline: Deadline, user_id: Optional[int] = None, outcome: str = "degraded"):
+        event = {
+            "timestamp": time.time(),
+            "stage": stage,
+            "outcome": outcome,
+            "user_id": user_id,
+            "budget_ms": deadline.budget_ms,
+            "elapsed_ms": round(deadline.elapsed_ms(), 1),
+            "stages": dict(deadline.stages)
+        }
+        with self._lock:
+            self._events.append(event)
+            key = f"{stage}:{outcome}"
+            self._counts[key] = self._counts.get(key, 0) + 1
+        logger.warning(f"查詢延遲預算耗盡: 用戶 {user_id}, 階段 {stage}, 處理方式 {outcome}, "
+                       f"已用 {event['elapsed_ms']}ms / {deadline.budget_ms:.0f}ms")
+
+    def stats(self, recent: int = 20) -> Dict:
+        with self._lock:
+            exhausted = sum(self._counts.values())
+            return {
+                "total_queries": self.total_queries,
+                "budget_exhausted": exhausted,
+                "exhausted_ratio": round(exhausted / self.total_queries, 4) if self.total_queries else 0.0,
+                "by_stage": dict(self._counts),
+                "recent": list(self._events)[-recent:]
+            }
+
+
+class DeferredAnswers:
+    """
+    超出預算後仍在生成的答案，客戶端通過 answer_id 輪詢獲取
+
+    存儲在進程內；多 worker 部署時輪詢請求需路由到同一 worker（或由客戶端重試）
+    """
+
+    def __init__(self, ttl: float = DEFERRED_ANSWER_TTL):
+        self.ttl = ttl
+        self._answers: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def defer(self, future: Future, user_id: int, query: str) -> str:
+        answer_id = uuid.uuid4().hex
+        with self._lock:
+            self._purge()
+            self._answers[answer_id] = {
+                "future": future,
+                "user_id": user_id,
+                "query": query,
+                "created_at": time.time()
+            }
+        return answer_id
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._answers.items() if entry["created_at"] < cutoff]
+        for key in expired:
+            del self._answers[key]
+
+    def get(self, answer_id: str, user_id: int) -> Optional[Dict]:
+        """返回答案狀態；不存在、已過期或不屬於該用戶時返回 None"""
+        with self._lock:
+            self._purge()
+            entry = self._answers.get(answer_id)
+        if entry is None or entry["user_id"] != user_id:
+            return None
+
+        future = entry["future"]
+        result = {"answer_id": answer_id, "query": entry["query"], "status": "pending", "answer": None}
+        if future.done():
+            if future.exception() is not None:
+                result.update(status="failed", error=str(future.exception()))
+            else:
+                result.update(status="ready", answer=future.result())
+        return result
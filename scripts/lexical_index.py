@@ -0,0 +1,142 @@
+"""
+全文（詞彙）索引
+每個用戶一個 SQLite FTS5 數據庫，與 FAISS 索引在建索引時一同生成；rowid 與向量索引位置一致。
+CJK 文本切成相鄰字符二元組，英文和數字按詞保留（型號、錯誤碼中的連字符另存連寫形式），
+用 BM25 排名；混合檢索時與向量結果按倒數排名融合（RRF）
+"""
+
+import os
+import re
+import sqlite3
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 檢索方式：vector（默認）、lexical（只用全文索引，不做查詢嵌入）、hybrid（兩者融合）
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower()
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+# RRF 融合常數，以及混合檢索時每路召回數相對 top_k 的倍數
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_CANDIDATE_MULTIPLIER = int(os.getenv("HYBRID_CANDIDATE_MULTIPLIER", "3"))
+
+LEXICAL_INDEX_FILE = "lexical.db"
+
+_CJK_RUN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+")
+_WORD = re.compile(r"[0-9A-Za-z]+(?:[-_./][0-9A-Za-z]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    """CJK 連續字符切成二元組（單字保留），英文數字按詞小寫，帶分隔符的詞同時保留連寫形式和各部分"""
+    tokens = []
+    position = 0
+    while position < len(text):
+        cjk = _CJK_RUN.match(text, position)
+        if cjk:
+            run = cjk.group()
+            tokens.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+            position = cjk.end()
+            continue
+        word = _WORD.match(text, position)
+        if word:
+            parts = re.split(r"[-_./]", word.group().lower())
+            if len(parts) > 1:
+                tokens.append("".join(parts))
+            tokens.extend(parts)
+            position = word.end()
+            continue
+        position += 1
+    return tokens
+
+
+def build_lexical_index(path: Path, documents: List[str]):
+    """建立全文索引；先寫臨時文件再替換，查詢中的讀取不會看到半成品"""
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(str(tmp_path))
+    try:
+        conn.execute("CREATE VIRTUAL TABLE chunks USING fts5(tokens, tokenize='unicode61')")
+        conn.executemany(
+            "INSERT INTO chunks(rowid, tokens) VALUES (?, ?)",
+            ((position, " ".join(tokenize(text))) for position, text in enumerate(documents))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+def replace_owner_rows(path: Path, owner: int, row_ids: List[int], documents: List[str]):
+    """
+    共享全文索引（多個用戶一個數據庫）中替換某個用戶的全部行；documents 為空時只刪除
+
+    在同一事務中刪除並插入，並發的讀取看到的是替換前或替換後的完整結果
+    """
+    conn = sqlite3.connect(str(path))
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(tokens, owner UNINDEXED, tokenize='unicode61')")
+        conn.execute("DELETE FROM chunks WHERE owner = ?", (owner,))
+        conn.executemany(
+            "INSERT INTO chunks(rowid, tokens, owner) VALUES (?, ?, ?)",
+            ((row_id, " ".join(tokenize(text)), owner) for row_id, text in zip(row_ids, documents))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def search_lexical(path: Path, queries: List[str], top_k: int, owner: Optional[int] = None,
+                   allowed: Optional[List[int]] = None) -> List[List[Tuple[int, float]]]:
+    """
+    在同一連接中依次檢索多個查詢；owner 不為 None 時只檢索共享全文索引中該用戶的行，
+    allowed 不為 None 時只檢索這些 rowid（過濾條件）
+
+    Returns:
+        每個查詢的 [(文檔位置, BM25 分數)]，分數越大越相關；索引不存在時拋出 FileNotFoundError
+    """
+    if not path.exists():
+        raise FileNotFoundError(path)
+
+    sql = "SELECT rowid, bm25(chunks) FROM chunks WHERE chunks MATCH ?"
+    if owner is not None:
+        sql += " AND owner = ?"
+    if allowed is not None:
+        sql += " AND rowid IN (SELECT id FROM allowed)"
+    sql += " ORDER BY bm25(chunks) LIMIT ?"
+
+    results = []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        if allowed is not None:
+            # 臨時表在連接自己的臨時庫中，只讀打開主庫不影響
+            conn.execute("CREATE TEMP TABLE allowed(id INTEGER PRIMARY KEY)")
+            conn.executemany("INSERT INTO allowed VALUES (?)", ((int(row_id),) for row_id in allowed))
+        for query in queries:
+            tokens = list(dict.fromkeys(tokenize(query)))
+            if not tokens:
+                results.append([])
+                continue
+            match = " OR ".join(f'"{token}"' for token in tokens)
+            params = (match, top_k) if owner is None else (match, owner, top_k)
+            rows = conn.execute(sql, params).fetchall()
+            # SQLite 的 bm25() 越小越相關，取反後與向量分數方向一致
+            results.append([(int(rowid), -float(score)) for rowid, score in rows])
+    finally:
+        conn.close()
+    return results
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, List[int]], top_k: int, k: int = HYBRID_RRF_K) -> List[Tuple[int, float]]:
+    """
+    按倒數排名融合多路結果：score = Σ 1 / (k + rank)
+
+    Args:
+        rankings: 每路檢索按相關性排列的文檔位置
+    """
+    scores: Dict[int, float] = {}
+    for ranked in rankings.values():
+        for rank, position in enumerate(ranked, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda item: -item[1])
+    return fused[:top_k]
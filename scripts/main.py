@@ -92,11 +92,7 @@ try:
     print("=" * 60)
     print("🎯 啟動 FastAPI 服務器...")
     
-    # 啟動服務器
-    uvicorn.run(
-        app,
-        host=host,
-        port=port,
+    server_options = dict(
         timeout_keep_alive=300,
         timeout_graceful_shutdown=300,
         limit_max_requests=1000,
@@ -105,6 +101,19 @@ try:
         log_level="info"
     )
     
+    # WEB_CONCURRENCY > 1 時使用預先 fork 模式：主進程載入模型後 fork worker 共享權重
+    workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+    if workers > 1 and hasattr(os, 'fork'):
+        from auth_api_server import initialize_kb_system, reset_after_fork
+        from prefork import serve_prefork
+        
+        print(f"✓ 預先 fork 模式: {workers} 個 worker")
+        serve_prefork(app, host, port, workers, preload=initialize_kb_system,
+                      after_fork=reset_after_fork, **server_options)
+    else:
+        # 啟動服務器
+        uvicorn.run(app, host=host, port=port, **server_options)
+    
 except ImportError as e:
     print(f"❌ 導入失敗: {e}")
     print("\n可能的原因:")
@@ -0,0 +1,276 @@
+"""
+按延遲路由 LLM 請求
+記錄每個模型最近的延遲和錯誤率，把請求發給最快的健康模型；
+主請求超過該模型 p95 延遲仍未返回時，向第二個模型發出對沖請求，先返回者勝出
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    from scripts.provider_health import get_provider_health
+except ImportError:
+    from provider_health import get_provider_health
+
+logger = logging.getLogger(__name__)
+
+# 路由模式：default（只用默認模型）或 latency（按延遲路由並對沖）
+LLM_ROUTING_MODE = os.getenv("LLM_ROUTING_MODE", "default").lower()
+# latency 模式下是否發出對沖請求
+LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+# 每個模型保留的最近調用數
+ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+# 樣本不足時使用的對沖延遲，以及對沖延遲的下限（毫秒）
+HEDGE_DEFAULT_DELAY_MS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_MS", "3000"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "500"))
+# 錯誤率超過此值的模型視為不健康
+ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))
+# 計算延遲分位數所需的最少樣本數
+MIN_SAMPLES = 5
+
+
+def model_key(model_config: Dict) -> str:
+    return f"{model_config['provider']}:{model_config['model_id']}"
+
+
+# 調用結果：成功、失敗（含超過總超時）、對沖落敗後被取消（延遲只知道下限）
+OK, ERROR, CENSORED = "ok", "error", "censored"
+
+
+class ModelStats:
+    """
+    單個模型最近 N 次調用的延遲和結果
+
+    對沖線程寫入、請求線程和 /system/resources 讀取，所有讀寫都在鎖內進行，讀取時先複製調用記錄
+    """
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self._calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.wins = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self._calls.append((latency, OK if ok else ERROR))
+
+    def record_censored(self, lower_bound: float):
+        """落敗後被取消的請求：實際延遲至少為 lower_bound，不計入成功次數和錯誤率"""
+        with self._lock:
+            self._calls.append((lower_bound, CENSORED))
+
+    def record_hedged(self):
+        with self._lock:
+            self.hedged += 1
+
+    def record_win(self, hedge: bool):
+        with self._lock:
+            self.wins += 1
+            if hedge:
+                self.hedge_wins += 1
+
+    def _snapshot(self) -> list:
+        with self._lock:
+            return list(self._calls)
+
+    def latencies(self, outcome: str = OK) -> np.ndarray:
+        return np.array([latency for latency, result in self._snapshot() if result == outcome], dtype=np.float64)
+
+    def percentile(self, q: float, min_samples: int = MIN_SAMPLES) -> Optional[float]:
+        """
+        成功調用的延遲分位數；被取消請求的延遲下限只會提高分位數
+        （例如對沖發出後幾毫秒就被取消的備用模型不會因此顯得更快）
+        """
+        latencies = self.latencies()
+        censored = self.latencies(CENSORED)
+        if len(latencies) + len(censored) < max(1, min_samples):
+            return None
+        with_censored = float(np.percentile(np.concatenate([latencies, censored]), q))
+        if not len(latencies):
+            return with_censored
+        return max(float(np.percentile(latencies, q)), with_censored)
+
+    def error_rate(self) -> float:
+        completed = [result for _, result in self._snapshot() if result != CENSORED]
+        if not completed:
+            return 0.0
+        return sum(1 for result in completed if result == ERROR) / len(completed)
+
+    def stats(self) -> Dict:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        calls = self._snapshot()
+        with self._lock:
+            wins, hedged, hedge_wins = self.wins, self.hedged, self.hedge_wins
+        return {
+            "calls": len(calls),
+            "censored": sum(1 for _, result in calls if result == CENSORED),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "wins": wins,
+            "hedged": hedged,
+            "hedge_wins": hedge_wins
+        }
+
+
+class ModelRouter:
+    """選擇最快的健康模型，並在主請求過慢時發出對沖請求"""
+
+    def __init__(self, hedging: bool = LLM_HEDGING, max_workers: int = int(os.getenv("LLM_MAX_CONCURRENCY", "8")) * 2):
+        self.hedging = hedging
+        self._models: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-hedge")
+
+    def _stats(self, key: str) -> ModelStats:
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = ModelStats()
+            return self._models[key]
+
+    def rank(self, candidates: List[Dict]) -> List[Dict]:
+        """
+        健康模型在前，按延遲中位數升序；還沒有樣本的模型排在已知模型之前以便收集數據，
+        同等條件下保持原順序（默認模型在前）
+        """
+        health = get_provider_health()
+
+        def sort_key(item):
+            position, config = item
+            stats = self._stats(model_key(config))
+            healthy = (health.is_available(config['provider'], config.get('api_key'))
+                       and stats.error_rate() <= ROUTER_MAX_ERROR_RATE)
+            p50 = stats.percentile(50, min_samples=1)
+            return (not healthy, p50 is not None, p50 or 0.0, position)
+
+        return [config for _, config in sorted(enumerate(candidates), key=sort_key)]
+
+    def hedge_delay(self, config: Dict) -> float:
+        """對沖延遲（秒）：主模型的 p95，樣本不足時使用默認值"""
+        p95 = self._stats(model_key(config)).percentile(95)
+        delay_ms = p95 * 1000 if p95 is not None else HEDGE_DEFAULT_DELAY_MS
+        return max(delay_ms, HEDGE_MIN_DELAY_MS) / 1000.0
+
+    def _timed_call(self, call: Callable[[Dict, threading.Event], str], config: Dict,
+                    cancel_event: threading.Event) -> str:
+        start_time = time.perf_counter()
+        stats = self._stats(model_key(config))
+        try:
+            result = call(config, cancel_event)
+        except Exception:
+            # 落敗後被取消的請求不算錯誤（取消時已按下限記錄延遲）
+            if not cancel_event.is_set():
+                stats.record(time.perf_counter() - start_time, ok=False)
+            raise
+        if not cancel_event.is_set():
+            stats.record(time.perf_counter() - start_time, ok=True)
+        return result
+
+    def execute(self, candidates: List[Dict], call: Callable[[Dict, threading.Event], str],
+                timeout: float) -> str:
+        """
+        按路由結果調用模型
+
+        Args:
+            candidates: 用戶可用的模型配置（默認模型在前）
+            call: call(model_config, cancel_event) 返回答案，失敗時拋出異常
+            timeout: 總超時秒數
+
+        Returns:
+            最先成功的答案；全部失敗時拋出最後一個異常
+        """
+        ranked = self.rank(candidates)
+        deadline = time.monotonic() + timeout
+        backups = list(ranked[1:])
+        running = {}
+        hedged = False
+        last_error = None
+
+        def launch(config: Dict, hedge: bool) -> float:
+            cancel_event = threading.Event()
+            future = self._executor.submit(self._timed_call, call, config, cancel_event)
+            running[future] = (config, cancel_event, hedge, time.perf_counter())
+            if hedge:
+                self._stats(model_key(config)).record_hedged()
+            return time.monotonic() + self.hedge_delay(config)
+
+        def cancel_running(timed_out: bool):
+            for config, cancel_event, _, started in running.values():
+                cancel_event.set()
+                stats = self._stats(model_key(config))
+                if timed_out:
+                    # 超過總超時仍未返回，記為失敗，否則一直掛起的模型錯誤率為 0、繼續被選為主模型
+                    stats.record(time.perf_counter() - started, ok=False)
+                else:
+                    # 落敗一方的實際延遲至少為已等待的時間，按下限記錄，否則慢模型永遠沒有樣本
+                    stats.record_censored(time.perf_counter() - started)
+
+        primary = ranked[0]
+        hedge_at = launch(primary, hedge=False)
+
+        while running:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            can_hedge = self.hedging and backups and not hedged
+            next_event = min(deadline, hedge_at) if can_hedge else deadline
+            done, _ = wait(list(running), timeout=max(0.0, next_event - now), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                config, _, hedge, _ = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"模型 {model_key(config)} 調用失敗: {e}")
+                    # 沒有其他請求在途時立即改用下一個模型
+                    if backups and not running:
+                        primary = backups.pop(0)
+                        hedge_at = launch(primary, hedge=False)
+                    continue
+
+                self._stats(model_key(config)).record_win(hedge)
+                cancel_running(timed_out=False)
+                return result
+
+            if not done and can_hedge and time.monotonic() >= hedge_at:
+                backup = backups.pop(0)
+                logger.info(f"模型 {model_key(primary)} 超過 {self.hedge_delay(primary):.2f}s 未返回，"
+                            f"向 {model_key(backup)} 發出對沖請求")
+                launch(backup, hedge=True)
+                hedged = True
+
+        cancel_running(timed_out=True)
+        if last_error is not None:
+            raise last_error
+        raise TimeoutError(f"LLM 調用超過 {timeout:.1f}s 未返回")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            models = dict(self._models)
+        return {
+            "mode": LLM_ROUTING_MODE,
+            "hedging": self.hedging,
+            "models": {key: stats.stats() for key, stats in models.items()}
+        }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """進程內共享的模型路由器"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
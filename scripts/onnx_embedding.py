@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime 嵌入後端
+將 SentenceTransformer 模型導出為 ONNX（可選 int8 動態量化），提供與 encode 兼容的推理接口
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "backend_config.json"
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+# 驗證和基準測試使用的樣本文本
+SAMPLE_TEXTS = [
+    "企業知識庫系統支持用戶上傳私人文檔並進行智能問答。",
+    "向量檢索使用 FAISS 在嵌入空間中查找最相似的文檔片段。",
+    "請問公司的年假政策是如何規定的？",
+    "Retrieval-augmented generation combines search with large language models.",
+    "機器學習模型的推理性能取決於硬件、批次大小和數值精度。",
+    "錯誤代碼 E-1024 表示上傳的文件格式不受支持。",
+    "人力資源管理正在從傳統流程轉向數據驅動的智能決策。",
+    "短句",
+]
+
+
+def default_onnx_dir(model_name: str) -> Path:
+    """模型默認的 ONNX 導出目錄"""
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+    return Path(os.getenv("ONNX_MODEL_DIR", Path("models") / "onnx" / safe_name))
+
+
+def _cosine_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """逐行計算餘弦相似度"""
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return np.einsum("ij,ij->i", a, b)
+
+
+class OnnxEmbeddingModel:
+    """基於 ONNX Runtime 的句向量模型，接口與 SentenceTransformer.encode 兼容"""
+
+    def __init__(self, model_dir, quantized: bool = False, num_threads: Optional[int] = None):
+        """
+        載入已導出的 ONNX 模型
+
+        Args:
+            model_dir: export_onnx_model 的輸出目錄
+            quantized: 是否使用 int8 量化模型
+            num_threads: ONNX Runtime intra-op 線程數，默認讀取 ONNX_NUM_THREADS，未設置時由 ORT 決定
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_dir = Path(model_dir)
+        with open(self.model_dir / CONFIG_FILE, "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+
+        model_file = self.model_dir / (INT8_FILE if quantized else FP32_FILE)
+        if not model_file.exists():
+            raise FileNotFoundError(f"ONNX 模型不存在: {model_file}")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        num_threads = num_threads or int(os.getenv("ONNX_NUM_THREADS", "0"))
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(self.model_dir))
+
+        self.quantized = quantized
+        self.pooling = self.config.get("pooling", "cls")
+        self.normalize = self.config.get("normalize", False)
+        self.max_seq_length = self.config.get("max_seq_length", 512)
+        self.dimension = self.config["dimension"]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np"
+        )
+        feeds = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+        hidden = self.session.run(None, feeds)[0]
+
+        if self.pooling == "mean":
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return hidden[:, 0]
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """生成句向量"""
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size=batch_size, normalize_embeddings=normalize_embeddings)[0]
+
+        sentences = list(sentences)
+        embeddings = np.empty((len(sentences), self.dimension), dtype=np.float32)
+        # 與 SentenceTransformer 相同：按長度排序以減少 padding
+        order = np.argsort([-len(s) for s in sentences], kind="stable")
+        for start in range(0, len(sentences), batch_size):
+            positions = order[start:start + batch_size]
+            embeddings[positions] = self._encode_batch([sentences[i] for i in positions])
+
+        if self.normalize or normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+def export_onnx_model(model_name: str, output_dir=None, quantize: bool = False, opset: int = 14) -> Path:
+    """
+    將 SentenceTransformer 模型導出為 ONNX，並與 PyTorch 輸出做餘弦相似度驗證
+
+    Returns:
+        輸出目錄路徑
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    output_dir = Path(output_dir) if output_dir else default_onnx_dir(model_name)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"導出 ONNX 模型: {model_name} -> {output_dir}")
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0]
+    auto_model = transformer.auto_model.eval()
+    tokenizer = transformer.tokenizer
+
+    pooling = "cls"
+    normalize = False
+    for module in st_model:
+        if hasattr(module, "get_pooling_mode_str"):
+            pooling = module.get_pooling_mode_str()
+        if type(module).__name__ == "Normalize":
+            normalize = True
+
+    class _EncoderWrapper(torch.nn.Module):
+        """只輸出 last_hidden_state，池化在 numpy 中完成"""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            return self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids
+            ).last_hidden_state
+
+    dummy = tokenizer(SAMPLE_TEXTS[:2], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    fp32_path = output_dir / FP32_FILE
+    with torch.no_grad():
+        torch.onnx.export(
+            _EncoderWrapper(auto_model),
+            tuple(dummy[name] for name in input_names),
+            str(fp32_path),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset
+        )
+    tokenizer.save_pretrained(str(output_dir))
+
+    config = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "normalize": normalize,
+        "max_seq_length": st_model.max_seq_length,
+        "dimension": st_model.get_sentence_embedding_dimension(),
+        "validation": {}
+    }
+    with open(output_dir / CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        logger.info("執行 int8 動態量化...")
+        quantize_dynamic(str(fp32_path), str(output_dir / INT8_FILE), weight_type=QuantType.QInt8)
+
+    # 導出後立即驗證並記錄結果，載入時據此判斷是否可用
+    reference = st_model.encode(SAMPLE_TEXTS, convert_to_numpy=True, show_progress_bar=False)
+    variants = [("fp32", False)] + ([("int8", True)] if quantize else [])
+    for variant, quantized in variants:
+        onnx_model = OnnxEmbeddingModel(output_dir, quantized=quantized)
+        config["validation"][variant] = validate_embeddings(reference, onnx_model.encode(SAMPLE_TEXTS))
+        logger.info(f"ONNX {variant} 驗證: {config['validation'][variant]}")
+
+    with open(output_dir / CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return output_dir
+
+
+def validate_embeddings(reference: np.ndarray, candidate: np.ndarray) -> Dict[str, float]:
+    """比較兩組向量的逐行餘弦相似度"""
+    similarity = _cosine_rows(np.asarray(reference, dtype=np.float32), np.asarray(candidate, dtype=np.float32))
+    return {
+        "min_cosine": float(similarity.min()),
+        "mean_cosine": float(similarity.mean())
+    }
+
+
+def benchmark_backends(model_name: str, model_dir=None, texts: Optional[List[str]] = None,
+                       batch_size: int = 32, rounds: int = 5) -> Dict[str, Dict[str, float]]:
+    """對 PyTorch 和 ONNX 後端進行吞吐量基準測試，返回各後端結果及相對 PyTorch 的加速比"""
+    from sentence_transformers import SentenceTransformer
+
+    model_dir = Path(model_dir) if model_dir else default_onnx_dir(model_name)
+    texts = texts or SAMPLE_TEXTS * 8
+
+    backends = {"torch": SentenceTransformer(model_name, device="cpu"),
+                "onnx-fp32": OnnxEmbeddingModel(model_dir)}
+    if (model_dir / INT8_FILE).exists():
+        backends["onnx-int8"] = OnnxEmbeddingModel(model_dir, quantized=True)
+
+    results = {}
+    reference = None
+    for name, model in backends.items():
+        # 預熱一次，排除首次調用的初始化開銷
+        embeddings = model.encode(texts[:batch_size], batch_size=batch_size, convert_to_numpy=True)
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            embeddings = model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+        elapsed = time.perf_counter() - start_time
+
+        results[name] = {
+            "texts_per_second": len(texts) * rounds / elapsed,
+            "ms_per_batch": elapsed / (rounds * max(1, len(texts) // batch_size)) * 1000
+        }
+        if reference is None:
+            reference = embeddings
+        else:
+            results[name].update(validate_embeddings(reference, embeddings))
+
+    base = results["torch"]["texts_per_second"]
+    for name in results:
+        results[name]["speedup"] = results[name]["texts_per_second"] / base
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="導出並測試 ONNX 嵌入模型")
+    parser.add_argument("command", choices=["export", "benchmark"])
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-zh"))
+    parser.add_argument("--output", help="ONNX 輸出目錄")
+    parser.add_argument("--quantize", action="store_true", help="同時生成 int8 動態量化模型")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        output_dir = export_onnx_model(args.model, args.output, quantize=args.quantize)
+        print(f"ONNX 模型已導出到: {output_dir}")
+
+    results = benchmark_backends(args.model, args.output, batch_size=args.batch_size)
+    print(f"{'後端':<12}{'texts/s':>12}{'ms/batch':>12}{'speedup':>10}{'min cos':>10}")
+    for name, result in results.items():
+        min_cosine = result.get("min_cosine")
+        print(f"{name:<12}{result['texts_per_second']:>12.1f}{result['ms_per_batch']:>12.1f}"
+              f"{result['speedup']:>9.2f}x{(f'{min_cosine:.4f}' if min_cosine is not None else '-'):>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""
+小用戶共享索引池
+文檔數不超過 POOLED_INDEX_MAX_DOCUMENTS 的用戶不單獨建索引目錄，按 user_id 分配到 POOLED_INDEX_POOLS 個
+共享池之一。池內向量 ID 的高 32 位為 user_id、低 32 位為片段位置，檢索時用 IDSelectorRange
+只在該用戶的 ID 範圍內搜索；池常駐記憶體，查詢不再逐次從磁盤載入索引
+"""
+
+import os
+import time
+import uuid
+import pickle
+import shutil
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+try:
+    from scripts.lexical_index import replace_owner_rows, search_lexical, LEXICAL_INDEX_FILE
+    from scripts.file_lock import file_lock
+except ImportError:
+    from lexical_index import replace_owner_rows, search_lexical, LEXICAL_INDEX_FILE
+    from file_lock import file_lock
+
+logger = logging.getLogger(__name__)
+
+# 文檔數不超過此值的用戶放入共享池（0 為不使用共享池），以及共享池數量
+POOLED_INDEX_MAX_DOCUMENTS = int(os.getenv("POOLED_INDEX_MAX_DOCUMENTS", "0"))
+POOLED_INDEX_POOLS = int(os.getenv("POOLED_INDEX_POOLS", "16"))
+# 檢查其他進程是否寫入了新版本的最短間隔（秒）；其他 worker 的更新最多延遲這麼久可見
+POOLED_INDEX_REFRESH_INTERVAL = float(os.getenv("POOLED_INDEX_REFRESH_INTERVAL", "1"))
+
+POOLS_DIR = "pools"
+# 每個版本一個 gen_* 目錄，包含向量索引和語料（faiss.serialize_index 與語料同一文件）以及全文索引，
+# 寫入後替換 CURRENT 文件一次切換
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "gen_"
+POOL_FILE = "pool.pkl"
+POOL_LOCK_FILE = "pool.lock"
+
+_POSITION_MASK = 0xFFFFFFFF
+
+
+def pooled_ids(user_id: int, count: int) -> np.ndarray:
+    return (np.int64(user_id) << 32) | np.arange(count, dtype=np.int64)
+
+
+def user_selector(user_id: int):
+    """選出該用戶全部向量的 ID 範圍 [user_id << 32, (user_id + 1) << 32)"""
+    return faiss.IDSelectorRange(int(user_id) << 32, (int(user_id) + 1) << 32)
+
+
+class IndexPool:
+    """
+    一個共享池：IndexIDMap2(IndexFlatIP)、按用戶保存的文檔和元數據，以及帶 owner 列的全文索引
+
+    修改在跨進程文件鎖內進行：先按磁盤上的最新版本重新載入，複製索引並修改，與全文索引一起寫入新版本目錄後
+    替換 CURRENT，最後替換記憶體中的引用，進行中的檢索繼續使用舊版本；上一版本目錄保留給仍在讀取它的進程。
+    其他進程最多每 POOLED_INDEX_REFRESH_INTERVAL 秒讀取一次 CURRENT，版本變化時重新載入
+    """
+
+    def __init__(self, path: Path, dimension: int):
+        self.path = path
+        self.dimension = dimension
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = None
+        self._corpus: Dict[int, Tuple[List[str], List[dict]]] = {}
+        self._generation = None
+        self._checked_at = 0.0
+
+    @property
+    def lexical_path(self) -> Path:
+        """已載入版本的全文索引；池為空時文件不存在"""
+        return self.path / (self._generation or GENERATION_PREFIX) / LEXICAL_INDEX_FILE
+
+    @property
+    def generation(self) -> Optional[str]:
+        """已載入的版本目錄名，池為空時為 None"""
+        return self._generation
+
+    def _current(self) -> Optional[str]:
+        try:
+            return (self.path / CURRENT_FILE).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self, force: bool = False):
+        """按 CURRENT 重新載入；force 為 False 時距上次檢查不足 POOLED_INDEX_REFRESH_INTERVAL 秒則跳過"""
+        now = time.monotonic()
+        if self._index is not None and not force and now - self._checked_at < POOLED_INDEX_REFRESH_INTERVAL:
+            return
+        generation = self._current()
+        self._checked_at = now
+        if self._index is not None and generation == self._generation:
+            return
+        with self._lock:
+            while self._index is None or generation != self._generation:
+                if generation is None:
+                    self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+                    self._corpus = {}
+                else:
+                    try:
+                        with open(self.path / generation / POOL_FILE, 'rb') as f:
+                            state = pickle.load(f)
+                    except FileNotFoundError:
+                        # 讀取 CURRENT 之後又有兩次寫入，該版本已刪除：按最新的 CURRENT 重試
+                        generation = self._current()
+                        continue
+                    self._index = faiss.deserialize_index(state["index"])
+                    self._corpus = state["corpus"]
+                    logger.info(f"載入共享索引池 {self.path.name}: {len(self._corpus)} 個用戶, "
+                                f"{self._index.ntotal} 個向量")
+                self._generation = generation
+
+    def has_user(self, user_id: int, fresh: bool = False) -> bool:
+        """
+        用戶是否在池中；查詢使用已載入版本的結果，建索引時 fresh=True 立即讀取 CURRENT，
+        不會因為尚未看到其他 worker 的寫入而讓用戶同時存在於池中和獨立索引中
+        """
+        self._refresh(force=fresh)
+        return user_id in self._corpus
+
+    def corpus(self, user_id: int) -> Tuple[List[str], List[dict]]:
+        self._refresh()
+        return self._corpus.get(user_id, ([], []))
+
+    def replace_user(self, user_id: int, embeddings: Optional[np.ndarray], documents: List[str],
+                     metadata: List[dict]):
+        """
+        替換用戶在池中的全部向量和文檔；documents 為空時從池中移除該用戶
+
+        整個池（向量、語料和全文索引）在鎖內寫入新版本目錄，耗時與池大小成正比；
+        池過大時增加 POOLED_INDEX_POOLS 或降低 POOLED_INDEX_MAX_DOCUMENTS
+        """
+        with file_lock(self.path / POOL_LOCK_FILE):
+            # 其他 worker 可能剛寫入過：在鎖內按磁盤上的最新版本修改，避免覆蓋它的更新
+            self._refresh(force=True)
+            index = faiss.clone_index(self._index)
+            index.remove_ids(user_selector(user_id))
+            corpus = dict(self._corpus)
+            corpus.pop(user_id, None)
+            ids = pooled_ids(user_id, len(documents))
+            if documents:
+                index.add_with_ids(np.ascontiguousarray(embeddings, dtype=np.float32), ids)
+                corpus[user_id] = (documents, metadata)
+
+            previous = self._generation
+            generation = self.path / f"{GENERATION_PREFIX}{uuid.uuid4().hex}"
+            generation.mkdir()
+            try:
+                with open(generation / POOL_FILE, 'wb') as f:
+                    pickle.dump({"index": faiss.serialize_index(index), "corpus": corpus}, f,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                # 全文索引在鎖內複製後修改，與向量索引屬於同一版本；寫入者持有鎖，複製時文件不會變化
+                if previous is not None and (self.path / previous / LEXICAL_INDEX_FILE).exists():
+                    shutil.copyfile(self.path / previous / LEXICAL_INDEX_FILE, generation / LEXICAL_INDEX_FILE)
+                replace_owner_rows(generation / LEXICAL_INDEX_FILE, user_id, ids.tolist(), documents)
+
+                pointer_tmp = self.path / f"{CURRENT_FILE}.{generation.name}.tmp"
+                pointer_tmp.write_text(generation.name, encoding="utf-8")
+                os.replace(pointer_tmp, self.path / CURRENT_FILE)
+            except BaseException:
+                shutil.rmtree(generation, ignore_errors=True)
+                raise
+
+            with self._lock:
+                self._index, self._corpus, self._generation = index, corpus, generation.name
+
+            for path in self.path.iterdir():
+                if path.name in (CURRENT_FILE, POOL_LOCK_FILE, generation.name, previous):
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+
+    def remove_user(self, user_id: int) -> bool:
+        """從池中移除用戶（升級為獨立索引或刪除賬號），返回用戶原本是否在池中"""
+        if not self.has_user(user_id, fresh=True):
+            return False
+        self.replace_user(user_id, None, [], [])
+        return True
+
+    def search(self, user_id: int, query_embeddings: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        只在該用戶的 ID 範圍內檢索；allowed 為過濾條件允許的語料位置時只檢索這些位置
+
+        Returns:
+            (scores, positions)，positions 為用戶語料中的位置，不足 top_k 時用 -1 填充
+        """
+        self._refresh()
+        if allowed is not None:
+            selector = faiss.IDSelectorBatch((np.int64(user_id) << 32) | allowed)
+        else:
+            selector = user_selector(user_id)
+        params = faiss.SearchParameters(sel=selector)
+        scores, ids = self._index.search(query_embeddings, top_k, params=params)
+        return scores, np.where(ids >= 0, ids & _POSITION_MASK, -1)
+
+    def search_lexical(self, user_id: int, queries: List[str], top_k: int,
+                       allowed: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """在共享全文索引中只檢索該用戶的行，返回 [(語料位置, BM25 分數)]"""
+        self._refresh()
+        row_ids = ((np.int64(user_id) << 32) | allowed).tolist() if allowed is not None else None
+        hits = search_lexical(self.lexical_path, queries, top_k, owner=user_id, allowed=row_ids)
+        return [[(row_id & _POSITION_MASK, score) for row_id, score in row] for row in hits]
+
+    def stats(self) -> Dict:
+        self._refresh()
+        return {"users": len(self._corpus), "vectors": int(self._index.ntotal)}
+
+
+class PooledIndexes:
+    """按 user_id 取模分配的共享池集合，池在首次使用時載入並常駐"""
+
+    def __init__(self, base_path: Path, dimension: int, pools: int = POOLED_INDEX_POOLS):
+        self.base_path = Path(base_path)
+        self.dimension = dimension
+        self.pools = max(1, pools)
+        self._pools: Dict[int, IndexPool] = {}
+        self._lock = threading.Lock()
+
+    def pool_for(self, user_id: int) -> IndexPool:
+        number = user_id % self.pools
+        with self._lock:
+            pool = self._pools.get(number)
+            if pool is None:
+                pool = self._pools[number] = IndexPool(self.base_path / f"pool_{number}", self.dimension)
+            return pool
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pools = dict(self._pools)
+        loaded = [pool.stats() for pool in pools.values()]
+        return {
+            "pools": self.pools,
+            "loaded_pools": len(loaded),
+            "users": sum(pool["users"] for pool in loaded),
+            "vectors": sum(pool["vectors"] for pool in loaded)
+        }
@@ -0,0 +1,208 @@
+"""
+預先 fork 的多 worker 啟動模式
+主進程先載入嵌入模型和只讀共享狀態，再 fork 出多個 uvicorn worker，模型權重頁以寫時複製方式共享
+"""
+
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 主進程報告各 worker 記憶體的間隔（秒），0 表示只在啟動後報告一次
+MEMORY_REPORT_INTERVAL = float(os.getenv("PREFORK_MEMORY_REPORT_INTERVAL", "300"))
+# fork 前由主進程寫入自身 PID，worker 據此找到主進程（不能用 getppid 猜測：單進程或被重新託管時會出錯）
+MASTER_PID_ENV = "PREFORK_MASTER_PID"
+
+
+def get_master_pid() -> int:
+    """預先 fork 模式下返回主進程 PID，單進程模式返回當前進程 PID"""
+    value = os.getenv(MASTER_PID_ENV)
+    return int(value) if value else os.getpid()
+
+
+def read_process_memory(pid: int) -> Optional[Dict[str, int]]:
+    """從 /proc/<pid>/smaps_rollup 讀取記憶體統計（KB）"""
+    fields = {"Rss": "rss_kb", "Pss": "pss_kb", "Shared_Clean": "shared_clean_kb",
+              "Shared_Dirty": "shared_dirty_kb", "Private_Clean": "private_clean_kb",
+              "Private_Dirty": "private_dirty_kb"}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    result = {}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in fields:
+            result[fields[key]] = int(value.split()[0])
+    result["uss_kb"] = result.get("private_clean_kb", 0) + result.get("private_dirty_kb", 0)
+    return result
+
+
+def child_pids(pid: int) -> List[int]:
+    """列出進程的直接子進程"""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_report(master_pid: int, worker_pids: Optional[List[int]] = None) -> Dict:
+    """
+    匯總主進程和各 worker 的記憶體使用
+
+    total_rss_mb 把共享頁重複計算；total_pss_mb 按共享進程數平攤，是實際佔用。
+    兩者差距越大，說明寫時複製共享越有效。
+    """
+    worker_pids = child_pids(master_pid) if worker_pids is None else worker_pids
+    processes = {"master": master_pid}
+    processes.update({f"worker_{pid}": pid for pid in worker_pids})
+
+    report = {"processes": {}, "total_rss_mb": 0.0, "total_pss_mb": 0.0}
+    for name, pid in processes.items():
+        memory = read_process_memory(pid)
+        if memory is None:
+            continue
+        report["processes"][name] = {
+            "pid": pid,
+            "rss_mb": round(memory.get("rss_kb", 0) / 1024, 1),
+            "pss_mb": round(memory.get("pss_kb", 0) / 1024, 1),
+            "uss_mb": round(memory["uss_kb"] / 1024, 1),
+            "shared_mb": round((memory.get("shared_clean_kb", 0) + memory.get("shared_dirty_kb", 0)) / 1024, 1)
+        }
+        report["total_rss_mb"] += memory.get("rss_kb", 0) / 1024
+        report["total_pss_mb"] += memory.get("pss_kb", 0) / 1024
+
+    report["total_rss_mb"] = round(report["total_rss_mb"], 1)
+    report["total_pss_mb"] = round(report["total_pss_mb"], 1)
+    return report
+
+
+def _log_memory_report(master_pid: int, worker_pids: List[int]):
+    report = memory_report(master_pid, worker_pids)
+    for name, info in report["processes"].items():
+        logger.info(f"[記憶體] {name}: RSS {info['rss_mb']}MB, PSS {info['pss_mb']}MB, "
+                    f"私有 {info['uss_mb']}MB, 共享 {info['shared_mb']}MB")
+    logger.info(f"[記憶體] 總 RSS {report['total_rss_mb']}MB, 總 PSS（實際佔用）{report['total_pss_mb']}MB")
+
+
+def _run_worker(app, sock: socket.socket, uvicorn_kwargs: dict, threads_per_worker: int,
+                after_fork: Optional[Callable[[], object]] = None):
+    """子進程：在繼承的監聽 socket 上運行 uvicorn"""
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # 丟棄從主進程繼承的數據庫連接等句柄，由 worker 自行重新打開
+    if after_fork is not None:
+        after_fork()
+
+    # fork 後重新設置線程數，避免每個 worker 都按全部核心創建線程池
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads_per_worker)
+
+    config = uvicorn.Config(app, **uvicorn_kwargs)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def serve_prefork(app, host: str, port: int, workers: int,
+                  preload: Optional[Callable[[], object]] = None,
+                  after_fork: Optional[Callable[[], object]] = None, **uvicorn_kwargs):
+    """
+    在主進程預載入後 fork 多個 worker 共享同一個監聽 socket
+
+    Args:
+        app: ASGI 應用
+        host: 監聽地址
+        port: 監聽端口
+        workers: worker 進程數
+        preload: fork 前在主進程執行的載入函數（例如載入嵌入模型）
+        after_fork: 每個 worker fork 後、啟動 uvicorn 前執行的函數（例如丟棄繼承的數據庫連接池）
+        uvicorn_kwargs: 傳給 uvicorn.Config 的其他參數
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("當前平台不支持 fork，請使用單進程模式")
+
+    master_pid = os.getpid()
+    os.environ[MASTER_PID_ENV] = str(master_pid)
+    if preload is not None:
+        start_time = time.perf_counter()
+        preload()
+        logger.info(f"主進程預載入完成，耗時 {time.perf_counter() - start_time:.2f}s")
+
+    # 把預載入產生的對象移出 GC 追蹤，避免子進程中 GC 掃描觸發寫時複製
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    threads_per_worker = max(1, cpu_count // workers)
+    worker_pids = set()
+    shutting_down = False
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, sock, uvicorn_kwargs, threads_per_worker, after_fork)
+            finally:
+                os._exit(0)
+        worker_pids.add(pid)
+        logger.info(f"啟動 worker 進程 {pid}")
+
+    def handle_shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(worker_pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
+    for _ in range(workers):
+        spawn_worker()
+
+    logger.info(f"預先 fork 模式: {workers} 個 worker 監聽 {host}:{port}（主進程 {master_pid}）")
+    time.sleep(2)
+    _log_memory_report(master_pid, sorted(worker_pids))
+    next_report = time.monotonic() + MEMORY_REPORT_INTERVAL if MEMORY_REPORT_INTERVAL > 0 else None
+
+    # 監督 worker：退出（例如達到 limit_max_requests）後從已載入的主進程重新 fork
+    while worker_pids:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+
+        if pid:
+            worker_pids.discard(pid)
+            if not shutting_down:
+                logger.info(f"worker {pid} 已退出，重新 fork")
+                spawn_worker()
+            continue
+
+        if next_report is not None and time.monotonic() >= next_report and not shutting_down:
+            _log_memory_report(master_pid, sorted(worker_pids))
+            next_report = time.monotonic() + MEMORY_REPORT_INTERVAL
+        time.sleep(0.5)
+
+    sock.close()
+    logger.info("所有 worker 已退出")
@@ -0,0 +1,402 @@
+"""
+LLM 提供商健康管理
+按提供商和 API 密鑰分別維護熔斷器、重試預算和限流節奏：
+服務故障時快速失敗，暫時性錯誤帶抖動退避重試，並根據響應的限流頭主動放慢請求
+"""
+
+import os
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 連續失敗多少次後熔斷，以及熔斷多久後放行試探請求（秒）
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("LLM_BREAKER_RESET_TIMEOUT", "30"))
+# 單次調用最多重試次數
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# 重試預算：每個請求存入的重試額度和額度上限（重試最多約佔請求的 20%）
+RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("LLM_RETRY_BUDGET_MAX", "10"))
+# 退避基數和上限（秒）
+RETRY_BACKOFF_BASE = float(os.getenv("LLM_RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("LLM_RETRY_BACKOFF_MAX", "8"))
+
+# 可重試的狀態碼：限流和網關/服務暫時不可用
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class LLMCallError(Exception):
+    """LLM 調用失敗，消息可直接展示給用戶"""
+
+
+class RequestCancelled(Exception):
+    """請求在發出前被取消"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        super().__init__(f"{provider} 請求已取消")
+
+
+class ProviderUnavailable(Exception):
+    """熔斷中或限流等待超出超時時間，未發出請求"""
+
+    def __init__(self, provider: str, reason: str, retry_in: float):
+        self.provider = provider
+        self.reason = reason
+        self.retry_in = retry_in
+        super().__init__(f"{provider} 服務暫時不可用（{reason}），約 {retry_in:.0f} 秒後恢復")
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """API 密鑰的短哈希，用於區分同一提供商的不同密鑰而不記錄密鑰本身"""
+    if not api_key:
+        return "none"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """解析 OpenAI 風格的重置時間，如 "1s"、"6m0s"、"250ms"，返回秒數"""
+    total, number, i = 0.0, "", 0
+    while i < len(value):
+        ch = value[i]
+        if ch.isdigit() or ch == ".":
+            number += ch
+        elif value.startswith("ms", i):
+            total += float(number or 0) / 1000
+            number = ""
+            i += 1
+        elif ch in "hms":
+            total += float(number or 0) * {"h": 3600, "m": 60, "s": 1}[ch]
+            number = ""
+        else:
+            return None
+        i += 1
+    return total + (float(number) if number else 0.0)
+
+
+def _parse_reset(value: Optional[str], now: float) -> Optional[float]:
+    """把限流頭中的重置時間（秒數、時長、RFC 3339 或 HTTP 日期）轉成等待秒數"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    duration = _parse_duration(value)
+    if duration is not None:
+        return duration
+    for parse in (lambda v: datetime.fromisoformat(v.replace("Z", "+00:00")), parsedate_to_datetime):
+        try:
+            moment = parse(value)
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            return max(0.0, moment.timestamp() - now)
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+class CircuitBreaker:
+    """連續失敗達到閾值後熔斷，冷卻後放行一個試探請求"""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 on_transition: Optional[Callable[[str, str, str], None]] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._on_transition = on_transition
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if self._on_transition is not None:
+            self._on_transition(self.name, previous, state)
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """是否允許發出請求"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.retry_in() <= 0:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """放行後未實際發出請求時調用，歸還試探名額"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self._transition(OPEN)
+
+
+class RetryBudget:
+    """每個請求存入一定額度，每次重試消耗 1，避免故障時重試把流量放大數倍"""
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, max_tokens: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Pacer:
+    """根據限流響應頭推算下一次請求最早可以發出的時間"""
+
+    def __init__(self):
+        self.not_before = 0.0
+        self.paced_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        return max(0.0, self.not_before - time.monotonic())
+
+    def update(self, response: requests.Response):
+        headers = response.headers
+        now = time.time()
+        delay = None
+        if response.status_code == 429:
+            delay = _parse_reset(headers.get("retry-after"), now)
+            if delay is None:
+                delay = 1.0
+        else:
+            # OpenAI / DeepSeek: x-ratelimit-*；Anthropic: anthropic-ratelimit-*
+            for prefix in ("x-ratelimit", "anthropic-ratelimit"):
+                for kind in ("requests", "tokens"):
+                    remaining = headers.get(f"{prefix}-remaining-{kind}")
+                    if remaining is not None and remaining.strip() in ("0", "0.0"):
+                        reset = _parse_reset(headers.get(f"{prefix}-reset-{kind}"), now)
+                        if reset is not None:
+                            delay = max(delay or 0.0, reset)
+        if delay:
+            with self._lock:
+                self.not_before = max(self.not_before, time.monotonic() + delay)
+
+    def pace(self, max_wait: float) -> float:
+        """等待到允許發送；需要等待的時間超過 max_wait 時返回還需等待的秒數而不等待"""
+        wait = self.wait_time()
+        if wait > max_wait:
+            return wait
+        if wait > 0:
+            time.sleep(wait)
+            with self._lock:
+                self.paced_seconds += wait
+        return 0.0
+
+
+class ProviderHealth:
+    """單個提供商 + API 密鑰的健康狀態"""
+
+    def __init__(self, provider: str, fingerprint: str, on_transition: Callable[[str, str, str], None]):
+        self.provider = provider
+        self.fingerprint = fingerprint
+        self.breaker = CircuitBreaker(f"{provider}:{fingerprint}", on_transition=on_transition)
+        self.retry_budget = RetryBudget()
+        self.pacer = Pacer()
+        self.counters = {"requests": 0, "successes": 0, "failures": 0, "retries": 0,
+                         "rejected": 0, "rate_limited": 0, "retry_budget_exhausted": 0}
+
+    def count(self, name: str):
+        # 對沖請求會在多個線程中更新同一提供商的計數，與熔斷器狀態共用一把鎖
+        with self.breaker._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict:
+        with self.breaker._lock:
+            counters = dict(self.counters)
+        return {
+            "provider": self.provider,
+            "key": self.fingerprint,
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "retry_in": round(self.breaker.retry_in(), 1) if self.breaker.state == OPEN else 0.0,
+            "retry_tokens": round(self.retry_budget.tokens, 2),
+            "paced_seconds": round(self.pacer.paced_seconds, 2),
+            **counters
+        }
+
+
+class ProviderHealthRegistry:
+    """所有提供商的健康狀態和熔斷狀態變化記錄"""
+
+    def __init__(self):
+        self._providers: Dict[str, ProviderHealth] = {}
+        self._lock = threading.Lock()
+        self.transitions = deque(maxlen=100)
+        self.transition_counts: Dict[str, int] = {}
+
+    def _record_transition(self, name: str, previous: str, state: str):
+        key = f"{previous}->{state}"
+        with self._lock:
+            self.transitions.append({"timestamp": time.time(), "breaker": name, "from": previous, "to": state})
+            self.transition_counts[key] = self.transition_counts.get(key, 0) + 1
+        log = logger.warning if state == OPEN else logger.info
+        log(f"LLM 熔斷器 {name}: {previous} -> {state}")
+
+    def get(self, provider: str, api_key: Optional[str]) -> ProviderHealth:
+        fingerprint = key_fingerprint(api_key)
+        key = f"{provider}:{fingerprint}"
+        with self._lock:
+            if key not in self._providers:
+                self._providers[key] = ProviderHealth(provider, fingerprint, self._record_transition)
+            return self._providers[key]
+
+    def is_available(self, provider: str, api_key: Optional[str]) -> bool:
+        """熔斷器未打開（或冷卻已結束）時返回 True，不改變熔斷器狀態"""
+        breaker = self.get(provider, api_key).breaker
+        return breaker.state != OPEN or breaker.retry_in() <= 0
+
+    def request(self, provider: str, api_key: Optional[str], url: str, headers: Dict,
+                payload: Dict, timeout: float, cancel_event: Optional[threading.Event] = None) -> requests.Response:
+        """
+        經熔斷器、限流節奏和重試發送 POST 請求
+
+        Args:
+            timeout: 整個調用（含重試和等待）的總超時秒數
+            cancel_event: 設置後不再發起新的嘗試（對沖請求中落敗的一方）
+
+        Returns:
+            最後一次響應（可能是非 2xx，由調用方處理）
+
+        Raises:
+            ProviderUnavailable: 熔斷中，或限流等待超出剩餘時間
+            RequestCancelled: cancel_event 已設置
+            requests.RequestException: 網絡錯誤且重試用盡
+        """
+        health = self.get(provider, api_key)
+        deadline = time.monotonic() + timeout
+        health.retry_budget.deposit()
+        health.count("requests")
+
+        attempt = 0
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled(provider)
+            if not health.breaker.allow():
+                health.count("rejected")
+                raise ProviderUnavailable(provider, "熔斷中", health.breaker.retry_in())
+
+            wait = health.pacer.pace(max_wait=deadline - time.monotonic())
+            if wait > 0:
+                health.count("rejected")
+                health.breaker.release()
+                raise ProviderUnavailable(provider, "請求頻率受限", wait)
+
+            remaining = deadline - time.monotonic()
+            error = None
+            response = None
+            try:
+                response = requests.post(url, headers=headers, json=payload, timeout=max(remaining, 0.1))
+            except requests.Timeout as e:
+                # 超時已用掉整個時間預算，不再重試
+                health.count("failures")
+                health.breaker.record_failure()
+                raise e
+            except requests.ConnectionError as e:
+                error = e
+
+            if response is not None:
+                health.pacer.update(response)
+                if response.status_code not in RETRYABLE_STATUS:
+                    # 2xx 和客戶端錯誤（密鑰無效、參數錯誤）都說明服務本身可用
+                    health.breaker.record_success()
+                    if response.status_code < 400:
+                        health.count("successes")
+                    return response
+
+            if response is not None and response.status_code == 429:
+                # 限流說明服務可用，只由 Pacer 放慢節奏，不計入熔斷失敗；歸還可能佔用的試探名額
+                health.count("rate_limited")
+                health.breaker.release()
+            else:
+                health.count("failures")
+                health.breaker.record_failure()
+
+            backoff = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+            backoff = max(backoff, health.pacer.wait_time())
+            can_retry = (attempt < LLM_MAX_RETRIES
+                         and time.monotonic() + backoff < deadline
+                         and health.breaker.state != OPEN)
+            if can_retry and not health.retry_budget.withdraw():
+                health.count("retry_budget_exhausted")
+                can_retry = False
+            if not can_retry:
+                if error is not None:
+                    raise error
+                return response
+
+            attempt += 1
+            health.count("retries")
+            logger.info(f"{provider} 請求失敗（{error or response.status_code}），{backoff:.2f}s 後第 {attempt} 次重試")
+            time.sleep(backoff)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            providers = list(self._providers.values())
+            transitions = list(self.transitions)[-20:]
+            counts = dict(self.transition_counts)
+        return {
+            "providers": [health.stats() for health in providers],
+            "transition_counts": counts,
+            "recent_transitions": transitions
+        }
+
+
+_registry = ProviderHealthRegistry()
+
+
+def get_provider_health() -> ProviderHealthRegistry:
+    """進程內共享的提供商健康狀態"""
+    return _registry
@@ -0,0 +1,221 @@
+"""
+請求限流
+按用戶（認證接口按客戶端 IP）和接口類別（query / search / batch / upload / auth）使用令牌桶限流，
+超限時返回 429 並帶 Retry-After；多 worker 部署可使用共享的 SQLite 存儲
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# 計數器存儲：memory（進程內）或 sqlite（多個 worker 共享）
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory").lower()
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "./rate_limits.db")
+
+# 各接口類別的默認限額：(每分鐘請求數, 突發容量)
+DEFAULT_LIMITS = {
+    "query": (30, 10),
+    "search": (120, 30),
+    "batch": (5, 2),
+    "upload": (10, 5),
+    "auth": (10, 5)
+}
+
+
+@dataclass
+class RateLimit:
+    """令牌桶參數：每分鐘補充 per_minute 個令牌，最多累積 burst 個"""
+    per_minute: float
+    burst: int
+
+    @property
+    def refill_rate(self) -> float:
+        return self.per_minute / 60.0
+
+
+def _refill(tokens: float, updated: float, now: float, limit: RateLimit) -> float:
+    return min(float(limit.burst), tokens + (now - updated) * limit.refill_rate)
+
+
+def _take(tokens: float, limit: RateLimit, cost: float) -> Tuple[bool, float, float]:
+    """返回 (是否允許, 剩餘令牌, 需等待秒數)"""
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / limit.refill_rate
+
+
+class InMemoryBucketStore:
+    """
+    進程內令牌桶存儲，最多保存 max_keys 個桶，超出時淘汰最久未使用的桶
+
+    已補滿的桶與不存在等價；只有大量身份同時活躍時才會淘汰未補滿的桶（等同重置該身份的計數）
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max(1, max_keys)
+        # key -> (令牌數, 更新時間, 該桶的限額)，按最近使用排序
+        self._buckets: "OrderedDict[str, Tuple[float, float, RateLimit]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, limit: RateLimit, cost: float = 1.0) -> Tuple[bool, float, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (float(limit.burst), now, limit))
+            allowed, tokens, retry_after = _take(_refill(tokens, updated, now, limit), limit, cost)
+            self._buckets[key] = (tokens, now, limit)
+            while len(self._buckets) > self.max_keys:
+                self._evict_oldest(now)
+        return allowed, tokens, retry_after
+
+    def _evict_oldest(self, now: float):
+        key, (tokens, updated, limit) = self._buckets.popitem(last=False)
+        if _refill(tokens, updated, now, limit) < limit.burst:
+            logger.debug(f"限流桶數超過 {self.max_keys}，淘汰未補滿的桶 {key}")
+
+
+class SQLiteBucketStore:
+    """
+    SQLite 令牌桶存儲，同一主機上的多個 worker 進程共享計數
+
+    每個進程最多每 prune_interval 秒刪除一次已補滿的行（更新時間早於最長的補滿時間 burst / 補充速率）
+    """
+
+    def __init__(self, path: str = RATE_LIMIT_DB, prune_interval: float = 60.0):
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        # 已使用過的限額中從空桶補滿所需的最長秒數；更新時間早於此的行已補滿，可以刪除
+        self._refill_horizon = 0.0
+        self._next_prune = time.time() + prune_interval
+
+    def _connection(self) -> sqlite3.Connection:
+        # 首次使用時才連接，並按進程區分：fork 出的 worker 不能沿用主進程的連接
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS rate_limit_buckets_updated ON rate_limit_buckets (updated)")
+            self._local.pid, self._local.conn = pid, conn
+        return self._local.conn
+
+    def take(self, key: str, limit: RateLimit, cost: float = 1.0) -> Tuple[bool, float, float]:
+        # 進程間共享，使用牆上時間
+        now = time.time()
+        self._refill_horizon = max(self._refill_horizon, limit.burst / limit.refill_rate)
+        conn = self._connection()
+        # BEGIN IMMEDIATE 取得寫鎖，讀取和更新之間不會被其他 worker 插入
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (float(limit.burst), now)
+            allowed, tokens, retry_after = _take(_refill(tokens, updated, now, limit), limit, cost)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now)
+            )
+            if now >= self._next_prune:
+                self._next_prune = now + self.prune_interval
+                conn.execute("DELETE FROM rate_limit_buckets WHERE updated < ?", (now - self._refill_horizon,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, tokens, retry_after
+
+
+class RateLimitExceeded(Exception):
+    """超出限額"""
+
+    def __init__(self, endpoint_class: str, limit: RateLimit, retry_after: float):
+        self.endpoint_class = endpoint_class
+        self.limit = limit
+        self.retry_after = retry_after
+        super().__init__(f"{endpoint_class} 請求過於頻繁，請 {retry_after:.1f} 秒後重試")
+
+
+class RateLimiter:
+    """按接口類別和身份標識限流"""
+
+    def __init__(self, limits: Optional[Dict[str, RateLimit]] = None, store=None, enabled: bool = True):
+        self.limits = limits or {name: RateLimit(*values) for name, values in DEFAULT_LIMITS.items()}
+        self.store = store or InMemoryBucketStore()
+        self.enabled = enabled
+        self.rejected: Dict[str, int] = {name: 0 for name in self.limits}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        """
+        從環境變數創建，例如 RATE_LIMIT_QUERY_PER_MINUTE=30、RATE_LIMIT_QUERY_BURST=10
+        """
+        limits = {}
+        for name, (per_minute, burst) in DEFAULT_LIMITS.items():
+            prefix = f"RATE_LIMIT_{name.upper()}"
+            limits[name] = RateLimit(
+                per_minute=float(os.getenv(f"{prefix}_PER_MINUTE", per_minute)),
+                burst=int(os.getenv(f"{prefix}_BURST", burst))
+            )
+
+        store = None
+        if RATE_LIMIT_STORE == "sqlite":
+            try:
+                store = SQLiteBucketStore(RATE_LIMIT_DB)
+                logger.info(f"限流計數使用 SQLite 共享存儲: {RATE_LIMIT_DB}")
+            except sqlite3.Error as e:
+                logger.error(f"SQLite 限流存儲初始化失敗，改用進程內存儲: {e}")
+        elif RATE_LIMIT_STORE != "memory":
+            logger.warning(f"未知的限流存儲 {RATE_LIMIT_STORE}，使用進程內存儲")
+
+        return cls(limits=limits, store=store, enabled=RATE_LIMIT_ENABLED)
+
+    def check(self, endpoint_class: str, identity: str, cost: float = 1.0) -> Dict:
+        """
+        消耗一個令牌
+
+        Returns:
+            限額信息（limit / remaining）
+
+        Raises:
+            RateLimitExceeded: 令牌不足
+        """
+        limit = self.limits.get(endpoint_class)
+        if not self.enabled or limit is None:
+            return {}
+
+        try:
+            allowed, remaining, retry_after = self.store.take(f"{endpoint_class}:{identity}", limit, cost)
+        except Exception as e:
+            # 計數存儲故障時放行，不影響正常服務
+            logger.error(f"限流計數失敗，放行請求: {e}")
+            return {}
+
+        if not allowed:
+            with self._lock:
+                self.rejected[endpoint_class] += 1
+            raise RateLimitExceeded(endpoint_class, limit, retry_after)
+        return {"limit": limit.per_minute, "burst": limit.burst, "remaining": int(remaining)}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            rejected = dict(self.rejected)
+        return {
+            "enabled": self.enabled,
+            "store": type(self.store).__name__,
+            "limits": {name: {"per_minute": l.per_minute, "burst": l.burst} for name, l in self.limits.items()},
+            "rejected": rejected
+        }
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+批量重建用戶索引腳本
+使用多進程嵌入池重新生成所有（或指定）用戶的向量索引
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+current_dir = Path(__file__).parent
+sys.path.insert(0, str(current_dir))
+
+from user_knowledge_base import UserKnowledgeBaseSystem
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量重建用戶向量索引")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("EMBED_POOL_WORKERS", os.cpu_count() or 1)),
+                        help="嵌入工作進程數量")
+    parser.add_argument("--user", type=int, action="append", help="只重建指定用戶（可重複）")
+    args = parser.parse_args()
+
+    kb_system = UserKnowledgeBaseSystem(embedding_workers=args.workers)
+    try:
+        if args.user:
+            results = {user_id: kb_system.build_user_index(user_id) for user_id in args.user}
+        else:
+            results = kb_system.rebuild_all_user_indexes()
+    finally:
+        kb_system.close()
+
+    failed = [user_id for user_id, ok in results.items() if not ok]
+    print(f"重建完成：成功 {len(results) - len(failed)} 個，失敗或無文檔 {len(failed)} 個")
+    if failed:
+        print(f"未成功的用戶: {failed}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
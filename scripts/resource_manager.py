@@ -0,0 +1,305 @@
+"""
+CPU 資源分區
+為查詢嵌入、文檔攝取和 FAISS 搜索分別配置線程數並劃分核心，為交互式查詢預留核心，
+避免 PyTorch、FAISS (OpenMP) 和分詞器各自按全部核心創建線程池造成超額訂閱；
+各池的任務按優先級和租戶公平調度（見 scheduler.py）
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Optional
+
+try:
+    from scripts.scheduler import FairQueue, PriorityScheduler, INTERACTIVE, BULK
+except ImportError:
+    from scheduler import FairQueue, PriorityScheduler, INTERACTIVE, BULK
+
+logger = logging.getLogger(__name__)
+
+# 是否啟用核心分區
+RESOURCE_PARTITIONING = os.getenv("RESOURCE_PARTITIONING", "true").lower() == "true"
+
+
+def _available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _read_cpu_times() -> Dict[int, tuple]:
+    """讀取 /proc/stat 中每個核心的 (busy, total) jiffies"""
+    times = {}
+    try:
+        with open("/proc/stat", "r") as f:
+            for line in f:
+                if not line.startswith("cpu") or line.startswith("cpu "):
+                    continue
+                parts = line.split()
+                values = [int(v) for v in parts[1:]]
+                idle = values[3] + (values[4] if len(values) > 4 else 0)
+                times[int(parts[0][3:])] = (sum(values) - idle, sum(values))
+    except OSError:
+        pass
+    return times
+
+
+def _read_procs_running() -> Optional[int]:
+    """系統運行隊列中可運行的線程數"""
+    try:
+        with open("/proc/stat", "r") as f:
+            for line in f:
+                if line.startswith("procs_running"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class WorkPool:
+    """綁定到一組核心的工作線程池，並統計排隊、運行和飽和度"""
+
+    def __init__(self, name: str, cores: List[int], workers: int,
+                 initializer: Optional[Callable[[], None]] = None,
+                 scheduler: Optional[PriorityScheduler] = None):
+        """
+        Args:
+            name: 池名稱（query / ingest / search）
+            cores: 工作線程綁定的 CPU 核心
+            workers: 工作線程數
+            initializer: 每個工作線程執行首個任務前調用（設置庫線程數等）
+            scheduler: 跨池優先級調度器，批量任務在交互式任務清空後才執行
+        """
+        self.name = name
+        self.cores = cores
+        self.workers = max(1, workers)
+        self._initializer = initializer
+        self._scheduler = scheduler
+        self._queue = FairQueue()
+        self._condition = threading.Condition()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._last_snapshot = (time.monotonic(), 0.0)
+
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{name}-pool-{i}", daemon=True).start()
+
+    def _worker(self):
+        # Linux 上 sched_setaffinity(0) 只作用於調用線程；之後在此線程創建的
+        # OpenMP 線程組會繼承同一組核心
+        if self.cores and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, self.cores)
+            except OSError as e:
+                logger.warning(f"{self.name} 池綁定核心失敗: {e}")
+        initialized = False
+
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                (future, fn, args, kwargs, enqueued_at), priority = self._queue.pop()
+                self.queued -= 1
+
+            # 批量任務讓位：有交互式任務排隊或運行時先等待
+            if priority == BULK and self._scheduler is not None:
+                self._scheduler.wait_for_bulk_turn()
+
+            # 首個任務前再初始化：此時模型已載入，torch / faiss 已導入
+            if not initialized and self._initializer is not None:
+                self._initializer()
+                initialized = True
+
+            with self._condition:
+                self.running += 1
+            started_at = time.monotonic()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                finished_at = time.monotonic()
+                with self._condition:
+                    self.running -= 1
+                    self.completed += 1
+                    self.busy_seconds += finished_at - started_at
+                    self.wait_seconds += started_at - enqueued_at
+                if priority == INTERACTIVE and self._scheduler is not None:
+                    self._scheduler.interactive_finished()
+
+    def schedule(self, fn: Callable, args: tuple = (), kwargs: Optional[dict] = None,
+                 priority: int = INTERACTIVE, tenant: Optional[Hashable] = None) -> Future:
+        """
+        按優先級和租戶提交任務
+
+        Args:
+            fn: 要執行的函數
+            args: 位置參數
+            kwargs: 關鍵字參數
+            priority: INTERACTIVE 或 BULK
+            tenant: 租戶標識（通常為用戶 ID），同一優先級內按租戶輪轉
+        """
+        future = Future()
+        if priority == INTERACTIVE and self._scheduler is not None:
+            self._scheduler.interactive_started()
+        with self._condition:
+            self._queue.push((future, fn, args, kwargs or {}, time.monotonic()), priority, tenant)
+            self.queued += 1
+            self._condition.notify()
+        return future
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """以交互式優先級提交任務，返回 concurrent.futures.Future"""
+        return self.schedule(fn, args, kwargs)
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """提交任務並阻塞等待結果"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run_async(self, fn: Callable, *args, **kwargs):
+        """在事件循環中等待任務結果"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self) -> Dict:
+        """池狀態；saturation 為上次調用以來工作線程忙碌時間佔比"""
+        now = time.monotonic()
+        with self._condition:
+            busy = self.busy_seconds
+            snapshot = {
+                "cores": self.cores,
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait_ms": round(self.wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+                "queues": self._queue.stats()
+            }
+        last_time, last_busy = self._last_snapshot
+        self._last_snapshot = (now, busy)
+        elapsed = max(now - last_time, 1e-6)
+        snapshot["saturation"] = round(min(1.0, (busy - last_busy) / (elapsed * self.workers)), 3)
+        return snapshot
+
+
+class ResourceManager:
+    """劃分 CPU 核心並管理 query / ingest / search 三個工作池"""
+
+    def __init__(self):
+        cores = _available_cores()
+        n = len(cores)
+
+        query_count = int(os.getenv("CPU_QUERY_CORES", max(1, n // 3)))
+        search_count = int(os.getenv("CPU_SEARCH_CORES", 1))
+
+        if RESOURCE_PARTITIONING and n >= 3 and query_count + search_count < n:
+            # 查詢核心優先預留，其次是搜索，剩餘核心給攝取
+            self.partitions = {
+                "query": cores[:query_count],
+                "search": cores[query_count:query_count + search_count],
+                "ingest": cores[query_count + search_count:]
+            }
+        else:
+            # 核心太少時不分區，各池共享所有核心
+            self.partitions = {"query": cores, "search": cores, "ingest": cores}
+
+        self.tokenizer_threads = int(os.getenv("TOKENIZERS_NUM_THREADS", "1"))
+        self.scheduler = PriorityScheduler()
+        self.pools: Dict[str, WorkPool] = {}
+        self._last_cpu_times = _read_cpu_times()
+
+    def configure_environment(self):
+        """
+        在導入 torch / faiss / tokenizers 之前設置線程數環境變數
+        （OpenMP、MKL 和 rayon 都在首次使用時按這些變數創建線程池）
+        """
+        query_threads = str(len(self.partitions["query"]))
+        os.environ.setdefault("OMP_NUM_THREADS", query_threads)
+        os.environ.setdefault("MKL_NUM_THREADS", query_threads)
+        os.environ.setdefault("RAYON_NUM_THREADS", str(self.tokenizer_threads))
+        if self.tokenizer_threads <= 1:
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    def _thread_initializer(self, torch_threads: int, faiss_threads: int) -> Callable[[], None]:
+        def initialize():
+            # OpenMP 的線程數設置作用於調用線程，因此在每個工作線程內分別設置；
+            # 只配置已導入的庫（例如遠程嵌入後端下不會導入 torch）
+            if "torch" in sys.modules:
+                sys.modules["torch"].set_num_threads(torch_threads)
+            if "faiss" in sys.modules:
+                sys.modules["faiss"].omp_set_num_threads(faiss_threads)
+        return initialize
+
+    def start_pools(self):
+        """創建工作池（預先 fork 模式下需在 worker 進程內調用，線程不會跨 fork 保留）"""
+        if self.pools:
+            return self.pools
+
+        workers = {
+            "query": int(os.getenv("QUERY_POOL_WORKERS", "2")),
+            "search": int(os.getenv("SEARCH_POOL_WORKERS", "2")),
+            "ingest": int(os.getenv("INGEST_POOL_WORKERS", "1"))
+        }
+        for name, cores in self.partitions.items():
+            # 每個任務的庫線程數 = 池核心數 / 併發任務數
+            threads = max(1, len(cores) // workers[name])
+            self.pools[name] = WorkPool(
+                name, cores, workers[name],
+                initializer=self._thread_initializer(torch_threads=threads, faiss_threads=threads),
+                scheduler=self.scheduler
+            )
+        logger.info("CPU 分區: " + ", ".join(
+            f"{name}={cores[0]}-{cores[-1]} ({workers[name]} 線程)" for name, cores in self.partitions.items()
+        ))
+        return self.pools
+
+    def pool(self, name: str) -> Optional[WorkPool]:
+        return self.pools.get(name)
+
+    def stats(self) -> Dict:
+        """各池的運行隊列、飽和度以及所屬核心的 CPU 使用率"""
+        cpu_times = _read_cpu_times()
+        core_usage = {}
+        for core, (busy, total) in cpu_times.items():
+            last_busy, last_total = self._last_cpu_times.get(core, (0, 0))
+            core_usage[core] = (busy - last_busy) / (total - last_total) if total > last_total else 0.0
+        self._last_cpu_times = cpu_times
+
+        pools = {}
+        for name, pool in self.pools.items():
+            pools[name] = pool.stats()
+            usage = [core_usage[c] for c in pool.cores if c in core_usage]
+            pools[name]["cpu_utilization"] = round(sum(usage) / len(usage), 3) if usage else None
+
+        return {
+            "partitioning": self.partitions["query"] != self.partitions["ingest"],
+            "pools": pools,
+            "scheduler": self.scheduler.stats(),
+            "system": {
+                "cores": len(_available_cores()),
+                "load_average": list(os.getloadavg()) if hasattr(os, "getloadavg") else None,
+                "procs_running": _read_procs_running()
+            }
+        }
+
+
+_resource_manager = None
+_resource_lock = threading.Lock()
+
+
+def get_resource_manager() -> ResourceManager:
+    """進程內共享的資源管理器"""
+    global _resource_manager
+    with _resource_lock:
+        if _resource_manager is None:
+            _resource_manager = ResourceManager()
+        return _resource_manager
@@ -0,0 +1,102 @@
+"""
+優先級調度
+交互式查詢優先於批量攝取；同一優先級內按租戶輪轉，避免單個大量上傳的用戶餓死其他用戶
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, Hashable, Optional
+
+# 優先級（數值越小越優先）
+INTERACTIVE = 0
+BULK = 1
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# 批量任務讓位給交互式任務的最長等待時間，避免查詢持續不斷時攝取完全停滯
+BULK_MAX_DEFER_MS = float(os.getenv("BULK_MAX_DEFER_MS", "2000"))
+
+
+class FairQueue:
+    """按優先級分層、層內按租戶輪轉的隊列（調用方負責加鎖）"""
+
+    def __init__(self):
+        self._tiers: Dict[int, "OrderedDict[Hashable, deque]"] = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self._sizes = {INTERACTIVE: 0, BULK: 0}
+
+    def push(self, item: Any, priority: int = INTERACTIVE, tenant: Optional[Hashable] = None):
+        tenants = self._tiers[priority]
+        if tenant not in tenants:
+            tenants[tenant] = deque()
+        tenants[tenant].append(item)
+        self._sizes[priority] += 1
+
+    def pop(self):
+        """取出最高優先級中輪到的租戶的下一個任務，返回 (item, priority)"""
+        for priority in (INTERACTIVE, BULK):
+            tenants = self._tiers[priority]
+            if not tenants:
+                continue
+            tenant, items = next(iter(tenants.items()))
+            item = items.popleft()
+            # 該租戶移到隊尾，下一次輪到其他租戶
+            if items:
+                tenants.move_to_end(tenant)
+            else:
+                del tenants[tenant]
+            self._sizes[priority] -= 1
+            return item, priority
+        raise IndexError("pop from empty FairQueue")
+
+    def __len__(self) -> int:
+        return self._sizes[INTERACTIVE] + self._sizes[BULK]
+
+    def stats(self) -> Dict:
+        return {
+            PRIORITY_NAMES[priority]: {"queued": self._sizes[priority], "tenants": len(self._tiers[priority])}
+            for priority in (INTERACTIVE, BULK)
+        }
+
+
+class PriorityScheduler:
+    """跨工作池協調：有交互式任務排隊或運行時，批量任務暫緩執行"""
+
+    def __init__(self, max_defer_ms: float = BULK_MAX_DEFER_MS):
+        self.max_defer = max_defer_ms / 1000.0
+        self._condition = threading.Condition()
+        self._interactive_active = 0
+        self.bulk_deferrals = 0
+        self.bulk_deferred_seconds = 0.0
+
+    def interactive_started(self):
+        """交互式任務進入隊列時調用"""
+        with self._condition:
+            self._interactive_active += 1
+
+    def interactive_finished(self):
+        """交互式任務完成時調用"""
+        with self._condition:
+            self._interactive_active -= 1
+            if self._interactive_active == 0:
+                self._condition.notify_all()
+
+    def wait_for_bulk_turn(self):
+        """批量任務執行前調用：等待交互式任務清空，最多等待 max_defer"""
+        with self._condition:
+            if self._interactive_active == 0:
+                return
+            self.bulk_deferrals += 1
+            start_time = time.monotonic()
+            self._condition.wait_for(lambda: self._interactive_active == 0, timeout=self.max_defer)
+            self.bulk_deferred_seconds += time.monotonic() - start_time
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {
+                "interactive_active": self._interactive_active,
+                "bulk_deferrals": self.bulk_deferrals,
+                "bulk_deferred_seconds": round(self.bulk_deferred_seconds, 3),
+                "bulk_max_defer_ms": self.max_defer * 1000
+            }
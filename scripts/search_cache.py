@@ -0,0 +1,127 @@
+"""
+檢索結果緩存
+/search 第一頁一次檢索較深的結果集並緩存，後續頁通過游標直接從緩存切片，
+不再重複嵌入和搜索。結果集記錄檢索時的索引版本，任何 worker 重建索引後版本改變，所有 worker 的緩存都不再命中；
+本 worker 處理的文檔變更另外直接清除該用戶的緩存
+"""
+
+import os
+import time
+import uuid
+import base64
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# 緩存結果集保留時間（秒）、緩存結果集總數上限；索引重建後舊結果集按版本失效，不受 TTL 影響
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+# 第一頁檢索的結果數（所有分頁共享），以及每頁結果數上限
+SEARCH_CACHE_DEPTH = int(os.getenv("SEARCH_CACHE_DEPTH", "50"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+
+
+class InvalidCursor(Exception):
+    """游標格式錯誤、不屬於該用戶或與查詢不符"""
+
+
+def encode_cursor(result_id: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{result_id}:{offset}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, max_offset: int = SEARCH_CACHE_DEPTH) -> Tuple[str, int]:
+    """
+    Raises:
+        InvalidCursor: 格式錯誤，或偏移量超出緩存的結果集深度（游標由客戶端提交，不能用來放大檢索深度）
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        result_id, offset = base64.urlsafe_b64decode(padded.encode()).decode().split(":", 1)
+        offset = int(offset)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor("游標格式錯誤")
+    if not 0 <= offset < max_offset:
+        raise InvalidCursor("游標超出結果範圍")
+    return result_id, offset
+
+
+class SearchResultCache:
+    """
+    按 result_id 緩存的檢索結果集，LRU 淘汰並按 TTL 過期
+
+    存儲在進程內；多 worker 部署時游標落到其他 worker 會重新檢索（結果相同，只是多一次搜索）。
+    index_version 與緩存時不同（其他 worker 重建了索引）視為未命中
+    """
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, user_id: int, query: str, results: List[dict], result_id: Optional[str] = None,
+            retrieval: str = "vector", filters: str = "", index_version: str = "") -> str:
+        result_id = result_id or uuid.uuid4().hex
+        with self._lock:
+            self._entries[result_id] = {
+                "user_id": user_id,
+                "query": query,
+                "retrieval": retrieval,
+                "filters": filters,
+                "index_version": index_version,
+                "results": results,
+                "created_at": time.time()
+            }
+            self._entries.move_to_end(result_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result_id
+
+    def get(self, result_id: str, user_id: int, query: str, retrieval: str = "vector",
+            filters: str = "", index_version: str = "") -> Optional[List[dict]]:
+        """
+        返回緩存的結果集；不存在、已過期或索引已重建時返回 None
+
+        Args:
+            filters: 過濾條件摘要（SearchFilter.key()），與緩存時不同視為游標不符
+            index_version: 用戶當前的索引版本（UserKnowledgeBaseSystem.index_version）
+
+        Raises:
+            InvalidCursor: 結果集屬於其他用戶或其他查詢
+        """
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is not None and (entry["created_at"] < time.time() - self.ttl
+                                      or entry["index_version"] != index_version):
+                del self._entries[result_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            if (entry["user_id"] != user_id or entry["query"] != query or entry["retrieval"] != retrieval
+                    or entry["filters"] != filters):
+                raise InvalidCursor("游標與當前查詢不符")
+            self._entries.move_to_end(result_id)
+            self.hits += 1
+            return entry["results"]
+
+    def invalidate_user(self, user_id: int):
+        """用戶文檔或索引變更後清除其所有緩存結果集"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry["user_id"] == user_id]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "depth": SEARCH_CACHE_DEPTH,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0
+            }
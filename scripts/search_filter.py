@@ -0,0 +1,74 @@
+"""
+檢索過濾條件
+按文件、文件類型和上傳時間範圍限定檢索範圍。建索引時把每個片段的屬性按索引位置保存成列，
+查詢時向量化地算出允許的位置，交給 FAISS 的 IDSelector 在搜索中跳過其餘向量，而不是取回 top_k 後再過濾
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+ATTRIBUTES_FILE = "attributes.npz"
+
+
+@dataclass
+class SearchFilter:
+    filenames: Optional[List[str]] = None  # 保存後的文件名（Document.filename）
+    file_types: Optional[List[str]] = None  # 擴展名，如 pdf、.docx
+    uploaded_after: Optional[float] = None  # Unix 時間戳，含邊界
+    uploaded_before: Optional[float] = None
+
+    def is_empty(self) -> bool:
+        return (self.filenames is None and self.file_types is None
+                and self.uploaded_after is None and self.uploaded_before is None)
+
+    def normalized_types(self) -> List[str]:
+        return ["." + file_type.lower().lstrip(".") for file_type in self.file_types or []]
+
+    def key(self) -> str:
+        """用於區分緩存結果集的過濾條件摘要"""
+        if self.is_empty():
+            return ""
+        return "|".join([
+            ",".join(sorted(self.filenames)) if self.filenames is not None else "*",
+            ",".join(sorted(self.normalized_types())) if self.file_types is not None else "*",
+            str(self.uploaded_after), str(self.uploaded_before)
+        ])
+
+
+def attribute_columns(metadata: List[dict]) -> Dict[str, np.ndarray]:
+    """按索引位置排列的片段屬性列；本功能上線前建立的索引沒有上傳時間，記為 NaN（時間過濾時不匹配）"""
+    return {
+        "filename": np.array([meta.get("filename", "") for meta in metadata], dtype=str),
+        "file_type": np.array([Path(meta.get("filename", "")).suffix.lower() for meta in metadata], dtype=str),
+        "uploaded_at": np.array([meta.get("uploaded_at", np.nan) for meta in metadata], dtype=np.float64)
+    }
+
+
+def save_attributes(path: Path, metadata: List[dict]):
+    np.savez(path, **attribute_columns(metadata))
+
+
+def load_attributes(path: Optional[Path], metadata: List[dict]) -> Dict[str, np.ndarray]:
+    """讀取建索引時保存的屬性列；path 為 None（共享池）或文件不存在（舊索引）時從元數據計算"""
+    if path is not None and path.exists():
+        with np.load(path) as columns:
+            return {name: columns[name] for name in columns.files}
+    return attribute_columns(metadata)
+
+
+def allowed_positions(search_filter: SearchFilter, columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """返回滿足所有條件的索引位置（升序 int64）"""
+    mask = np.ones(len(columns["filename"]), dtype=bool)
+    if search_filter.filenames is not None:
+        mask &= np.isin(columns["filename"], search_filter.filenames)
+    if search_filter.file_types is not None:
+        mask &= np.isin(columns["file_type"], search_filter.normalized_types())
+    uploaded_at = columns["uploaded_at"]
+    if search_filter.uploaded_after is not None:
+        mask &= uploaded_at >= search_filter.uploaded_after
+    if search_filter.uploaded_before is not None:
+        mask &= uploaded_at <= search_filter.uploaded_before
+    return np.flatnonzero(mask).astype(np.int64)
@@ -60,10 +60,7 @@ def main():
         import uvicorn
         
         # 簡化的 uvicorn 配置，適合容器環境
-        uvicorn.run(
-            app,
-            host=host,
-            port=port,
+        server_options = dict(
             log_level="info",
             access_log=True,
             timeout_keep_alive=120,
@@ -71,6 +68,18 @@ def main():
             # 移除可能導致問題的限制設置
         )
         
+        # WEB_CONCURRENCY > 1 時主進程先載入模型，再 fork worker 以寫時複製共享權重
+        workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+        if workers > 1 and hasattr(os, 'fork'):
+            from auth_api_server import initialize_kb_system, reset_after_fork
+            from prefork import serve_prefork
+            
+            log(f"🔀 預先 fork 模式: {workers} 個 worker")
+            serve_prefork(app, host, port, workers, preload=initialize_kb_system,
+                          after_fork=reset_after_fork, **server_options)
+        else:
+            uvicorn.run(app, host=host, port=port, **server_options)
+        
     except ImportError as e:
         log(f"❌ 導入錯誤: {e}")
         log("💡 可能原因：依賴包未正確安裝")
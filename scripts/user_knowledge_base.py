@@ -4,16 +4,67 @@
 """
 
 import os
+import time
 import logging
 import uuid
+import shutil
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
 from typing import List, Optional, Dict
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 import pickle
 
+try:
+    from scripts.embedding_backend import load_embedding_model
+    from scripts.scheduler import INTERACTIVE, BULK
+    from scripts.latency_budget import BudgetExceeded, LLM_TIMEOUT
+    from scripts.provider_health import get_provider_health, ProviderUnavailable, LLMCallError
+    from scripts.model_router import get_model_router, LLM_ROUTING_MODE
+    from scripts.context_builder import ContextBuilder, TokenCounter, split_sentences, join_sentences
+    from scripts.extractive_answer import ExtractiveAnswerer
+    from scripts.vector_index import (
+        create_compressed_index, write_vectors, open_vectors, rescore, read_manifest, write_manifest,
+        read_index, write_index, coarse_search, rescore_factor,
+        train_pca, apply_pca, save_pca, load_pca,
+        DocumentHierarchy, CentroidAccumulator, select_chunks, DOC_INDEX_FILE, HIERARCHY_FILE,
+        HIERARCHICAL_MIN_CHUNKS, HIERARCHICAL_TOP_DOCS, INDEX_SHARDS, SHARD_SEARCH_WORKERS, shard_of,
+        VECTOR_INDEX_TYPE, VECTOR_INDEX_TYPES, VECTOR_STORE_DTYPE, VECTORS_FILE,
+        VECTOR_PCA_DIM, VECTOR_PCA_PATH, PCA_MIN_TRAIN, PCA_FILE
+    )
+    from scripts.file_lock import file_lock
+    from scripts.search_filter import SearchFilter, save_attributes, load_attributes, allowed_positions, ATTRIBUTES_FILE
+    from scripts.pooled_index import PooledIndexes, POOLED_INDEX_MAX_DOCUMENTS, POOLED_INDEX_POOLS, POOLS_DIR
+    from scripts.lexical_index import (
+        build_lexical_index, search_lexical, reciprocal_rank_fusion,
+        RETRIEVAL_MODE, RETRIEVAL_MODES, HYBRID_CANDIDATE_MULTIPLIER, LEXICAL_INDEX_FILE
+    )
+except ImportError:
+    from embedding_backend import load_embedding_model
+    from scheduler import INTERACTIVE, BULK
+    from latency_budget import BudgetExceeded, LLM_TIMEOUT
+    from provider_health import get_provider_health, ProviderUnavailable, LLMCallError
+    from model_router import get_model_router, LLM_ROUTING_MODE
+    from context_builder import ContextBuilder, TokenCounter, split_sentences, join_sentences
+    from extractive_answer import ExtractiveAnswerer
+    from vector_index import (
+        create_compressed_index, write_vectors, open_vectors, rescore, read_manifest, write_manifest,
+        read_index, write_index, coarse_search, rescore_factor,
+        train_pca, apply_pca, save_pca, load_pca,
+        DocumentHierarchy, CentroidAccumulator, select_chunks, DOC_INDEX_FILE, HIERARCHY_FILE,
+        HIERARCHICAL_MIN_CHUNKS, HIERARCHICAL_TOP_DOCS, INDEX_SHARDS, SHARD_SEARCH_WORKERS, shard_of,
+        VECTOR_INDEX_TYPE, VECTOR_INDEX_TYPES, VECTOR_STORE_DTYPE, VECTORS_FILE,
+        VECTOR_PCA_DIM, VECTOR_PCA_PATH, PCA_MIN_TRAIN, PCA_FILE
+    )
+    from file_lock import file_lock
+    from search_filter import SearchFilter, save_attributes, load_attributes, allowed_positions, ATTRIBUTES_FILE
+    from pooled_index import PooledIndexes, POOLED_INDEX_MAX_DOCUMENTS, POOLED_INDEX_POOLS, POOLS_DIR
+    from lexical_index import (
+        build_lexical_index, search_lexical, reciprocal_rank_fusion,
+        RETRIEVAL_MODE, RETRIEVAL_MODES, HYBRID_CANDIDATE_MULTIPLIER, LEXICAL_INDEX_FILE
+    )
+
 # 載入環境變數
 load_dotenv()
 
@@ -21,13 +72,40 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SUPPORTED_FORMATS = ['.txt', '.md', '.pdf', '.docx', '.doc']
+
+# 用戶索引目錄中指向當前索引版本的文件；新版本在 gen_* 目錄中建好後替換此文件切換
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "gen_"
+# 用戶降級到共享池時在其獨立索引目錄寫入的標記；目錄保留給仍在讀取它的查詢，下一次寫入共享池時刪除
+RETIRED_FILE = "RETIRED"
+# 啟用降維時原始向量的臨時文件（訓練降維矩陣後逐批降維寫入索引，完成後刪除）
+RAW_VECTORS_TMP_FILE = "vectors_raw.npy.tmp"
+# 每個用戶一個建索引鎖文件（放在用戶索引目錄之外，刪除或遷移用戶目錄時鎖仍有效）
+INDEX_LOCKS_DIR = "locks"
+
+
+def _link_or_copy(src, dst):
+    """硬鏈接未變更的索引文件（索引文件寫入後不再原地修改），文件系統不支持時複製"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 class UserKnowledgeBaseSystem:
     """支持用戶隔離的企業知識庫系統"""
     
     def __init__(self, 
                  base_docs_folder: str = "user_documents",
                  base_index_path: str = "user_indexes",
-                 embed_model_name: str = os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-zh")):
+                 embed_model_name: str = os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-zh"),
+                 embedding_workers: int = int(os.getenv("EMBED_POOL_WORKERS", "0")),
+                 resource_manager=None,
+                 vector_index_type: str = VECTOR_INDEX_TYPE,
+                 pca_dimension: int = VECTOR_PCA_DIM,
+                 index_shards: int = INDEX_SHARDS,
+                 pooled_max_documents: int = POOLED_INDEX_MAX_DOCUMENTS):
         """
         初始化用戶知識庫系統
         
@@ -35,10 +113,17 @@ class UserKnowledgeBaseSystem:
             base_docs_folder: 用戶文檔基礎目錄
             base_index_path: 用戶索引基礎目錄
             embed_model_name: 嵌入模型名稱
+            embedding_workers: 建索引使用的嵌入進程數，大於 1 時啟用多進程嵌入池
+            resource_manager: CPU 資源管理器，設置後查詢嵌入、攝取和搜索分別在各自的工作池中執行
+            vector_index_type: flat / sq8 / pq / binary，壓縮索引查詢時從磁盤上的全精度向量精確重排候選
+            pca_dimension: 大於 0 時入庫和查詢前用 PCA 降到此維度（設置 VECTOR_PCA_PATH 時使用部署共用的降維矩陣）
+            index_shards: 大於 1 時每個用戶的索引按文件分成多個分片，並行檢索後合併，入庫只重建受影響的分片
+            pooled_max_documents: 大於 0 時文檔數不超過此值的用戶放入共享索引池，超過後升級為獨立索引
         """
         self.base_docs_folder = Path(base_docs_folder)
         self.base_index_path = Path(base_index_path)
         self.embed_model_name = embed_model_name
+        self.resource_manager = resource_manager
         
         # 創建基礎目錄
         self.base_docs_folder.mkdir(exist_ok=True)
@@ -46,14 +131,79 @@ class UserKnowledgeBaseSystem:
         
         # 初始化嵌入模型
         logger.info(f"載入嵌入模型: {embed_model_name}")
-        self.embed_model = SentenceTransformer(embed_model_name)
+        load_start = time.perf_counter()
+        self.embed_model = load_embedding_model(embed_model_name)
+        self.model_load_seconds = time.perf_counter() - load_start
+        logger.info(f"嵌入模型載入耗時 {self.model_load_seconds:.2f}s")
         
         # 模型維度
-        self.dimension = 768  # BGE 模型維度
+        self.dimension = self._detect_dimension()
+        logger.info(f"嵌入維度: {self.dimension}")
+        
+        if vector_index_type not in VECTOR_INDEX_TYPES:
+            logger.warning(f"未知的索引類型 {vector_index_type}，使用 flat")
+            vector_index_type = "flat"
+        self.vector_index_type = vector_index_type
+        
+        # PCA 降維：部署共用的降維矩陣優先，否則按用戶訓練
+        self.pca_dimension = pca_dimension
+        self.shared_pca = None
+        if VECTOR_PCA_PATH:
+            self.shared_pca = load_pca(Path(VECTOR_PCA_PATH))
+            if self.shared_pca.d_in != self.dimension:
+                raise ValueError(f"降維矩陣輸入維度 {self.shared_pca.d_in} 與嵌入維度 {self.dimension} 不一致")
+            logger.info(f"使用部署共用的 PCA 降維矩陣: {self.dimension} → {self.shared_pca.d_out}")
+        elif self.pca_dimension and not 0 < self.pca_dimension < self.dimension:
+            logger.warning(f"降維維度 {self.pca_dimension} 須在 1 到 {self.dimension - 1} 之間，不降維")
+            self.pca_dimension = 0
+        # faiss.PCAMatrix 的訓練向量數不能少於降維後維度
+        self.pca_min_train = max(PCA_MIN_TRAIN, self.pca_dimension)
+        if self.shared_pca is None and self.pca_min_train > PCA_MIN_TRAIN:
+            logger.warning(f"PCA_MIN_TRAIN={PCA_MIN_TRAIN} 小於降維維度，改為 {self.pca_min_train}")
+        
+        # 建索引時每批嵌入的文本數量，控制峰值記憶體
+        self.embed_batch_size = max(1, int(os.getenv("EMBED_BATCH_SIZE", "32")))
+        # 在工作池中攝取時每個調度任務的文本數，越小越能及時讓位給交互式查詢
+        self.ingest_slice_size = max(1, int(os.getenv("INGEST_SLICE_SIZE", "8")))
+        # 文檔切片的最大字符數（0 為整個文檔作為一個片段）和相鄰片段重疊的句子數
+        self.chunk_size = max(0, int(os.getenv("CHUNK_SIZE", "0")))
+        self.chunk_overlap = max(0, int(os.getenv("CHUNK_OVERLAP_SENTENCES", "1")))
+        
+        # 多進程嵌入池（僅用於建索引，查詢仍使用進程內模型）
+        self.embedding_pool = None
+        if embedding_workers > 1:
+            try:
+                from scripts.embedding_pool import EmbeddingPool
+            except ImportError:
+                from embedding_pool import EmbeddingPool
+            self.embedding_pool = EmbeddingPool(embed_model_name, embedding_workers)
+        
+        # 用戶索引分片數，以及並行檢索分片的線程池（首次使用時創建）
+        self.index_shards = max(1, index_shards)
+        self._shard_executor = None
+        
+        # 小用戶共享索引池（向量不降維，與查詢嵌入維度一致）
+        self.pooled_max_documents = max(0, pooled_max_documents)
+        self.pooled_indexes = None
+        if self.pooled_max_documents:
+            self.pooled_indexes = PooledIndexes(self.base_index_path / POOLS_DIR, self.dimension, POOLED_INDEX_POOLS)
+        
+        # 上下文打包使用的 token 計數器
+        self.token_counter = TokenCounter()
         
         # 用戶會話緩存
         self.user_sessions = {}
         
+    def _detect_dimension(self) -> int:
+        """從嵌入模型讀取向量維度，不支持時嵌入一條探測文本"""
+        try:
+            dimension = self.embed_model.get_sentence_embedding_dimension()
+            if dimension:
+                return int(dimension)
+        except AttributeError:
+            pass
+        return int(self._encode_texts(["dimension probe"]).shape[1])
+    
     def get_user_docs_folder(self, user_id: int) -> Path:
         """獲取用戶文檔目錄"""
         user_folder = self.base_docs_folder / f"user_{user_id}"
@@ -132,17 +282,24 @@ class UserKnowledgeBaseSystem:
             logger.error(f"文本提取失敗 {file_path}: {e}")
             return ""
     
-    def load_user_documents(self, user_id: int) -> List[Dict]:
-        """載入用戶文檔"""
+    def load_user_documents(self, user_id: int, include=None) -> List[Dict]:
+        """
+        載入用戶文檔
+        
+        Args:
+            include: include(文件名) 返回 False 的文件不載入（只重建部分分片時使用）
+        """
         user_docs_folder = self.get_user_docs_folder(user_id)
         documents = []
         metadata = []
         
         # 支持的文件格式
-        supported_formats = ['.txt', '.md', '.pdf', '.docx', '.doc']
+        supported_formats = SUPPORTED_FORMATS
         
         for file_path in user_docs_folder.glob("**/*"):
             if file_path.is_file() and file_path.suffix.lower() in supported_formats:
+                if include is not None and not include(file_path.name):
+                    continue
                 try:
                     content = self.extract_text_from_file(file_path)
                     if content.strip():  # 確保提取到內容
@@ -151,6 +308,7 @@ class UserKnowledgeBaseSystem:
                             'filename': file_path.name,
                             'path': str(file_path),
                             'size': len(content),
+                            'uploaded_at': file_path.stat().st_mtime,
                             'user_id': user_id
                         })
                         logger.info(f"載入用戶 {user_id} 文檔: {file_path.name}")
@@ -161,44 +319,461 @@ class UserKnowledgeBaseSystem:
         
         return documents, metadata
     
-    def build_user_index(self, user_id: int):
-        """為特定用戶建立向量索引"""
+    def _chunk_text(self, text: str) -> List[str]:
+        """按句子把文本打包成不超過 chunk_size 字符的片段，相鄰片段重疊 chunk_overlap 句"""
+        if not self.chunk_size or len(text) <= self.chunk_size:
+            return [text]
+        
+        sentences = []
+        for sentence in split_sentences(text):
+            # 超長句子按字符硬切
+            sentences.extend(sentence[i:i + self.chunk_size] for i in range(0, len(sentence), self.chunk_size))
+        
+        chunks, current = [], []
+        for sentence in sentences:
+            if current and len(join_sentences(current + [sentence])) > self.chunk_size:
+                chunks.append(join_sentences(current))
+                current = current[-self.chunk_overlap:] if self.chunk_overlap else []
+                if current and len(join_sentences(current + [sentence])) > self.chunk_size:
+                    current = []
+            current.append(sentence)
+        if current:
+            chunks.append(join_sentences(current))
+        return chunks
+    
+    def _chunk_documents(self, documents: List[str], metadata: List[dict]) -> tuple:
+        """切片並在元數據中記錄所屬文檔（doc_id）和片段序號（chunk）"""
+        chunks, chunk_metadata = [], []
+        for doc_id, (text, meta) in enumerate(zip(documents, metadata)):
+            for position, chunk in enumerate(self._chunk_text(text)):
+                chunks.append(chunk)
+                chunk_metadata.append(dict(meta, doc_id=doc_id, chunk=position))
+        return chunks, chunk_metadata
+    
+    def build_user_index(self, user_id: int, changed_files: Optional[List[str]] = None):
+        """
+        為特定用戶建立向量索引
+        
+        同一用戶的建索引在線程和 prefork worker 之間串行：後開始的建索引在鎖內重新讀取文檔目錄，
+        不會被先開始、後完成的建索引覆蓋
+        
+        Args:
+            changed_files: 新增或刪除的文件名；分片索引只重建這些文件所在的分片，None 時全部重建
+        """
+        with self._index_lock(user_id):
+            return self._build_user_index(user_id, changed_files)
+    
+    def _index_lock(self, user_id: int):
+        return file_lock(self.base_index_path / INDEX_LOCKS_DIR / f"user_{user_id}.lock")
+    
+    def _build_user_index(self, user_id: int, changed_files: Optional[List[str]]) -> bool:
+        if self.pooled_indexes is not None:
+            pool = self.pooled_indexes.pool_for(user_id)
+            if self._count_user_documents(user_id) <= self.pooled_max_documents:
+                return self._build_pooled_index(user_id, pool)
+            if pool.has_user(user_id, fresh=True):
+                # 超過共享池上限：先建立完整的獨立索引，再從池中移除
+                logger.info(f"用戶 {user_id} 文檔數超過 {self.pooled_max_documents}，升級為獨立索引")
+                built = self._build_dedicated_index(user_id, None)
+                pool.remove_user(user_id)
+                return built
+        return self._build_dedicated_index(user_id, changed_files)
+    
+    def _count_user_documents(self, user_id: int) -> int:
+        return sum(1 for file_path in self.get_user_docs_folder(user_id).glob("*")
+                   if file_path.is_file() and file_path.suffix.lower() in SUPPORTED_FORMATS)
+    
+    def _build_pooled_index(self, user_id: int, pool) -> bool:
+        """把小用戶的全部文檔寫入共享池，並撤下其獨立索引目錄"""
         documents, metadata = self.load_user_documents(user_id)
+        documents, metadata = self._chunk_documents(documents, metadata)
+        embeddings = None
+        if documents:
+            start_time = time.time()
+            embeddings = np.vstack(list(self._iter_embedding_batches(documents, tenant=user_id)))
+            logger.info(f"用戶 {user_id} 嵌入完成: {len(documents)} 個片段, 耗時 {time.time() - start_time:.2f}s")
+        pool.replace_user(user_id, embeddings, documents, metadata)
+        
+        self._retire_dedicated_index(self.base_index_path / f"user_{user_id}")
         
         if not documents:
             logger.warning(f"用戶 {user_id} 沒有文檔可建立索引")
             return False
+        logger.info(f"用戶 {user_id} 已寫入共享索引池 {pool.path.name}，包含 {len(documents)} 個片段")
+        return True
+    
+    def _retire_dedicated_index(self, user_index_path: Path):
+        """
+        用戶已寫入共享池後撤下獨立索引：首次只寫入 RETIRED 標記，其他 worker 在看到新池版本之前
+        仍可讀取完整的舊索引；已有標記（上一次寫入共享池時撤下）的目錄刪除。重新升級為獨立索引時
+        _activate_generation 會清除標記
+        """
+        if not user_index_path.exists():
+            return
+        if (user_index_path / RETIRED_FILE).exists():
+            shutil.rmtree(user_index_path, ignore_errors=True)
+        else:
+            (user_index_path / RETIRED_FILE).touch()
+    
+    def _build_dedicated_index(self, user_id: int, changed_files: Optional[List[str]]) -> bool:
+        """建立用戶獨立的索引目錄（未分片或按 INDEX_SHARDS 分片）"""
+        user_index_path = self.get_user_index_path(user_id)
+        if self.index_shards <= 1:
+            documents, metadata = self.load_user_documents(user_id)
+            if not documents:
+                logger.warning(f"用戶 {user_id} 沒有文檔可建立索引")
+                return False
+            # 寫入新版本目錄後一次切換，查詢不會讀到新舊文件混合的索引
+            generation = self._new_generation(user_index_path)
+            try:
+                self._build_index_dir(user_id, generation, documents, metadata)
+            except Exception:
+                shutil.rmtree(generation, ignore_errors=True)
+                raise
+            self._activate_generation(user_index_path, generation)
+            return True
+        
+        shards = self.index_shards
+        current = self._active_index_path(user_id)
+        current_manifest = read_manifest(current)
+        # 所有分片共用同一降維矩陣，分數才能跨分片比較：降維設置未變時增量重建沿用當前版本的矩陣，否則全部重建
+        reuse = (current_manifest.get("shards") == shards
+                 and current_manifest.get("pca_config", 0) == self._pca_config())
+        targets = set(range(shards))
+        if changed_files and reuse:
+            targets = {shard_of(filename, shards) for filename in changed_files}
         
+        documents, metadata = self.load_user_documents(
+            user_id, include=lambda filename: shard_of(filename, shards) in targets
+        )
+        # 所有分片寫入新版本目錄，寫完後一次切換；重建期間的查詢繼續使用當前版本
+        generation = self._new_generation(user_index_path)
+        try:
+            prepared = {}
+            for shard in range(shards):
+                shard_path = generation / f"shard_{shard}"
+                if shard not in targets:
+                    # 未變更的分片硬鏈接到新版本，不重新嵌入
+                    if (current / shard_path.name).is_dir():
+                        shutil.copytree(current / shard_path.name, shard_path, copy_function=_link_or_copy)
+                    else:
+                        shard_path.mkdir()
+                    continue
+                shard_path.mkdir()
+                members = [i for i, meta in enumerate(metadata) if shard_of(meta['filename'], shards) == shard]
+                if members:
+                    logger.info(f"重建用戶 {user_id} 分片 {shard}: {len(members)} 個文檔")
+                    prepared[shard] = self._prepare_chunks([documents[i] for i in members],
+                                                           [metadata[i] for i in members])
+            
+            pca, raw_vectors = None, {}
+            if self._pca_config():
+                # 先寫出各分片的原始向量：全量重建時在用戶全部片段上訓練一次降維矩陣；
+                # 增量重建沿用當前版本的決定（片段數此後才達到 PCA_MIN_TRAIN 的用戶在下次全量重建時開始降維）
+                raw_vectors = {shard: self._write_raw_vectors(user_id, generation / f"shard_{shard}", chunks)
+                               for shard, (_, chunks, _) in prepared.items()}
+                if targets == set(range(shards)):
+                    pca = self._train_pca(user_id, list(raw_vectors.values()))
+                elif self.shared_pca is not None:
+                    pca = self.shared_pca
+                elif current_manifest.get("pca"):
+                    pca = load_pca(current / PCA_FILE)
+                if pca is not None:
+                    save_pca(pca, generation / PCA_FILE)
+            
+            for shard, (document_count, chunks, chunk_metadata) in prepared.items():
+                self._write_index_dir(user_id, generation / f"shard_{shard}", document_count, chunks, chunk_metadata,
+                                      raw_vectors.get(shard), pca)
+            write_manifest(generation, {"shards": shards, "pca": pca is not None, "pca_config": self._pca_config()})
+        except Exception:
+            shutil.rmtree(generation, ignore_errors=True)
+            raise
+        self._activate_generation(user_index_path, generation)
+        
+        built = self._index_dirs(user_id)
+        if not built:
+            logger.warning(f"用戶 {user_id} 沒有文檔可建立索引")
+        return bool(built)
+    
+    def _active_index_path(self, user_id: int) -> Path:
+        """當前索引版本的目錄；沒有 CURRENT 文件時（單一索引或舊佈局）為用戶索引目錄本身"""
+        user_index_path = self.base_index_path / f"user_{user_id}"
+        try:
+            return user_index_path / (user_index_path / CURRENT_FILE).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return user_index_path
+    
+    def index_version(self, user_id: int) -> str:
+        """
+        用戶當前索引的版本標識，任何 worker 重建索引後改變；用於使其他 worker 中的檢索結果緩存失效
+        （共享池中的用戶為池的版本，池內任一用戶更新都會改變）
+        """
+        if self.pooled_indexes is not None:
+            pool = self.pooled_indexes.pool_for(user_id)
+            if pool.has_user(user_id):
+                return f"{pool.path.name}/{pool.generation}"
+        return self._active_index_path(user_id).name
+    
+    def _new_generation(self, user_index_path: Path) -> Path:
+        generation = user_index_path / f"{GENERATION_PREFIX}{uuid.uuid4().hex}"
+        generation.mkdir()
+        return generation
+    
+    def _activate_generation(self, user_index_path: Path, generation: Path):
+        """
+        原子地把 CURRENT 指向新版本；上一版本保留給仍在載入它的查詢，更早的版本和舊佈局的文件刪除
+        """
+        previous = (user_index_path / CURRENT_FILE).read_text(encoding="utf-8").strip() \
+            if (user_index_path / CURRENT_FILE).exists() else None
+        pointer_tmp = user_index_path / f"{CURRENT_FILE}.{generation.name}.tmp"
+        pointer_tmp.write_text(generation.name, encoding="utf-8")
+        os.replace(pointer_tmp, user_index_path / CURRENT_FILE)
+        
+        for path in user_index_path.iterdir():
+            if path.name in (CURRENT_FILE, generation.name, previous):
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+    
+    def _build_index_dir(self, user_id: int, user_index_path: Path, documents: List[str], metadata: List[dict]):
+        """在未分片的用戶索引目錄建立向量索引、全文索引和元數據；啟用降維時在本目錄的片段上訓練降維矩陣"""
+        document_count, documents, metadata = self._prepare_chunks(documents, metadata)
+        raw_vectors, pca = None, None
+        if self._pca_config():
+            raw_vectors = self._write_raw_vectors(user_id, user_index_path, documents)
+            pca = self._train_pca(user_id, [raw_vectors])
+        self._write_index_dir(user_id, user_index_path, document_count, documents, metadata, raw_vectors, pca)
+    
+    def _prepare_chunks(self, documents: List[str], metadata: List[dict]) -> tuple:
+        """
+        切片並按文本長度排序，讓同一批次長度相近以減少 padding；
+        元數據和文檔按相同順序保存，保證與索引位置一致
+        
+        Returns:
+            (文檔數, 片段, 片段元數據)
+        """
+        document_count = len(documents)
+        documents, metadata = self._chunk_documents(documents, metadata)
+        order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        return document_count, [documents[i] for i in order], [metadata[i] for i in order]
+    
+    def _pca_config(self):
+        """當前的降維設置，記錄在分片索引的版本描述中；0 為不降維"""
+        if self.shared_pca is not None:
+            return f"shared:{VECTOR_PCA_PATH}"
+        return self.pca_dimension
+    
+    def _write_raw_vectors(self, user_id: int, user_index_path: Path, documents: List[str]) -> np.ndarray:
+        """降維前先把原始向量寫入臨時文件：降維矩陣要在全部向量上訓練後才能使用"""
+        return write_vectors(user_index_path / RAW_VECTORS_TMP_FILE, self._iter_embedding_batches(documents, tenant=user_id),
+                             len(documents), self.dimension, dtype="float32")
+    
+    def _train_pca(self, user_id: int, raw_vectors: List[np.ndarray]):
+        """部署共用的降維矩陣優先；否則片段數達到 pca_min_train 時在這些向量上訓練，不足時不降維"""
+        if self.shared_pca is not None:
+            return self.shared_pca
+        count = sum(len(vectors) for vectors in raw_vectors)
+        if count < self.pca_min_train:
+            logger.info(f"用戶 {user_id} 只有 {count} 個片段，不足 {self.pca_min_train}，不降維")
+            return None
+        return train_pca(raw_vectors, self.pca_dimension)
+    
+    def _write_index_dir(self, user_id: int, user_index_path: Path, document_count: int, documents: List[str],
+                         metadata: List[dict], raw_vectors: Optional[np.ndarray], pca):
+        """
+        在指定目錄（用戶索引目錄或其中一個分片）建立向量索引、全文索引和元數據
+        
+        documents 和 metadata 為 _prepare_chunks 排序後的片段；raw_vectors 為已寫出的原始向量（啟用降維時），
+        pca 為這些向量使用的降維矩陣（None 為不降維）
+        """
         logger.info(f"開始為用戶 {user_id} 建立向量索引...")
         
-        # 生成文檔嵌入向量
-        embeddings = self.embed_model.encode(documents)
-        embeddings = np.array(embeddings).astype('float32')
+        vectors_file = user_index_path / VECTORS_FILE
+        index_type = self.vector_index_type
+        
+        # 創建 FAISS 索引，逐批嵌入並追加，避免一次性持有整個語料的向量
+        start_time = time.time()
+        dimension = self.dimension
+        if raw_vectors is None:
+            batches = self._iter_embedding_batches(documents, tenant=user_id)
+        else:
+            if pca is not None:
+                dimension = pca.d_out
+            batches = (
+                apply_pca(pca, raw_vectors[start:start + self.embed_batch_size]) if pca is not None
+                else np.asarray(raw_vectors[start:start + self.embed_batch_size])
+                for start in range(0, len(documents), self.embed_batch_size)
+            )
+        
+        # 片段遠多於文檔時累加每個文檔的片段向量，建立文檔級索引做兩級檢索；
+        # 文檔數不超過第一級保留的文檔數時第一級不會篩掉任何文檔，不建立
+        accumulator = None
+        if (HIERARCHICAL_MIN_CHUNKS and len(documents) >= HIERARCHICAL_MIN_CHUNKS
+                and HIERARCHICAL_TOP_DOCS < document_count < len(documents)):
+            chunk_docs = np.array([meta['doc_id'] for meta in metadata], dtype=np.int64)
+            accumulator = CentroidAccumulator(chunk_docs, dimension)
+            batches = accumulator.wrap(batches)
         
-        # 創建 FAISS 索引
-        faiss_index = faiss.IndexFlatIP(self.dimension)
-        faiss_index.add(embeddings)
+        if index_type == "flat":
+            faiss_index = faiss.IndexFlatIP(dimension)
+            for embeddings in batches:
+                faiss_index.add(embeddings)
+        else:
+            # 壓縮索引：全精度向量先逐批寫入磁盤，再從中採樣訓練量化器並分批添加
+            tmp_vectors_file = user_index_path / (VECTORS_FILE + ".tmp")
+            vectors = write_vectors(tmp_vectors_file, batches, len(documents), dimension)
+            faiss_index, index_type = create_compressed_index(index_type, vectors)
+            del vectors
+        (user_index_path / RAW_VECTORS_TMP_FILE).unlink(missing_ok=True)
+        
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(
+            f"用戶 {user_id} 嵌入完成: {len(documents)} 個片段, "
+            f"耗時 {elapsed:.2f}s, {len(documents) / elapsed:.1f} chunks/s"
+        )
         
         # 保存索引和元數據
-        user_index_path = self.get_user_index_path(user_id)
         index_file = user_index_path / "faiss.index"
         metadata_file = user_index_path / "metadata.pkl"
         documents_file = user_index_path / "documents.pkl"
         
-        faiss.write_index(faiss_index, str(index_file))
+        write_index(faiss_index, index_file, index_type)
+        if index_type == "flat":
+            vectors_file.unlink(missing_ok=True)
+        else:
+            os.replace(tmp_vectors_file, vectors_file)
+        if pca is not None:
+            save_pca(pca, user_index_path / PCA_FILE)
+        else:
+            (user_index_path / PCA_FILE).unlink(missing_ok=True)
+        if accumulator is not None:
+            faiss.write_index(accumulator.build_index(), str(user_index_path / DOC_INDEX_FILE))
+            DocumentHierarchy(accumulator.chunk_docs).save(user_index_path / HIERARCHY_FILE)
+        else:
+            (user_index_path / DOC_INDEX_FILE).unlink(missing_ok=True)
+            (user_index_path / HIERARCHY_FILE).unlink(missing_ok=True)
+        write_manifest(user_index_path, {
+            "type": index_type,
+            "dimension": dimension,
+            "input_dimension": self.dimension,
+            "pca": pca is not None,
+            "hierarchical": accumulator is not None,
+            "documents": document_count,
+            "count": len(documents),
+            "vector_dtype": VECTOR_STORE_DTYPE if index_type != "flat" else None,
+            "index_bytes": index_file.stat().st_size
+        })
         
         with open(metadata_file, 'wb') as f:
             pickle.dump(metadata, f)
         
         with open(documents_file, 'wb') as f:
             pickle.dump(documents, f)
+        save_attributes(user_index_path / ATTRIBUTES_FILE, metadata)
+        
+        # 全文索引與向量索引使用相同的文檔順序
+        lexical_start = time.time()
+        build_lexical_index(user_index_path / LEXICAL_INDEX_FILE, documents)
+        logger.info(f"用戶 {user_id} 全文索引建立完成，耗時 {time.time() - lexical_start:.2f}s")
         
         logger.info(f"用戶 {user_id} 索引建立完成，包含 {len(documents)} 個文檔")
-        return True
+    
+    def _iter_embedding_batches(self, texts: List[str], tenant=None):
+        """按 embed_batch_size 分批生成 float32 嵌入向量"""
+        if self.embedding_pool is not None:
+            # 分片到多個進程並按原順序產出
+            yield from self.embedding_pool.iter_encode(texts, batch_size=self.embed_batch_size)
+            return
+        
+        # 由工作池調度時切成小片，以批量優先級逐片提交
+        step = self.ingest_slice_size if self._pool("ingest") is not None else self.embed_batch_size
+        for start in range(0, len(texts), step):
+            batch = texts[start:start + step]
+            yield self._run_in_pool("ingest", self._encode_texts, batch, priority=BULK, tenant=tenant)
+    
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        """嵌入一批文本，返回 float32 矩陣"""
+        embeddings = self.embed_model.encode(
+            texts,
+            batch_size=len(texts),
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        # encode 已返回 float32 ndarray 時不會再複製
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    
+    def _pool(self, pool_name: str):
+        return self.resource_manager.pool(pool_name) if self.resource_manager is not None else None
+    
+    def _run_in_pool(self, pool_name: str, fn, *args, priority: int = INTERACTIVE, tenant=None,
+                     timeout: Optional[float] = None):
+        """
+        在資源管理器的指定工作池中按優先級執行，未配置時直接在當前線程執行
+        
+        timeout 限制從提交到完成的總時間（排隊等待加執行），超時拋出 concurrent.futures.TimeoutError；
+        仍在排隊的任務隨之取消，已開始執行的任務會繼續運行到結束，結果被丟棄
+        """
+        pool = self._pool(pool_name)
+        if pool is None:
+            return fn(*args)
+        future = pool.schedule(fn, args, priority=priority, tenant=tenant)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+    
+    def _run_stage(self, deadline, stage: str, pool_name: str, fn, *args, tenant=None):
+        """在工作池中執行查詢的一個階段，並按延遲預算檢查和計時"""
+        if deadline is None:
+            return self._run_in_pool(pool_name, fn, *args, tenant=tenant)
+        
+        deadline.check(stage)
+        try:
+            result = self._run_in_pool(pool_name, fn, *args, tenant=tenant, timeout=deadline.timeout())
+        except FutureTimeoutError:
+            raise BudgetExceeded(stage, deadline)
+        deadline.mark(stage)
+        return result
+    
+    def rebuild_all_user_indexes(self) -> Dict[int, bool]:
+        """重建所有用戶的索引（用於模型升級或大批量重新索引）"""
+        results = {}
+        start_time = time.time()
+        
+        for user_folder in sorted(self.base_docs_folder.glob("user_*")):
+            if not user_folder.is_dir():
+                continue
+            try:
+                user_id = int(user_folder.name.split("_", 1)[1])
+            except ValueError:
+                continue
+            
+            try:
+                results[user_id] = self.build_user_index(user_id)
+            except Exception as e:
+                logger.error(f"重建用戶 {user_id} 索引失敗: {e}")
+                results[user_id] = False
+        
+        logger.info(f"重建 {len(results)} 個用戶索引完成，耗時 {time.time() - start_time:.2f}s")
+        return results
+    
+    def close(self):
+        """釋放嵌入進程池等資源"""
+        if self.embedding_pool is not None:
+            self.embedding_pool.close()
+            self.embedding_pool = None
+        if self._shard_executor is not None:
+            self._shard_executor.shutdown(wait=False)
+            self._shard_executor = None
     
     def load_user_index(self, user_id: int) -> tuple:
-        """載入用戶的索引"""
-        user_index_path = self.get_user_index_path(user_id)
+        """載入用戶的索引（未分片）"""
+        return self._load_index_dir(user_id, self._active_index_path(user_id))
+    
+    def _load_index_dir(self, user_id: int, user_index_path: Path) -> tuple:
         index_file = user_index_path / "faiss.index"
         metadata_file = user_index_path / "metadata.pkl"
         documents_file = user_index_path / "documents.pkl"
@@ -207,38 +782,324 @@ class UserKnowledgeBaseSystem:
             return None, None, None
         
         try:
-            faiss_index = faiss.read_index(str(index_file))
-            
-            with open(metadata_file, 'rb') as f:
-                metadata = pickle.load(f)
-            
-            with open(documents_file, 'rb') as f:
-                documents = pickle.load(f)
+            faiss_index = read_index(index_file, read_manifest(user_index_path)["type"])
+            documents, metadata = self._load_corpus(user_index_path)
             
-            logger.info(f"載入用戶 {user_id} 索引成功")
+            logger.info(f"載入用戶 {user_id} 索引成功: {user_index_path.name}")
             return faiss_index, documents, metadata
         except Exception as e:
             logger.error(f"載入用戶 {user_id} 索引失敗: {e}")
             return None, None, None
     
-    def search_user_documents(self, user_id: int, query: str, top_k: int = 5) -> List[dict]:
-        """搜索用戶的相關文檔"""
-        faiss_index, documents, metadata = self.load_user_index(user_id)
+    def _load_corpus(self, user_index_path: Path) -> tuple:
+        """載入與索引位置對應的文檔全文和元數據"""
+        with open(user_index_path / "metadata.pkl", 'rb') as f:
+            metadata = pickle.load(f)
+        
+        with open(user_index_path / "documents.pkl", 'rb') as f:
+            documents = pickle.load(f)
+        
+        return documents, metadata
+    
+    def search_user_documents(self, user_id: int, query: str, top_k: int = 5, deadline=None,
+                              with_text: bool = False, retrieval: Optional[str] = None,
+                              filters: Optional[SearchFilter] = None) -> List[dict]:
+        """
+        搜索用戶的相關文檔
+        
+        Args:
+            deadline: 延遲預算（latency_budget.Deadline），各階段前檢查，耗盡時拋出 BudgetExceeded
+            with_text: 結果中附帶未截斷的全文（text 字段），用於構建 LLM 上下文
+            retrieval: vector / lexical / hybrid，默認讀取 RETRIEVAL_MODE
+            filters: 只在指定文件、文件類型或上傳時間範圍內檢索
+        """
+        return self.search_user_documents_batch(user_id, [query], top_k, deadline, with_text, retrieval, filters)[0]
+    
+    def search_user_documents_batch(self, user_id: int, queries: List[str], top_k: int = 5, deadline=None,
+                                    with_text: bool = False, retrieval: Optional[str] = None,
+                                    filters: Optional[SearchFilter] = None) -> List[List[dict]]:
+        """
+        批量搜索：索引只載入一次，所有查詢一次嵌入成矩陣，再用一次 faiss_index.search 檢索
+        
+        lexical 模式只查全文索引，不載入向量索引也不做查詢嵌入；hybrid 模式兩路各召回
+        top_k * HYBRID_CANDIDATE_MULTIPLIER 個結果後按倒數排名融合。
+        分片索引只嵌入一次查詢，各分片在線程池中並行檢索後合併前 top_k。
+        filters 在檢索前編譯成允許的索引位置，由 IDSelector 在搜索中跳過其他片段（所有查詢共用）
+        
+        Returns:
+            與 queries 順序對應的結果列表，每項格式同 search_user_documents
+        """
+        mode = (retrieval or RETRIEVAL_MODE).lower()
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"不支持的檢索方式: {mode}，可選 {', '.join(RETRIEVAL_MODES)}")
+        if filters is not None and filters.is_empty():
+            filters = None
+        
+        if self.pooled_indexes is not None:
+            pool = self.pooled_indexes.pool_for(user_id)
+            if pool.has_user(user_id):
+                return self._search_pooled(user_id, pool, queries, top_k, deadline, with_text, mode, filters)
+        
+        index_dirs = self._index_dirs(user_id, filters)
+        if not index_dirs:
+            if filters is None:
+                logger.error(f"用戶 {user_id} 索引未建立")
+            return [[] for _ in queries]
+        if len(index_dirs) == 1:
+            return self._search_index_dir(user_id, index_dirs[0], queries, top_k, deadline, with_text, mode,
+                                          filters=filters)
+        
+        query_embeddings = None
+        if mode != "lexical":
+            query_embeddings = self._run_stage(
+                deadline, "embedding", "query", self._encode_texts, list(queries), tenant=user_id
+            )
+        
+        # 分片檢索任務在專用線程池中並行，其中的 FAISS 搜索仍提交到搜索池，CPU 使用受分區限制
+        if self._shard_executor is None:
+            self._shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix="shard")
+        if deadline is not None:
+            deadline.check("search")
+        futures = [
+            self._shard_executor.submit(self._search_index_dir, user_id, path, queries, top_k, None, with_text,
+                                        mode, query_embeddings, filters)
+            for path in index_dirs
+        ]
+        try:
+            per_shard = [future.result(timeout=deadline.timeout() if deadline is not None else None)
+                         for future in futures]
+        except FutureTimeoutError:
+            raise BudgetExceeded("search", deadline)
+        if deadline is not None:
+            deadline.mark("search")
+        return self._merge_shard_results(per_shard, len(queries), top_k)
+    
+    def _search_pooled(self, user_id: int, pool, queries: List[str], top_k: int, deadline, with_text: bool,
+                       mode: str, filters: Optional[SearchFilter] = None) -> List[List[dict]]:
+        """在共享池中只檢索該用戶的片段；池常駐記憶體，沒有載入索引的階段"""
+        documents, metadata = pool.corpus(user_id)
+        candidates = top_k * HYBRID_CANDIDATE_MULTIPLIER if mode == "hybrid" else top_k
+        allowed = self._filter_positions(user_index_path=None, metadata=metadata, filters=filters, deadline=deadline)
+        if allowed is not None and not len(allowed):
+            return [[] for _ in queries]
+        
+        lexical_hits = None
+        if mode != "vector":
+            lexical_hits = self._run_stage(
+                deadline, "lexical", "search", pool.search_lexical, user_id, list(queries), candidates, allowed,
+                tenant=user_id
+            )
+        if mode == "lexical":
+            return [
+                self._format_results(user_id, [score for _, score in hits], [position for position, _ in hits],
+                                     documents, metadata, with_text)
+                for hits in lexical_hits
+            ]
+        
+        query_embeddings = self._run_stage(
+            deadline, "embedding", "query", self._encode_texts, list(queries), tenant=user_id
+        )
+        scores, indices = self._run_stage(
+            deadline, "search", "search", pool.search, user_id, query_embeddings, candidates, allowed, tenant=user_id
+        )
+        if mode == "vector":
+            return [
+                self._format_results(user_id, row_scores, row_indices, documents, metadata, with_text)
+                for row_scores, row_indices in zip(scores, indices)
+            ]
+        
+        results = []
+        for row_indices, hits in zip(indices, lexical_hits):
+            fused = reciprocal_rank_fusion({
+                "vector": [int(idx) for idx in row_indices if idx >= 0],
+                "lexical": [position for position, _ in hits]
+            }, top_k)
+            results.append(self._format_results(
+                user_id, [score for _, score in fused], [position for position, _ in fused],
+                documents, metadata, with_text
+            ))
+        if deadline is not None:
+            deadline.mark("fusion")
+        return results
+    
+    def _index_dirs(self, user_id: int, filters: Optional[SearchFilter] = None) -> List[Path]:
+        """
+        用戶的索引目錄：未分片時為用戶索引目錄本身，分片時為已建立索引的各分片目錄
+        （按文件過濾時只返回這些文件所在的分片）
+        """
+        user_index_path = self._active_index_path(user_id)
+        shards = read_manifest(user_index_path).get("shards")
+        if not shards:
+            return [user_index_path] if (user_index_path / "documents.pkl").exists() else []
+        selected = range(shards)
+        if filters is not None and filters.filenames is not None:
+            selected = sorted({shard_of(filename, shards) for filename in filters.filenames})
+        return [path for path in (user_index_path / f"shard_{shard}" for shard in selected)
+                if (path / "documents.pkl").exists()]
+    
+    def _filter_positions(self, user_index_path: Optional[Path], metadata: List[dict],
+                          filters: Optional[SearchFilter], deadline=None) -> Optional[np.ndarray]:
+        """把過濾條件編譯成允許的索引位置；沒有過濾條件時返回 None"""
+        if filters is None:
+            return None
+        attributes_file = user_index_path / ATTRIBUTES_FILE if user_index_path is not None else None
+        allowed = allowed_positions(filters, load_attributes(attributes_file, metadata))
+        if deadline is not None:
+            deadline.mark("filter")
+        return allowed
+    
+    def _merge_shard_results(self, per_shard: List[List[List[dict]]], query_count: int, top_k: int) -> List[List[dict]]:
+        """
+        把各分片的前 top_k 排成 (查詢, 分片 × top_k) 的分數矩陣，一次 argsort 取出合併後的前 top_k
+        
+        各分片使用同一版本目錄中訓練的降維矩陣，向量分數可直接比較；
+        lexical / hybrid 的分數（BM25、RRF）在各分片內計算，跨分片合併是近似排序
+        """
+        scores = np.full((query_count, len(per_shard), top_k), -np.inf, dtype=np.float32)
+        for shard, shard_results in enumerate(per_shard):
+            for row, results in enumerate(shard_results):
+                scores[row, shard, :len(results)] = [result['score'] for result in results[:top_k]]
+        
+        order = np.argsort(-scores.reshape(query_count, -1), axis=1, kind="stable")[:, :top_k]
+        merged = []
+        for row in range(query_count):
+            results = []
+            for position in order[row]:
+                shard, offset = divmod(int(position), top_k)
+                if not np.isfinite(scores[row, shard, offset]):
+                    break
+                results.append(dict(per_shard[shard][row][offset], rank=len(results) + 1))
+            merged.append(results)
+        return merged
+    
+    def _search_index_dir(self, user_id: int, user_index_path: Path, queries: List[str], top_k: int, deadline,
+                          with_text: bool, mode: str, query_embeddings: Optional[np.ndarray] = None,
+                          filters: Optional[SearchFilter] = None) -> List[List[dict]]:
+        """在單個索引目錄（用戶索引或一個分片）中檢索；傳入 query_embeddings 時不再嵌入查詢"""
+        lexical_path = user_index_path / LEXICAL_INDEX_FILE
+        if mode != "vector" and not lexical_path.exists():
+            # 本功能上線前建立的索引沒有全文索引，重建索引後可用
+            logger.warning(f"用戶 {user_id} 全文索引未建立，改用向量檢索")
+            mode = "vector"
+        
+        if mode == "lexical":
+            try:
+                documents, metadata = self._load_corpus(user_index_path)
+            except (OSError, pickle.UnpicklingError) as e:
+                logger.error(f"用戶 {user_id} 索引未建立: {e}")
+                return [[] for _ in queries]
+            if deadline is not None:
+                deadline.mark("load_index")
+            allowed = self._filter_positions(user_index_path, metadata, filters, deadline)
+            if allowed is not None and not len(allowed):
+                return [[] for _ in queries]
+            
+            lexical_hits = self._run_stage(
+                deadline, "lexical", "search", search_lexical, lexical_path, list(queries), top_k, None,
+                allowed.tolist() if allowed is not None else None, tenant=user_id
+            )
+            return [
+                self._format_results(user_id, [score for _, score in hits], [position for position, _ in hits],
+                                     documents, metadata, with_text)
+                for hits in lexical_hits
+            ]
+        
+        faiss_index, documents, metadata = self._load_index_dir(user_id, user_index_path)
+        if deadline is not None:
+            deadline.mark("load_index")
         
         if faiss_index is None:
             logger.error(f"用戶 {user_id} 索引未建立")
-            return []
+            return [[] for _ in queries]
+        allowed = self._filter_positions(user_index_path, metadata, filters, deadline)
+        if allowed is not None and not len(allowed):
+            return [[] for _ in queries]
+        
+        candidates = top_k * HYBRID_CANDIDATE_MULTIPLIER if mode == "hybrid" else top_k
+        manifest = read_manifest(user_index_path)
+        
+        # 生成查詢向量（查詢池）
+        if query_embeddings is None:
+            query_embeddings = self._run_stage(
+                deadline, "embedding", "query", self._encode_texts, list(queries), tenant=user_id
+            )
+        if manifest.get("pca"):
+            # 與入庫時使用同一降維矩陣
+            query_embeddings = apply_pca(load_pca(user_index_path / PCA_FILE), query_embeddings)
+        
+        # 搜索（搜索池）
+        scores, indices = self._search_vectors(
+            user_id, user_index_path, manifest, faiss_index, query_embeddings, candidates, deadline, allowed
+        )
+        
+        if mode == "vector":
+            return [
+                self._format_results(user_id, row_scores, row_indices, documents, metadata, with_text)
+                for row_scores, row_indices in zip(scores, indices)
+            ]
         
-        # 生成查詢向量
-        query_embedding = self.embed_model.encode([query])
-        query_embedding = np.array(query_embedding).astype('float32')
+        lexical_hits = self._run_stage(
+            deadline, "lexical", "search", search_lexical, lexical_path, list(queries), candidates, None,
+            allowed.tolist() if allowed is not None else None, tenant=user_id
+        )
+        results = []
+        for row_indices, hits in zip(indices, lexical_hits):
+            fused = reciprocal_rank_fusion({
+                "vector": [int(idx) for idx in row_indices if idx >= 0],
+                "lexical": [position for position, _ in hits]
+            }, top_k)
+            results.append(self._format_results(
+                user_id, [score for _, score in fused], [position for position, _ in fused],
+                documents, metadata, with_text
+            ))
+        if deadline is not None:
+            deadline.mark("fusion")
+        return results
+    
+    def _search_vectors(self, user_id: int, user_index_path: Path, manifest: Dict, faiss_index,
+                        query_embeddings: np.ndarray, top_k: int, deadline=None,
+                        allowed: Optional[np.ndarray] = None) -> tuple:
+        """
+        向量檢索；壓縮索引先取 top_k * 候選倍數個候選，再用 mmap 的全精度向量精確重排；
+        建有文檔級索引時先選文檔再在其片段中檢索。allowed 為過濾條件允許的位置
+        
+        Returns:
+            與 faiss_index.search 相同格式的 (scores, indices)
+        """
+        index_type = manifest["type"]
         
-        # 搜索
-        scores, indices = faiss_index.search(query_embedding, top_k)
+        # 兩級檢索：先在文檔級索引中選出前 N 個文檔，片段檢索只在這些文檔的片段中進行；
+        # 過濾條件按文件、類型和上傳時間，同一文檔的片段結果相同，可直接限定第一級的候選文檔
+        if manifest.get("hierarchical"):
+            doc_index = faiss.read_index(str(user_index_path / DOC_INDEX_FILE))
+            hierarchy = DocumentHierarchy.load(user_index_path / HIERARCHY_FILE)
+            allowed_docs = np.unique(hierarchy.chunk_docs[allowed]) if allowed is not None else None
+            allowed = self._run_stage(
+                deadline, "doc_search", "search", select_chunks, doc_index, hierarchy, query_embeddings,
+                HIERARCHICAL_TOP_DOCS, allowed_docs, tenant=user_id
+            )
         
+        vectors = open_vectors(user_index_path) if index_type != "flat" else None
+        if vectors is None:
+            return self._run_stage(
+                deadline, "search", "search", coarse_search, faiss_index, index_type, query_embeddings, top_k,
+                allowed, tenant=user_id
+            )
+        
+        _, candidates = self._run_stage(
+            deadline, "search", "search", coarse_search, faiss_index, index_type, query_embeddings,
+            top_k * rescore_factor(index_type), allowed, tenant=user_id
+        )
+        return self._run_stage(
+            deadline, "rescore", "search", rescore, query_embeddings, candidates, vectors, top_k, tenant=user_id
+        )
+    
+    def _format_results(self, user_id: int, scores, indices, documents: List[str], metadata: List[dict],
+                        with_text: bool) -> List[dict]:
         results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(documents):
+        for i, (score, idx) in enumerate(zip(scores, indices)):
+            # top_k 大於文檔數時 FAISS 用 -1 填充
+            if 0 <= idx < len(documents):
                 results.append({
                     'rank': i + 1,
                     'score': float(score),
@@ -246,11 +1107,53 @@ class UserKnowledgeBaseSystem:
                     'metadata': metadata[idx] if idx < len(metadata) else {},
                     'user_id': user_id
                 })
+                if with_text:
+                    results[-1]['text'] = documents[idx]
         
         return results
     
-    def query_user_with_llm(self, user_id: int, query: str, context_docs: List[str], db_session=None) -> str:
-        """為特定用戶結合檢索結果調用 LLM，使用用戶選擇的模型"""
+    def build_context(self, user_id: int, query: str, texts: List[str], compress: Optional[bool] = None):
+        """
+        把檢索到的文檔全文按 token 預算打包成 LLM 上下文
+        
+        Args:
+            texts: 按檢索排名排列的文檔全文
+            compress: 是否按句子相似度壓縮，默認讀取 CONTEXT_COMPRESSION
+        
+        Returns:
+            context_builder.PackedContext
+        """
+        builder = ContextBuilder(
+            encode=lambda batch: self._run_in_pool("query", self._encode_texts, batch, tenant=user_id),
+            counter=self.token_counter
+        )
+        return builder.build(query, texts, compress=compress)
+    
+    def extractive_answer(self, user_id: int, query: str, texts: List[str], sources: List[dict]) -> Dict:
+        """
+        不調用 LLM，從檢索到的文檔中抽取最相關的句子作為答案
+        
+        Args:
+            texts: 按檢索排名排列的文檔全文
+            sources: 對應的檢索結果，用於標註引用
+        """
+        answerer = ExtractiveAnswerer(
+            encode=lambda batch: self._run_in_pool("query", self._encode_texts, batch, tenant=user_id)
+        )
+        return answerer.answer(query, texts, sources)
+    
+    def query_user_with_llm(self, user_id: int, query: str, context_docs: List[str], db_session=None,
+                            timeout: float = LLM_TIMEOUT, routing: Optional[str] = None,
+                            fallback=None) -> str:
+        """
+        為特定用戶結合檢索結果調用 LLM，使用用戶選擇的模型
+        
+        Args:
+            timeout: LLM 請求超時秒數
+            routing: default 只用默認模型；latency 在用戶設定的所有模型間按延遲路由並對沖，
+                     默認讀取 LLM_ROUTING_MODE
+            fallback: LLM 調用失敗時調用 fallback(失敗原因) 生成替代答案（如抽取式答案）
+        """
         # 構建提示詞
         context = "\n\n".join([f"文檔{i+1}: {doc}" for i, doc in enumerate(context_docs)])
         
@@ -262,33 +1165,60 @@ class UserKnowledgeBaseSystem:
 
 請基於上述您上傳的文檔內容提供準確、詳細的回答："""
         
-        # 獲取用戶的預設模型
-        model_config = self._get_user_preferred_model(user_id, db_session)
-        
-        if not model_config:
-            logger.warning(f"用戶 {user_id} 未設置預設模型，使用默認 DeepSeek")
-            model_config = {
-                'provider': 'deepseek',
-                'model_id': 'deepseek-chat',
-                'api_base_url': 'https://api.deepseek.com',
-                'api_key': os.getenv("DEEPSEEK_API_KEY")
-            }
-        
-        # 根據提供商調用不同的 API
         try:
-            if model_config['provider'] == 'deepseek':
-                return self._call_deepseek_api(user_id, prompt, model_config)
-            elif model_config['provider'] == 'openai':
-                return self._call_openai_api(user_id, prompt, model_config)
-            elif model_config['provider'] == 'anthropic':
-                return self._call_anthropic_api(user_id, prompt, model_config)
-            else:
-                # Google, Microsoft 等其他提供商使用 OpenAI 兼容格式
-                return self._call_openai_compatible_api(user_id, prompt, model_config)
+            if (routing or LLM_ROUTING_MODE) == "latency":
+                candidates = self._get_user_model_candidates(user_id, db_session)
+                return get_model_router().execute(
+                    candidates,
+                    lambda config, cancel_event: self._call_model(user_id, prompt, config, timeout, cancel_event),
+                    timeout
+                )
+            
+            # 獲取用戶的預設模型
+            model_config = self._get_user_preferred_model(user_id, db_session)
+            
+            if not model_config:
+                logger.warning(f"用戶 {user_id} 未設置預設模型，使用默認 DeepSeek")
+                model_config = self._default_model_config()
+            
+            return self._call_model(user_id, prompt, model_config, timeout)
                 
+        except LLMCallError as e:
+            message = str(e)
+        except ProviderUnavailable as e:
+            logger.warning(f"LLM 快速失敗: {e}")
+            message = f"AI 模型服務暫時不可用，請稍後重試（{e.provider}，約 {e.retry_in:.0f} 秒後恢復）。"
         except Exception as e:
             logger.error(f"LLM 調用錯誤: {e}")
-            return f"基於您的文檔，無法生成回答。錯誤: {str(e)}"
+            message = f"基於您的文檔，無法生成回答。錯誤: {str(e)}"
+        
+        if fallback is not None:
+            try:
+                return fallback(message)
+            except Exception as e:
+                logger.error(f"LLM 兜底答案生成失敗: {e}")
+        return message
+    
+    def _call_model(self, user_id: int, prompt: str, model_config: Dict, timeout: float,
+                    cancel_event=None) -> str:
+        """根據提供商調用不同的 API，失敗時拋出異常"""
+        if model_config['provider'] == 'deepseek':
+            return self._call_deepseek_api(user_id, prompt, model_config, timeout, cancel_event)
+        elif model_config['provider'] == 'openai':
+            return self._call_openai_api(user_id, prompt, model_config, timeout, cancel_event)
+        elif model_config['provider'] == 'anthropic':
+            return self._call_anthropic_api(user_id, prompt, model_config, timeout, cancel_event)
+        else:
+            # Google, Microsoft 等其他提供商使用 OpenAI 兼容格式
+            return self._call_openai_compatible_api(user_id, prompt, model_config, timeout, cancel_event)
+    
+    def _default_model_config(self) -> Dict:
+        return {
+            'provider': 'deepseek',
+            'model_id': 'deepseek-chat',
+            'api_base_url': 'https://api.deepseek.com',
+            'api_key': os.getenv("DEEPSEEK_API_KEY")
+        }
     
     def _get_user_preferred_model(self, user_id: int, db_session) -> Optional[Dict]:
         """獲取用戶的預設模型配置"""
@@ -311,21 +1241,62 @@ class UserKnowledgeBaseSystem:
         
         return None
     
-    def _call_deepseek_api(self, user_id: int, prompt: str, model_config: Dict) -> str:
-        """調用 DeepSeek API"""
-        import requests
+    def _get_user_model_candidates(self, user_id: int, db_session) -> List[Dict]:
+        """用戶設定了 API 密鑰的所有模型（默認模型在前），沒有時使用默認 DeepSeek"""
+        candidates = []
+        if db_session:
+            try:
+                try:
+                    from scripts.database import get_user_model_preferences
+                except ImportError:
+                    from database import get_user_model_preferences
+                preferences = sorted(get_user_model_preferences(db_session, user_id),
+                                     key=lambda pref: not pref.is_default)
+                for pref in preferences:
+                    api_key = pref.api_key or (os.getenv("DEEPSEEK_API_KEY") if pref.model.provider == 'deepseek' else None)
+                    if not api_key:
+                        continue
+                    candidates.append({
+                        'provider': pref.model.provider,
+                        'model_id': pref.model.model_id,
+                        'api_base_url': pref.model.api_base_url,
+                        'api_key': api_key
+                    })
+            except Exception as e:
+                logger.error(f"獲取用戶 {user_id} 模型列表失敗: {e}")
         
+        return candidates or [self._default_model_config()]
+    
+    def _post_llm(self, provider: str, api_key: str, url: str, headers: Dict, payload: Dict,
+                  timeout: float, cancel_event=None):
+        """經提供商熔斷器、限流節奏和重試發送 LLM 請求"""
+        return get_provider_health().request(provider, api_key, url, headers, payload, timeout, cancel_event)
+    
+    def _llm_error(self, provider: str, response) -> LLMCallError:
+        """非 200 響應轉成給用戶的提示，不直接返回提供商的原始響應"""
+        logger.error(f"{provider} API 調用失敗: {response.status_code} {response.text[:500]}")
+        if response.status_code == 429:
+            return LLMCallError(f"AI 模型服務請求過於頻繁（{provider}），請稍後重試。")
+        if response.status_code in (401, 403):
+            return LLMCallError(f"{provider} API 密鑰無效或無權限，請檢查模型設定。")
+        return LLMCallError(f"API 調用失敗（{provider}，HTTP {response.status_code}），請稍後重試。")
+    
+    def _call_deepseek_api(self, user_id: int, prompt: str, model_config: Dict,
+                           timeout: float = LLM_TIMEOUT, cancel_event=None) -> str:
+        """調用 DeepSeek API"""
         api_key = model_config.get('api_key') or os.getenv("DEEPSEEK_API_KEY")
         if not api_key:
-            return "錯誤：未設置 DeepSeek API 密鑰"
+            raise LLMCallError("錯誤：未設置 DeepSeek API 密鑰")
             
-        response = requests.post(
+        response = self._post_llm(
+            'deepseek',
+            api_key,
             f"{model_config['api_base_url']}/v1/chat/completions",
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {api_key}"
             },
-            json={
+            payload={
                 "model": model_config['model_id'],
                 "messages": [
                     {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。"},
@@ -333,30 +1304,31 @@ class UserKnowledgeBaseSystem:
                 ],
                 "temperature": 0.7
             },
-            timeout=30
+            timeout=timeout,
+            cancel_event=cancel_event
         )
         
         if response.status_code == 200:
             return response.json()["choices"][0]["message"]["content"]
         else:
-            logger.error(f"DeepSeek API 調用失敗: {response.status_code} {response.text}")
-            return f"API 調用失敗: {response.text}"
+            raise self._llm_error('deepseek', response)
     
-    def _call_openai_api(self, user_id: int, prompt: str, model_config: Dict) -> str:
+    def _call_openai_api(self, user_id: int, prompt: str, model_config: Dict,
+                         timeout: float = LLM_TIMEOUT, cancel_event=None) -> str:
         """調用 OpenAI API"""
-        import requests
-        
         api_key = model_config.get('api_key')
         if not api_key:
-            return "錯誤：未設置 OpenAI API 密鑰"
+            raise LLMCallError("錯誤：未設置 OpenAI API 密鑰")
             
-        response = requests.post(
+        response = self._post_llm(
+            'openai',
+            api_key,
             f"{model_config['api_base_url']}/chat/completions",
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {api_key}"
             },
-            json={
+            payload={
                 "model": model_config['model_id'],
                 "messages": [
                     {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。"},
@@ -364,61 +1336,63 @@ class UserKnowledgeBaseSystem:
                 ],
                 "temperature": 0.7
             },
-            timeout=30
+            timeout=timeout,
+            cancel_event=cancel_event
         )
         
         if response.status_code == 200:
             return response.json()["choices"][0]["message"]["content"]
         else:
-            logger.error(f"OpenAI API 調用失敗: {response.status_code} {response.text}")
-            return f"API 調用失敗: {response.text}"
+            raise self._llm_error('openai', response)
     
-    def _call_anthropic_api(self, user_id: int, prompt: str, model_config: Dict) -> str:
+    def _call_anthropic_api(self, user_id: int, prompt: str, model_config: Dict,
+                            timeout: float = LLM_TIMEOUT, cancel_event=None) -> str:
         """調用 Anthropic Claude API"""
-        import requests
-        
         api_key = model_config.get('api_key')
         if not api_key:
-            return "錯誤：未設置 Anthropic API 密鑰"
+            raise LLMCallError("錯誤：未設置 Anthropic API 密鑰")
             
-        response = requests.post(
+        response = self._post_llm(
+            'anthropic',
+            api_key,
             f"{model_config['api_base_url']}/v1/messages",
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {api_key}",
                 "anthropic-version": "2023-06-01"
             },
-            json={
+            payload={
                 "model": model_config['model_id'],
                 "max_tokens": 1000,
                 "messages": [
                     {"role": "user", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。\n\n{prompt}"}
                 ]
             },
-            timeout=30
+            timeout=timeout,
+            cancel_event=cancel_event
         )
         
         if response.status_code == 200:
             return response.json()["content"][0]["text"]
         else:
-            logger.error(f"Anthropic API 調用失敗: {response.status_code} {response.text}")
-            return f"API 調用失敗: {response.text}"
+            raise self._llm_error('anthropic', response)
     
-    def _call_openai_compatible_api(self, user_id: int, prompt: str, model_config: Dict) -> str:
+    def _call_openai_compatible_api(self, user_id: int, prompt: str, model_config: Dict,
+                                    timeout: float = LLM_TIMEOUT, cancel_event=None) -> str:
         """調用 OpenAI 兼容的 API（如 Google, Microsoft 等）"""
-        import requests
-        
         api_key = model_config.get('api_key')
         if not api_key:
-            return f"錯誤：未設置 {model_config['provider']} API 密鑰"
+            raise LLMCallError(f"錯誤：未設置 {model_config['provider']} API 密鑰")
             
-        response = requests.post(
+        response = self._post_llm(
+            model_config['provider'],
+            api_key,
             f"{model_config['api_base_url']}/chat/completions",
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {api_key}"
             },
-            json={
+            payload={
                 "model": model_config['model_id'],
                 "messages": [
                     {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。"},
@@ -426,14 +1400,14 @@ class UserKnowledgeBaseSystem:
                 ],
                 "temperature": 0.7
             },
-            timeout=30
+            timeout=timeout,
+            cancel_event=cancel_event
         )
         
         if response.status_code == 200:
             return response.json()["choices"][0]["message"]["content"]
         else:
-            logger.error(f"{model_config['provider']} API 調用失敗: {response.status_code} {response.text}")
-            return f"API 調用失敗: {response.text}"
+            raise self._llm_error(model_config['provider'], response)
     
     def delete_user_document(self, user_id: int, filename: str) -> bool:
         """刪除用戶文檔"""
@@ -444,8 +1418,8 @@ class UserKnowledgeBaseSystem:
             try:
                 file_path.unlink()
                 logger.info(f"刪除用戶 {user_id} 文檔: {filename}")
-                # 重新建立索引
-                self.build_user_index(user_id)
+                # 重新建立索引（分片索引只重建該文件所在的分片）
+                self.build_user_index(user_id, changed_files=[filename])
                 return True
             except Exception as e:
                 logger.error(f"刪除用戶 {user_id} 文檔失敗: {e}")
@@ -470,16 +1444,18 @@ class UserKnowledgeBaseSystem:
     
     def clear_user_data(self, user_id: int):
         """清除用戶所有數據（用於用戶刪除賬號）"""
-        import shutil
-        
         user_docs_folder = self.get_user_docs_folder(user_id)
         user_index_path = self.get_user_index_path(user_id)
         
         try:
-            if user_docs_folder.exists():
-                shutil.rmtree(user_docs_folder)
-            if user_index_path.exists():
-                shutil.rmtree(user_index_path)
+            # 與建索引互斥，避免進行中的建索引在刪除後重新寫入索引
+            with self._index_lock(user_id):
+                if user_docs_folder.exists():
+                    shutil.rmtree(user_docs_folder)
+                if user_index_path.exists():
+                    shutil.rmtree(user_index_path)
+                if self.pooled_indexes is not None:
+                    self.pooled_indexes.pool_for(user_id).remove_user(user_id)
             logger.info(f"清除用戶 {user_id} 所有數據")
             return True
         except Exception as e:
@@ -0,0 +1,479 @@
+"""
+壓縮向量索引與兩階段檢索
+FAISS 索引可用標量量化（sq8，每維 1 字節）、乘積量化（pq）或符號二值化（binary，每維 1 位，
+漢明距離）壓縮以節省記憶體；全精度向量另存為磁盤上的 .npy，查詢時按 k × 候選倍數從壓縮索引取候選，
+再只對候選從 mmap 中讀取原始向量精確重算內積。
+可選在入庫和查詢時用 PCA 把嵌入降維（如 768 → 256），降維矩陣按用戶訓練或整個部署共用，與索引一同保存。
+片段數很多的用戶另建文檔級索引（每個文檔一個片段向量的歸一化均值），先檢索前 N 個文檔，
+再用 IDSelector 只在這些文檔的片段中檢索
+
+命令行：
+    python vector_index.py benchmark 對比各類型與 IndexFlatIP 的建索引時間、記憶體和召回率
+    python vector_index.py benchmark-hierarchical 報告兩級檢索各級的召回率和延遲
+    python vector_index.py train-pca --vectors a.npy --dim 256 --output pca.bin 訓練部署共用的降維矩陣
+"""
+
+import os
+import sys
+import json
+import zlib
+import time
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 索引類型：flat（精確，默認）、sq8（8 位標量量化）、pq（乘積量化）、binary（符號二值化）
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat").lower()
+VECTOR_INDEX_TYPES = ("flat", "sq8", "pq", "binary")
+# 壓縮索引的候選倍數：從壓縮索引取 top_k * RESCORE_FACTOR 個候選後精確重排；
+# 二值索引的漢明距離較粗，使用更大的倍數
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+BINARY_RESCORE_FACTOR = int(os.getenv("BINARY_RESCORE_FACTOR", "10"))
+# 磁盤上全精度向量的存儲類型：float16（體積減半）或 float32
+VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float16").lower()
+# PQ 子向量數（需整除維度）；訓練樣本不足 PQ_MIN_TRAIN 時改用 sq8
+PQ_SUBQUANTIZERS = int(os.getenv("PQ_SUBQUANTIZERS", "96"))
+PQ_MIN_TRAIN = int(os.getenv("PQ_MIN_TRAIN", "1024"))
+# 訓練量化器最多使用的向量數
+TRAIN_SAMPLE_SIZE = int(os.getenv("VECTOR_TRAIN_SAMPLE_SIZE", "50000"))
+
+# PCA 降維後的維度（0 為不降維）；VECTOR_PCA_PATH 指向部署共用的降維矩陣時所有用戶共用，
+# 否則按用戶訓練，向量數不足 PCA_MIN_TRAIN（至少為降維後維度）的用戶不降維
+VECTOR_PCA_DIM = int(os.getenv("VECTOR_PCA_DIM", "0"))
+VECTOR_PCA_PATH = os.getenv("VECTOR_PCA_PATH", "")
+PCA_MIN_TRAIN = max(1, int(os.getenv("PCA_MIN_TRAIN", "1000")))
+
+# 片段數達到此值（0 為不使用）且文檔數多於第一級保留文檔數的用戶建立文檔級索引做兩級檢索；
+# 只有 CHUNK_SIZE > 0 時一個文檔才會有多個片段
+HIERARCHICAL_MIN_CHUNKS = max(0, int(os.getenv("HIERARCHICAL_MIN_CHUNKS", "50000")))
+HIERARCHICAL_TOP_DOCS = max(1, int(os.getenv("HIERARCHICAL_TOP_DOCS", "50")))
+
+# 每個用戶索引的分片數（1 為不分片），以及並行檢索分片的線程數
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", "4"))
+
+MANIFEST_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+PCA_FILE = "pca.bin"
+DOC_INDEX_FILE = "documents.index"
+HIERARCHY_FILE = "hierarchy.npz"
+
+
+def read_manifest(index_path: Path) -> Dict:
+    """索引描述；舊索引沒有描述文件時視為 flat"""
+    manifest_file = index_path / MANIFEST_FILE
+    if not manifest_file.exists():
+        return {"type": "flat"}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(index_path: Path, manifest: Dict):
+    tmp_file = index_path / (MANIFEST_FILE + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, index_path / MANIFEST_FILE)
+
+
+def shard_of(filename: str, shards: int) -> int:
+    """按文件名的 CRC32 分配分片，與進程和 Python 哈希種子無關"""
+    return zlib.crc32(filename.encode("utf-8")) % shards
+
+
+def write_vectors(path: Path, batches: Iterable[np.ndarray], count: int, dimension: int,
+                  dtype: str = VECTOR_STORE_DTYPE) -> np.memmap:
+    """逐批把嵌入寫入 .npy（mmap），不在記憶體中持有整個語料的向量"""
+    vectors = np.lib.format.open_memmap(str(path), mode="w+", dtype=np.dtype(dtype), shape=(count, dimension))
+    offset = 0
+    for batch in batches:
+        vectors[offset:offset + len(batch)] = batch
+        offset += len(batch)
+    if offset != count:
+        raise ValueError(f"寫入向量數 {offset} 與文檔數 {count} 不一致")
+    vectors.flush()
+    return vectors
+
+
+def open_vectors(index_path: Path) -> Optional[np.ndarray]:
+    """以只讀 mmap 打開全精度向量，只有被訪問的行會從磁盤讀入"""
+    vectors_file = index_path / VECTORS_FILE
+    if not vectors_file.exists():
+        return None
+    return np.load(str(vectors_file), mmap_mode="r")
+
+
+def train_pca(vectors: Union[np.ndarray, Sequence[np.ndarray]], dimension: int) -> faiss.PCAMatrix:
+    """
+    在（最多 TRAIN_SAMPLE_SIZE 個）採樣向量上訓練 PCA 降維矩陣
+
+    vectors 可以是依次拼接的多個數組（例如同一用戶各分片的原始向量文件），採樣結果與拼接後的單個數組相同
+    """
+    parts = [vectors] if isinstance(vectors, np.ndarray) else list(vectors)
+    count, input_dimension = sum(len(part) for part in parts), parts[0].shape[1]
+    if dimension >= input_dimension:
+        raise ValueError(f"降維後維度 {dimension} 必須小於原始維度 {input_dimension}")
+    if count < dimension:
+        raise ValueError(f"訓練向量數 {count} 少於降維後維度 {dimension}")
+    pca = faiss.PCAMatrix(input_dimension, dimension)
+    sample = np.sort(np.random.default_rng(0).choice(count, min(count, TRAIN_SAMPLE_SIZE), replace=False))
+    offsets = np.cumsum([0] + [len(part) for part in parts])
+    rows = [np.asarray(part[sample[(sample >= start) & (sample < end)] - start])
+            for part, start, end in zip(parts, offsets[:-1], offsets[1:])]
+    pca.train(np.ascontiguousarray(np.concatenate(rows), dtype=np.float32))
+    return pca
+
+
+def apply_pca(pca: faiss.PCAMatrix, vectors: np.ndarray) -> np.ndarray:
+    """降維後重新歸一化，使內積仍等於餘弦相似度"""
+    reduced = pca.apply(np.ascontiguousarray(vectors, dtype=np.float32))
+    return reduced / np.maximum(np.linalg.norm(reduced, axis=1, keepdims=True), 1e-12)
+
+
+def save_pca(pca: faiss.PCAMatrix, path: Path):
+    faiss.write_VectorTransform(pca, str(path))
+
+
+def load_pca(path: Path) -> faiss.PCAMatrix:
+    return faiss.read_VectorTransform(str(path))
+
+
+def binarize(vectors: np.ndarray) -> np.ndarray:
+    """按符號二值化並按位打包，每 8 維 1 字節"""
+    return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+
+def rescore_factor(index_type: str) -> int:
+    return BINARY_RESCORE_FACTOR if index_type == "binary" else RESCORE_FACTOR
+
+
+def write_index(index, path: Path, index_type: str):
+    if index_type == "binary":
+        faiss.write_index_binary(index, str(path))
+    else:
+        faiss.write_index(index, str(path))
+
+
+def read_index(path: Path, index_type: str):
+    if index_type == "binary":
+        return faiss.read_index_binary(str(path))
+    return faiss.read_index(str(path))
+
+
+def coarse_search(index, index_type: str, query_embeddings: np.ndarray, k: int,
+                  allowed=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    在（壓縮）索引上檢索；二值索引先把查詢二值化，返回的是漢明距離
+
+    Args:
+        allowed: 允許返回的位置，通過 IDSelectorBatch 限制搜索範圍；可以是所有查詢共用的一個數組
+                 （過濾條件），或每個查詢一個數組（兩級檢索第一級選出的片段）
+    """
+    if index_type == "binary":
+        query_embeddings = binarize(query_embeddings)
+    if allowed is None:
+        return index.search(query_embeddings, k)
+    if isinstance(allowed, np.ndarray):
+        selector = faiss.IDSelectorBatch(allowed)
+        return index.search(query_embeddings, k, params=faiss.SearchParameters(sel=selector))
+
+    scores, indices = [], []
+    for row, ids in enumerate(allowed):
+        selector = faiss.IDSelectorBatch(ids)
+        row_scores, row_indices = index.search(query_embeddings[row:row + 1], k,
+                                               params=faiss.SearchParameters(sel=selector))
+        scores.append(row_scores)
+        indices.append(row_indices)
+    return np.vstack(scores), np.vstack(indices)
+
+
+class DocumentHierarchy:
+    """片段到文檔的映射，按文檔分組的片段位置以 CSR 形式保存，第一級選出文檔後可直接取出其片段"""
+
+    def __init__(self, chunk_docs: np.ndarray, chunk_order: Optional[np.ndarray] = None,
+                 doc_offsets: Optional[np.ndarray] = None):
+        self.chunk_docs = np.asarray(chunk_docs, dtype=np.int64)
+        if chunk_order is None:
+            chunk_order = np.argsort(self.chunk_docs, kind="stable")
+            doc_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.chunk_docs))])
+        self.chunk_order = chunk_order
+        self.doc_offsets = doc_offsets
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_offsets) - 1
+
+    def chunk_ids(self, doc_ids: np.ndarray) -> np.ndarray:
+        doc_ids = doc_ids[(doc_ids >= 0) & (doc_ids < self.doc_count)]
+        if len(doc_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([
+            self.chunk_order[self.doc_offsets[doc]:self.doc_offsets[doc + 1]] for doc in doc_ids
+        ]).astype(np.int64)
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(str(tmp_path), chunk_docs=self.chunk_docs, chunk_order=self.chunk_order,
+                 doc_offsets=self.doc_offsets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "DocumentHierarchy":
+        with np.load(str(path)) as data:
+            return cls(data["chunk_docs"], data["chunk_order"], data["doc_offsets"])
+
+
+class CentroidAccumulator:
+    """建索引時隨片段嵌入批次累加每個文檔的向量和，不需要再讀一遍向量"""
+
+    def __init__(self, chunk_docs: np.ndarray, dimension: int):
+        self.chunk_docs = chunk_docs
+        self.sums = np.zeros((int(chunk_docs.max()) + 1, dimension), dtype=np.float32)
+        self._offset = 0
+
+    def wrap(self, batches: Iterable[np.ndarray]) -> Iterable[np.ndarray]:
+        for batch in batches:
+            np.add.at(self.sums, self.chunk_docs[self._offset:self._offset + len(batch)], batch)
+            self._offset += len(batch)
+            yield batch
+
+    def build_index(self) -> faiss.Index:
+        centroids = self.sums / np.maximum(np.linalg.norm(self.sums, axis=1, keepdims=True), 1e-12)
+        index = faiss.IndexFlatIP(centroids.shape[1])
+        index.add(np.ascontiguousarray(centroids, dtype=np.float32))
+        return index
+
+
+def select_chunks(doc_index: faiss.Index, hierarchy: DocumentHierarchy, query_embeddings: np.ndarray,
+                  top_docs: int = HIERARCHICAL_TOP_DOCS,
+                  allowed_docs: Optional[np.ndarray] = None) -> List[np.ndarray]:
+    """第一級：檢索最相關的 top_docs 個文檔（allowed_docs 限定候選文檔），返回每個查詢允許的片段位置"""
+    params = None
+    if allowed_docs is not None:
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(allowed_docs))
+    _, doc_ids = doc_index.search(np.ascontiguousarray(query_embeddings, dtype=np.float32), top_docs,
+                                  params=params)
+    return [hierarchy.chunk_ids(row) for row in doc_ids]
+
+
+def create_compressed_index(index_type: str, vectors: np.ndarray,
+                            batch_size: int = 4096) -> Tuple[faiss.Index, str]:
+    """
+    按類型訓練並填充壓縮索引
+
+    Returns:
+        (索引, 實際使用的類型)；PQ 訓練樣本不足或維度不整除時改用 sq8
+    """
+    count, dimension = vectors.shape
+    if index_type == "binary":
+        if dimension % 8:
+            raise ValueError(f"二值索引要求維度是 8 的倍數，當前為 {dimension}")
+        index = faiss.IndexBinaryFlat(dimension)
+        for start in range(0, count, batch_size):
+            index.add(binarize(vectors[start:start + batch_size]))
+        return index, index_type
+
+    if index_type == "pq" and (count < PQ_MIN_TRAIN or dimension % PQ_SUBQUANTIZERS):
+        logger.info(f"向量數 {count} 不足 {PQ_MIN_TRAIN} 或維度不整除 PQ 子向量數，改用 sq8")
+        index_type = "sq8"
+
+    if index_type == "pq":
+        index = faiss.IndexPQ(dimension, PQ_SUBQUANTIZERS, 8, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+
+    sample = np.sort(np.random.default_rng(0).choice(count, min(count, TRAIN_SAMPLE_SIZE), replace=False))
+    index.train(np.ascontiguousarray(vectors[sample], dtype=np.float32))
+    for start in range(0, count, batch_size):
+        index.add(np.ascontiguousarray(vectors[start:start + batch_size], dtype=np.float32))
+    return index, index_type
+
+
+def rescore(query_embeddings: np.ndarray, candidates: np.ndarray, vectors: np.ndarray,
+            top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    用全精度向量重算候選的內積並取前 top_k
+
+    Args:
+        query_embeddings: (n, d) 查詢向量
+        candidates: (n, k') 壓縮索引返回的候選位置，-1 為填充
+        vectors: (N, d) 全精度向量（mmap）
+
+    Returns:
+        與 faiss_index.search 相同格式的 (scores, indices)，不足 top_k 時以 -inf / -1 填充
+    """
+    n = len(query_embeddings)
+    scores = np.full((n, top_k), -np.inf, dtype=np.float32)
+    indices = np.full((n, top_k), -1, dtype=np.int64)
+
+    for row in range(n):
+        ids = candidates[row][candidates[row] >= 0]
+        if len(ids) == 0:
+            continue
+        # mmap 按位置升序讀取更順序
+        ids = np.unique(ids)
+        exact = np.asarray(vectors[ids], dtype=np.float32) @ query_embeddings[row]
+        order = np.argsort(-exact)[:top_k]
+        scores[row, :len(order)] = exact[order]
+        indices[row, :len(order)] = ids[order]
+    return scores, indices
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(a[a >= 0]) & set(b)) / k for a, b in zip(found, truth)]))
+
+
+def benchmark_index_types(vectors: np.ndarray, queries: np.ndarray, top_k: int = 10,
+                          index_types: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """
+    在同一批向量上對比各索引類型與 IndexFlatIP：建索引時間、索引記憶體、查詢延遲，
+    以及粗排和精確重排後相對 IndexFlatIP 的 recall@top_k
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    index_types = index_types or [t for t in VECTOR_INDEX_TYPES if t != "flat"]
+
+    start_time = time.perf_counter()
+    flat = faiss.IndexFlatIP(vectors.shape[1])
+    flat.add(vectors)
+    build_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    _, truth = flat.search(queries, top_k)
+    results = {"flat": {
+        "build_seconds": build_seconds,
+        "index_mb": vectors.nbytes / 2 ** 20,
+        "query_ms": (time.perf_counter() - start_time) / len(queries) * 1000,
+        "recall": 1.0,
+        "rescored_recall": 1.0
+    }}
+
+    for index_type in index_types:
+        start_time = time.perf_counter()
+        index, actual_type = create_compressed_index(index_type, vectors)
+        build_seconds = time.perf_counter() - start_time
+        serialized = (faiss.serialize_index_binary(index) if actual_type == "binary"
+                      else faiss.serialize_index(index))
+
+        _, coarse = coarse_search(index, actual_type, queries, top_k)
+        start_time = time.perf_counter()
+        _, candidates = coarse_search(index, actual_type, queries, top_k * rescore_factor(actual_type))
+        _, rescored = rescore(queries, candidates, vectors, top_k)
+        results[actual_type] = {
+            "build_seconds": build_seconds,
+            "index_mb": serialized.nbytes / 2 ** 20,
+            "query_ms": (time.perf_counter() - start_time) / len(queries) * 1000,
+            "recall": _recall(coarse, truth),
+            "rescored_recall": _recall(rescored, truth)
+        }
+    return results
+
+
+def benchmark_hierarchical(vectors: np.ndarray, chunk_docs: np.ndarray, queries: np.ndarray, top_k: int = 10,
+                           top_docs: int = HIERARCHICAL_TOP_DOCS) -> Dict[str, Dict[str, float]]:
+    """
+    對比兩級檢索與片段級 IndexFlatIP：
+    第一級召回率為真實 top_k 片段中所屬文檔被選中的比例（第二級能達到的上限），第二級為最終 recall@top_k
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    flat = faiss.IndexFlatIP(vectors.shape[1])
+    flat.add(vectors)
+    start_time = time.perf_counter()
+    _, truth = flat.search(queries, top_k)
+    flat_ms = (time.perf_counter() - start_time) / len(queries) * 1000
+
+    accumulator = CentroidAccumulator(chunk_docs, vectors.shape[1])
+    for _ in accumulator.wrap([vectors]):
+        pass
+    doc_index = accumulator.build_index()
+    hierarchy = DocumentHierarchy(chunk_docs)
+
+    start_time = time.perf_counter()
+    allowed = select_chunks(doc_index, hierarchy, queries, top_docs)
+    level1_ms = (time.perf_counter() - start_time) / len(queries) * 1000
+    start_time = time.perf_counter()
+    _, found = coarse_search(flat, "flat", queries, top_k, allowed)
+    level2_ms = (time.perf_counter() - start_time) / len(queries) * 1000
+
+    level1_recall = float(np.mean([np.isin(row, ids).mean() for row, ids in zip(truth, allowed)]))
+    return {
+        "flat": {"query_ms": flat_ms, "recall": 1.0, "searched": float(len(vectors))},
+        "level1": {"query_ms": level1_ms, "recall": level1_recall, "searched": float(hierarchy.doc_count)},
+        "level2": {"query_ms": level2_ms, "recall": _recall(found, truth),
+                   "searched": float(np.mean([len(ids) for ids in allowed]))}
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="對比壓縮索引與 IndexFlatIP，或訓練部署共用的 PCA 降維矩陣")
+    parser.add_argument("command", choices=["benchmark", "train-pca", "benchmark-hierarchical"])
+    parser.add_argument("--vectors", help="全精度向量 .npy（如 user_indexes/user_1/vectors.npy），默認使用隨機數據")
+    parser.add_argument("--dim", type=int, default=VECTOR_PCA_DIM or 256, help="train-pca：降維後的維度")
+    parser.add_argument("--output", default=PCA_FILE, help="train-pca：降維矩陣輸出路徑（設為 VECTOR_PCA_PATH）")
+    parser.add_argument("--count", type=int, default=100000, help="隨機數據的向量數")
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--types", default="sq8,pq,binary")
+    parser.add_argument("--hierarchy", help="benchmark-hierarchical：與 --vectors 對應的 hierarchy.npz")
+    parser.add_argument("--chunks-per-doc", type=int, default=20, help="benchmark-hierarchical：隨機數據每文檔片段數")
+    parser.add_argument("--top-docs", type=int, default=HIERARCHICAL_TOP_DOCS)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    chunk_docs = None
+    if args.vectors:
+        vectors = np.load(args.vectors, mmap_mode="r")
+        if args.hierarchy:
+            chunk_docs = DocumentHierarchy.load(Path(args.hierarchy)).chunk_docs
+    elif args.command == "benchmark-hierarchical":
+        # 每個文檔的片段圍繞文檔主題向量分佈
+        doc_count = max(1, args.count // args.chunks_per_doc)
+        topics = rng.standard_normal((doc_count, args.dimension), dtype=np.float32)
+        chunk_docs = np.repeat(np.arange(doc_count), args.chunks_per_doc)[:args.count]
+        vectors = topics[chunk_docs] + 0.8 * rng.standard_normal((len(chunk_docs), args.dimension), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    else:
+        # 帶簇結構的歸一化隨機向量，比均勻隨機更接近真實嵌入的分佈
+        centers = rng.standard_normal((max(1, args.count // 400), args.dimension), dtype=np.float32)
+        vectors = centers[rng.integers(0, len(centers), args.count)]
+        vectors += 0.6 * rng.standard_normal(vectors.shape, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # 查詢取已有向量加少量噪聲
+    if args.command == "train-pca":
+        pca = train_pca(vectors, args.dim)
+        save_pca(pca, Path(args.output))
+        eigenvalues = faiss.vector_to_array(pca.eigenvalues)
+        retained = eigenvalues[:args.dim].sum() / max(eigenvalues.sum(), 1e-12)
+        print(f"PCA {vectors.shape[1]} → {args.dim} 已保存到 {args.output}，保留方差 {retained:.1%}")
+        return 0
+
+    queries = np.asarray(vectors[rng.choice(len(vectors), args.queries, replace=False)], dtype=np.float32)
+    queries += 0.1 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(queries.shape[1])
+
+    if args.command == "benchmark-hierarchical":
+        if chunk_docs is None:
+            parser.error("使用 --vectors 時需要同時指定 --hierarchy")
+        results = benchmark_hierarchical(vectors, chunk_docs, queries, args.top_k, args.top_docs)
+        print(f"{'級別':<8}{'searched':>12}{'query ms':>10}{'recall':>9}")
+        for name, result in results.items():
+            print(f"{name:<8}{result['searched']:>12.0f}{result['query_ms']:>10.2f}{result['recall']:>9.3f}")
+        return 0
+
+    results = benchmark_index_types(vectors, queries, args.top_k, args.types.split(","))
+    print(f"{'類型':<8}{'build s':>10}{'index MB':>10}{'query ms':>10}{'recall':>9}{'rescored':>10}")
+    for name, result in results.items():
+        print(f"{name:<8}{result['build_seconds']:>10.2f}{result['index_mb']:>10.1f}{result['query_ms']:>10.2f}"
+              f"{result['recall']:>9.3f}{result['rescored_recall']:>10.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
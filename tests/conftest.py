@@ -0,0 +1,37 @@
+import sys
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# 與 scripts 下的模塊一樣以 scripts.xxx 導入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+HASH_EMBEDDING_DIMENSION = 64
+
+
+class HashEmbedding:
+    """按字符二元組哈希到固定維度並歸一化，確定性的嵌入，不需要下載模型"""
+
+    def get_sentence_embedding_dimension(self):
+        return HASH_EMBEDDING_DIMENSION
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+        vectors = np.zeros((len(sentences), HASH_EMBEDDING_DIMENSION), dtype=np.float32)
+        for row, text in enumerate(sentences):
+            for start in range(max(1, len(text) - 1)):
+                bucket = int(hashlib.md5(text[start:start + 2].encode("utf-8")).hexdigest(), 16)
+                vectors[row, bucket % HASH_EMBEDDING_DIMENSION] += 1.0
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+@pytest.fixture
+def hash_embedding(monkeypatch):
+    """用 HashEmbedding 代替知識庫載入的嵌入模型"""
+    from scripts import user_knowledge_base
+    model = HashEmbedding()
+    monkeypatch.setattr(user_knowledge_base, "load_embedding_model", lambda name: model)
+    return model
@@ -0,0 +1,73 @@
+"""
+共享索引池的版本切換：向量、語料和全文索引屬於同一版本，降級時保留獨立索引給仍在讀取它的查詢
+"""
+
+import numpy as np
+
+from scripts import pooled_index
+from scripts.pooled_index import IndexPool, CURRENT_FILE, POOL_FILE
+from scripts.lexical_index import LEXICAL_INDEX_FILE
+from scripts import user_knowledge_base
+
+DIMENSION = 4
+
+
+def _vectors(count):
+    return np.eye(DIMENSION, dtype=np.float32)[:count]
+
+
+def test_replace_user_switches_vectors_and_lexical_together(tmp_path):
+    pool = IndexPool(tmp_path / "pool_0", DIMENSION)
+    pool.replace_user(1, _vectors(2), ["錯誤碼 E-11", "設備故障"], [{}, {}])
+    first = pool._generation
+    pool.replace_user(2, _vectors(1), ["網絡中斷"], [{}])
+
+    # 新版本包含兩個用戶的向量和全文索引，上一版本保留給仍在讀取它的進程
+    current = (pool.path / CURRENT_FILE).read_text(encoding="utf-8")
+    assert current == pool._generation != first
+    assert (pool.path / first / POOL_FILE).exists()
+    assert (pool.path / current / LEXICAL_INDEX_FILE).exists()
+    assert [position for position, _ in pool.search_lexical(1, ["E-11"], 5)[0]] == [0]
+    assert [position for position, _ in pool.search_lexical(2, ["網絡"], 5)[0]] == [0]
+
+    pool.replace_user(1, None, [], [])
+    assert not (pool.path / first).exists()
+    assert pool.search_lexical(1, ["E-11"], 5) == [[]]
+
+
+def test_has_user_sees_other_process_writes_after_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(pooled_index, "POOLED_INDEX_REFRESH_INTERVAL", 3600)
+    reader = IndexPool(tmp_path / "pool_0", DIMENSION)
+    writer = IndexPool(tmp_path / "pool_0", DIMENSION)
+    assert not reader.has_user(1)
+
+    writer.replace_user(1, _vectors(1), ["錯誤碼 E-11"], [{}])
+    # 查詢使用緩存的版本，建索引時強制讀取 CURRENT
+    assert not reader.has_user(1)
+    assert reader.has_user(1, fresh=True)
+    assert reader.corpus(1)[0] == ["錯誤碼 E-11"]
+
+
+def test_demotion_keeps_dedicated_index_until_next_pooled_build(tmp_path, hash_embedding):
+    kb = user_knowledge_base.UserKnowledgeBaseSystem(
+        base_docs_folder=str(tmp_path / "docs"),
+        base_index_path=str(tmp_path / "indexes"),
+        vector_index_type="flat",
+        pooled_max_documents=2
+    )
+    for i in range(3):
+        kb.save_user_document(1, f"doc{i}.txt", f"錯誤碼 E-{i * 11}".encode())
+    assert kb.build_user_index(1)
+    live = kb._active_index_path(1)
+    assert (live / "documents.pkl").exists()
+
+    for path in list(kb.get_user_docs_folder(1).glob("*doc2.txt")):
+        path.unlink()
+    assert kb.build_user_index(1)
+    assert kb.pooled_indexes.pool_for(1).has_user(1)
+    assert (live / "documents.pkl").exists()
+    assert [result["metadata"]["filename"].endswith("_doc1.txt")
+            for result in kb.search_user_documents(1, "E-11", top_k=1, retrieval="lexical")] == [True]
+
+    assert kb.build_user_index(1)
+    assert not live.exists()
@@ -0,0 +1,41 @@
+"""
+令牌桶存儲的淘汰和清理
+"""
+
+from scripts.rate_limit import InMemoryBucketStore, SQLiteBucketStore, RateLimit, RateLimiter, RateLimitExceeded
+
+
+def test_memory_store_is_capped_and_keeps_each_bucket_limit():
+    store = InMemoryBucketStore(max_keys=3)
+    strict, loose = RateLimit(per_minute=1, burst=1), RateLimit(per_minute=600, burst=100)
+    assert store.take("batch:a", strict)[0]
+    for i in range(10):
+        store.take(f"search:{i}", loose)
+        store.take("batch:a", strict)
+    # 最近使用的桶保留，桶數不超過上限；淘汰時按各自的限額判斷是否補滿
+    assert len(store._buckets) == 3
+    assert store._buckets["batch:a"][2] is strict
+    assert not store.take("batch:a", strict)[0]
+
+
+def test_sqlite_store_prunes_refilled_rows(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("scripts.rate_limit.time.time", lambda: clock[0])
+    store = SQLiteBucketStore(str(tmp_path / "limits.db"), prune_interval=0)
+    limit = RateLimit(per_minute=60, burst=5)
+    store.take("query:old", limit)
+    # burst / 補充速率 = 5 秒後已補滿
+    clock[0] += 6
+    store.take("query:new", limit)
+    keys = [key for key, in store._connection().execute("SELECT key FROM rate_limit_buckets")]
+    assert keys == ["query:new"]
+
+
+def test_rejections_are_counted():
+    limiter = RateLimiter(limits={"query": RateLimit(per_minute=1, burst=1)})
+    limiter.check("query", "a")
+    try:
+        limiter.check("query", "a")
+    except RateLimitExceeded:
+        pass
+    assert limiter.stats()["rejected"] == {"query": 1}
@@ -0,0 +1,39 @@
+"""
+檢索結果緩存按索引版本失效：其他 worker 重建索引後本 worker 的緩存不再命中
+"""
+
+from scripts import user_knowledge_base
+from scripts.search_cache import SearchResultCache
+
+
+def _make_kb(tmp_path, pooled_max_documents):
+    return user_knowledge_base.UserKnowledgeBaseSystem(
+        base_docs_folder=str(tmp_path / "docs"),
+        base_index_path=str(tmp_path / "indexes"),
+        vector_index_type="flat",
+        pooled_max_documents=pooled_max_documents
+    )
+
+
+def test_cache_misses_after_index_version_changes():
+    cache = SearchResultCache(ttl=300)
+    result_id = cache.put(1, "E-11", [{"score": 1.0}], index_version="gen_a")
+    assert cache.get(result_id, 1, "E-11", index_version="gen_a") == [{"score": 1.0}]
+    assert cache.get(result_id, 1, "E-11", index_version="gen_b") is None
+    assert cache.get(result_id, 1, "E-11", index_version="gen_a") is None
+
+
+def test_rebuild_in_another_worker_changes_index_version(tmp_path, hash_embedding):
+    for pooled_max_documents in (0, 5):
+        root = tmp_path / f"pooled_{pooled_max_documents}"
+        root.mkdir()
+        worker, other = _make_kb(root, pooled_max_documents), _make_kb(root, pooled_max_documents)
+        worker.save_user_document(1, "doc.txt", "錯誤碼 E-11".encode())
+        assert worker.build_user_index(1)
+        before = worker.index_version(1)
+
+        other.save_user_document(1, "extra.txt", "錯誤碼 E-22".encode())
+        assert other.build_user_index(1)
+        if worker.pooled_indexes is not None:
+            worker.pooled_indexes.pool_for(1)._refresh(force=True)
+        assert worker.index_version(1) != before
@@ -0,0 +1,80 @@
+"""
+分片索引與未分片索引的檢索結果一致性
+"""
+
+import numpy as np
+import pytest
+
+from scripts import user_knowledge_base
+
+
+@pytest.fixture
+def make_kb(tmp_path, monkeypatch, hash_embedding):
+    monkeypatch.setattr(user_knowledge_base, "PCA_MIN_TRAIN", 10)
+    docs_folder = tmp_path / "docs"
+
+    def make(index_shards):
+        return user_knowledge_base.UserKnowledgeBaseSystem(
+            base_docs_folder=str(docs_folder),
+            base_index_path=str(tmp_path / f"indexes_{index_shards}"),
+            vector_index_type="flat",
+            pca_dimension=8,
+            index_shards=index_shards,
+            pooled_max_documents=0
+        )
+    return make
+
+
+def _top_filenames(kb, query, top_k=5):
+    return [result["metadata"]["filename"] for result in kb.search_user_documents(1, query, top_k=top_k,
+                                                                                  retrieval="vector")]
+
+
+def test_sharded_pca_matches_unsharded(make_kb):
+    unsharded = make_kb(1)
+    for i in range(16):
+        unsharded.save_user_document(1, f"doc{i}.txt", f"錯誤碼 E-{i * 11} 表示設備 {i} 的第 {i % 4} 類故障".encode())
+    sharded = make_kb(2)
+    assert unsharded.build_user_index(1)
+    assert sharded.build_user_index(1)
+
+    # 兩個分片都有文檔，且使用同一降維矩陣
+    shard_dirs = sharded._index_dirs(1)
+    assert len(shard_dirs) == 2
+    matrices = [user_knowledge_base.load_pca(path / user_knowledge_base.PCA_FILE) for path in shard_dirs]
+    assert all(matrix.d_out == 8 for matrix in matrices)
+    assert np.array_equal(user_knowledge_base.faiss.vector_to_array(matrices[0].A),
+                          user_knowledge_base.faiss.vector_to_array(matrices[1].A))
+
+    for query in ["E-33", "設備 7", "第 2 類故障", "錯誤碼 E-121"]:
+        assert _top_filenames(sharded, query) == _top_filenames(unsharded, query)
+    assert _top_filenames(sharded, "E-33", top_k=1)[0].endswith("_doc3.txt")
+
+
+def test_incremental_shard_rebuild_reuses_generation_pca(make_kb):
+    kb = make_kb(2)
+    for i in range(16):
+        kb.save_user_document(1, f"doc{i}.txt", f"錯誤碼 E-{i * 11} 表示設備 {i} 的故障".encode())
+    assert kb.build_user_index(1)
+    before = user_knowledge_base.load_pca(kb._active_index_path(1) / user_knowledge_base.PCA_FILE)
+    before_matrix = user_knowledge_base.faiss.vector_to_array(before.A)
+
+    added = kb.save_user_document(1, "extra.txt", "新增的錯誤碼 E-999 文檔".encode())
+    assert kb.build_user_index(1, [added.rsplit("/", 1)[-1]])
+
+    for path in kb._index_dirs(1):
+        matrix = user_knowledge_base.load_pca(path / user_knowledge_base.PCA_FILE)
+        assert np.array_equal(user_knowledge_base.faiss.vector_to_array(matrix.A), before_matrix)
+    assert any(name.endswith("_extra.txt") for name in _top_filenames(kb, "E-999", top_k=17))
+
+
+def test_pca_min_train_below_dimension_skips_pca(make_kb, monkeypatch):
+    # 4 個片段不足以訓練 8 維的 PCA：PCA_MIN_TRAIN 按降維維度計，不降維而不是讓 faiss 報錯
+    monkeypatch.setattr(user_knowledge_base, "PCA_MIN_TRAIN", 2)
+    kb = make_kb(1)
+    assert kb.pca_min_train == 8
+    for i in range(4):
+        kb.save_user_document(1, f"doc{i}.txt", f"錯誤碼 E-{i * 11}".encode())
+    assert kb.build_user_index(1)
+    assert not (kb._active_index_path(1) / user_knowledge_base.PCA_FILE).exists()
+    assert _top_filenames(kb, "E-22", top_k=1)[0].endswith("_doc2.txt")